@@ -0,0 +1,5 @@
+"""
+Benchmarks of the `cfdoit` task loading, generation and dispatch phases.
+
+See `benchmarks/Readme.md`.
+"""
@@ -0,0 +1,289 @@
+"""
+Benchmark the dispatch of `WorkerTask`s to a (simulated) TaskManager.
+
+    python -m benchmarks.benchDispatch [options]
+
+A simulated TaskManager (see `benchmarks.simTaskManager`) is started in its
+own process (so that it does not pollute the client's measurements), and
+`--tasks` (remote, batchable) `WorkerTask`s are executed from a pool of
+`--concurrency` threads, just as `doit -n N -P thread` would execute them,
+using each of the dispatch modes:
+
+- `serial`:   one task at a time, one `taskRequest` per task,
+- `threaded`: concurrent tasks, one `taskRequest` per task,
+- `batched`:  concurrent tasks, coalesced into `batchRequest`s,
+- `speculative`: concurrent tasks, one `taskRequest` per task, speculatively
+  re-executing stragglers,
+- `affinity`: concurrent tasks, one `taskRequest` per task, with worker
+  affinity hints.
+
+The tasks belong to `--roots` root tasks. Each mode starts with cold
+(simulated) worker caches. The `speculative` and `affinity` modes (and, with
+`--rebuild`, every mode) first run the tasks once, with neither speculation
+nor affinity hints, to record their durations and workers in the task history
+(and to warm the workers' caches), so that the measured run is an incremental
+rebuild.
+
+For each mode the driver reports the throughput (tasks per second), the
+percentiles of the dispatch latency (from `execute` being called until the
+TaskManager received the request), of the time spent queued (in the
+TaskManager) for a free worker, and of the client overhead (the task's elapsed
+time less the time it spent in the TaskManager), the client's CPU time
+(per task) and its peak resident memory, together with the number of
+failures, of tasks which fell back to running locally, of (speculative)
+requests which were cancelled and of tasks which ran on a worker with a cold
+cache.
+
+Options:
+
+  --tasks N        the number of tasks in each mode (default: 200)
+  --concurrency N  the number of client threads (default: 16)
+  --modes LIST     the (comma separated) modes to run (default: all)
+  --roots N        the number of root tasks (default: 20)
+  --rebuild        measure an incremental rebuild in every mode
+  --sim JSON       overrides of the simulated TaskManager's configuration,
+                   for example (fault injection):
+                     '{"numWorkers": 32, "failRate": 0.01, "dropRate": 0.01}'
+                   or (stragglers, for the `speculative` mode):
+                     '{"slowWorkers": 1, "slowFactor": 20}'
+                   or (cold caches, for the `affinity` mode):
+                     '{"coldFactor": 5}'
+"""
+
+import concurrent.futures
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from doit.task import Task
+
+from cfdoit.computeFarmTools import (
+  tcpTMConnection, tcpTMSentRequest, tcpTMReadMessages, tcpTMCloseConnection
+)
+from cfdoit.config import Config
+from cfdoit.taskHistory import TaskHistory
+from cfdoit.workerTasks import WorkerTask
+
+dispatchModes = {
+  'serial'      : { 'concurrent' : False, 'batch' : False, 'speculate' : False, 'affinity' : False },
+  'threaded'    : { 'concurrent' : True,  'batch' : False, 'speculate' : False, 'affinity' : False },
+  'batched'     : { 'concurrent' : True,  'batch' : True,  'speculate' : False, 'affinity' : False },
+  'speculative' : { 'concurrent' : True,  'batch' : False, 'speculate' : True,  'affinity' : False },
+  'affinity'    : { 'concurrent' : True,  'batch' : False, 'speculate' : False, 'affinity' : True  }
+}
+
+def startSimTaskManager(simConfig) :
+  """
+  Start a simulated TaskManager process, returning the process and its port.
+  """
+  simProcess = subprocess.Popen(
+    [ sys.executable, '-m', 'benchmarks.simTaskManager',
+      '--config', json.dumps(simConfig) ],
+    stdout=subprocess.PIPE, text=True
+  )
+  aLine = simProcess.stdout.readline()
+  if not aLine.startswith('port ') :
+    simProcess.kill()
+    raise RuntimeError(f"The simulated TaskManager did not start: [{aLine}]")
+  return simProcess, int(aLine.split()[1])
+
+def simRequest(aPort, aRequest) :
+  """
+  Send `aRequest` to the simulated TaskManager and return its (first) reply.
+  """
+  aRequest = dict(aRequest)
+  aRequest['host'] = '127.0.0.1'
+  aRequest['port'] = aPort
+  with open(os.devnull, 'w') as devNull :
+    with contextlib.redirect_stdout(devNull) :
+      tmSocket = tcpTMConnection(aRequest)
+      if not tmSocket or not tcpTMSentRequest(aRequest, tmSocket) : return {}
+      aReply = next(tcpTMReadMessages(tmSocket), {})
+      tcpTMCloseConnection(tmSocket)
+  return aReply
+
+def configureClient(aPort, batch, speculate, affinity, stateDir) :
+  """
+  Configure `cfdoit` to use the simulated TaskManager.
+  """
+  Config.config = {}
+  Config.updateConfig({ 'GLOBAL' : {
+    'taskManager' : {
+      'host'                : '127.0.0.1',
+      'port'                : aPort,
+      'batch'               : batch,
+      'speculate'           : speculate,
+      'affinity'            : affinity,
+      # (the simulated tasks are short)
+      'speculateMinSeconds' : 0.05
+    },
+    'build'       : { 'stateDir' : stateDir }
+  }})
+  WorkerTask.remoteBatcher  = None
+  WorkerTask.tmBreaker      = None
+  WorkerTask.batchDurations = {}
+  WorkerTask.batchRetries   = 1.0
+
+def newWorkerTasks(aMode, numTasks, numRoots, baseDir) :
+  someTasks = []
+  for aTask in range(numTasks) :
+    aWorkerTask = WorkerTask({
+      'actions'          : [ 'true' ],
+      'environment'      : { 'taskName' : f"root{aTask % numRoots}", 'profile' : 'bench' },
+      'tools'            : [ 'g++' ],
+      'workers'          : [ 'simWorker' ],
+      'baseDir'          : baseDir,
+      'requiredPlatform' : 'linux-x86_64',
+      'batchable'        : True
+    })
+    someTasks.append(Task(f"{aMode}-{aTask}", [ aWorkerTask ]))
+  return someTasks
+
+def percentile(someValues, aPercent) :
+  if not someValues : return float('nan')
+  someValues = sorted(someValues)
+  anIndex    = min(len(someValues) - 1, int(round(aPercent / 100 * (len(someValues) - 1))))
+  return someValues[anIndex]
+
+def runMode(aMode, aPort, numTasks, numRoots, concurrency, rebuild, workDir) :
+  """
+  Execute `numTasks` WorkerTasks in the dispatch mode `aMode`, returning the
+  client side measurements.
+  """
+  modeConfig = dispatchModes[aMode]
+  numThreads = concurrency if modeConfig['concurrent'] else 1
+  stateDir   = os.path.join(workDir, '.cfdoit')
+
+  timings = {}
+  def executeTask(aTask) :
+    startedAt = time.time()
+    failure   = aTask.actions[0].execute()
+    timings[aTask.name] = (startedAt, time.time(), failure)
+
+  def executeTasks() :
+    with open(os.devnull, 'w') as devNull :
+      with contextlib.redirect_stdout(devNull) :
+        with concurrent.futures.ThreadPoolExecutor(numThreads) as anExecutor :
+          list(anExecutor.map(
+            executeTask, newWorkerTasks(aMode, numTasks, numRoots, workDir)
+          ))
+
+  simRequest(aPort, { 'type' : 'simStats', 'coldCaches' : True })
+  if rebuild or modeConfig['speculate'] or modeConfig['affinity'] :
+    # record the task durations and workers on which speculation and the
+    # affinity hints depend
+    configureClient(aPort, modeConfig['batch'], False, False, stateDir)
+    executeTasks()
+    timings = {}
+  configureClient(
+    aPort, modeConfig['batch'], modeConfig['speculate'], modeConfig['affinity'], stateDir
+  )
+  simRequest(aPort, { 'type' : 'simStats', 'reset' : True })
+
+  startCpu  = time.process_time()
+  startTime = time.time()
+  executeTasks()
+  elapsed = time.time() - startTime
+  cpuTime = time.process_time() - startCpu
+
+  simStats    = simRequest(aPort, { 'type' : 'simStats' })
+  serverTasks = simStats.get('tasks', {})
+  dispatch    = []
+  queued      = []
+  overhead    = []
+  failures    = 0
+  fallbacks   = 0
+  for aTaskName, (startedAt, finishedAt, failure) in timings.items() :
+    if failure is not None : failures += 1
+    if aTaskName not in serverTasks :
+      fallbacks += 1
+      continue
+    serverTask = serverTasks[aTaskName]
+    dispatch.append(serverTask['receivedAt'] - startedAt)
+    queued.append(serverTask['startedAt'] - serverTask['receivedAt'])
+    overhead.append(
+      (finishedAt - startedAt) - (serverTask['finishedAt'] - serverTask['receivedAt'])
+    )
+
+  return {
+    'tasksPerSecond' : numTasks / elapsed,
+    'dispatchP50'    : percentile(dispatch, 50),
+    'dispatchP90'    : percentile(dispatch, 90),
+    'dispatchP99'    : percentile(dispatch, 99),
+    'queuedP50'      : percentile(queued, 50),
+    'queuedP99'      : percentile(queued, 99),
+    'overheadP50'    : percentile(overhead, 50),
+    'overheadP99'    : percentile(overhead, 99),
+    'cpuPerTask'     : cpuTime / numTasks,
+    'maxRSSMB'       : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'failures'       : failures,
+    'fallbacks'      : fallbacks,
+    'cancelled'      : simStats.get('counts', {}).get('cancelled', 0),
+    'coldStarts'     : simStats.get('counts', {}).get('coldStarts', 0)
+  }
+
+def printResults(allResults) :
+  print(
+    f"{'mode':11} {'tasks/s':>9} {'disp50ms':>9} {'disp90ms':>9} {'disp99ms':>9}" +
+    f" {'queue50ms':>9} {'queue99ms':>9} {'ovh50ms':>9} {'ovh99ms':>9} {'cpu/task':>9} {'maxRSSMB':>9}" +
+    f" {'failed':>7} {'local':>6} {'cancel':>6} {'cold':>6}"
+  )
+  for aMode, results in allResults.items() :
+    print(
+      f"{aMode:11} {results['tasksPerSecond']:9.1f}" +
+      f" {results['dispatchP50']*1000:9.2f} {results['dispatchP90']*1000:9.2f}" +
+      f" {results['dispatchP99']*1000:9.2f} {results['queuedP50']*1000:9.2f}" +
+      f" {results['queuedP99']*1000:9.2f} {results['overheadP50']*1000:9.2f}" +
+      f" {results['overheadP99']*1000:9.2f} {results['cpuPerTask']*1000:9.3f}" +
+      f" {results['maxRSSMB']:9.1f} {results['failures']:7d} {results['fallbacks']:6d}" +
+      f" {results['cancelled']:6d} {results['coldStarts']:6d}"
+    )
+
+def main(someArgs) :
+  numTasks    = 200
+  concurrency = 16
+  numRoots    = 20
+  rebuild     = False
+  modes       = list(dispatchModes.keys())
+  simConfig   = {}
+  while someArgs :
+    anArg = someArgs.pop(0)
+    if   anArg == '--tasks'       : numTasks    = int(someArgs.pop(0))
+    elif anArg == '--concurrency' : concurrency = int(someArgs.pop(0))
+    elif anArg == '--modes'       : modes       = someArgs.pop(0).split(',')
+    elif anArg == '--roots'       : numRoots    = int(someArgs.pop(0))
+    elif anArg == '--rebuild'     : rebuild     = True
+    elif anArg == '--sim'         : simConfig.update(json.loads(someArgs.pop(0)))
+    else :
+      print(f"Unknown option: {anArg}")
+      return 1
+  for aMode in modes :
+    if aMode not in dispatchModes :
+      print(f"Unknown dispatch mode: {aMode}")
+      return 1
+
+  simProcess, aPort = startSimTaskManager(simConfig)
+  allResults = {}
+  try :
+    with tempfile.TemporaryDirectory(prefix='cfdoit-dispatch-') as workDir :
+      for aMode in modes :
+        allResults[aMode] = runMode(
+          aMode, aPort, numTasks, numRoots, concurrency, rebuild, workDir
+        )
+      # (save the recorded task history while its directory still exists)
+      TaskHistory.save()
+  finally :
+    simProcess.terminate()
+    simProcess.wait()
+
+  print(f"{numTasks} tasks, {concurrency} client threads, simulated TaskManager: {json.dumps(simConfig)}")
+  printResults(allResults)
+  return 0
+
+if __name__ == '__main__' :
+  sys.exit(main(sys.argv[1:]))
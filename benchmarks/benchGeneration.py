@@ -0,0 +1,299 @@
+"""
+Benchmark the load and generation phases of `cfdoit` over synthetic trees.
+
+    python -m benchmarks.benchGeneration [options] [SCENARIO ...]
+
+For each (synthetic, see `benchmarks.synthDescriptions`) scenario the
+following phases are timed (the best of `--repeat` runs) and their peak
+(traced) memory measured (in a separate run, since tracing slows Python
+down):
+
+- `tomlLoad`:   loading the `cfdoit.toml` configuration,
+- `yamlLoad`:   parsing the YAML task descriptions,
+- `merge`:      merging the descriptions (`Config.mergeData`),
+- `generation`: generating the task dicts (`task_genTasks`, that is
+                `mergeTaskDef`, `buildTasksFromDef` and `expandEnv*`),
+- `taskYield`:  turning the yielded task dicts into `doit` tasks.
+
+(`yamlLoad` and `merge` together are `Config.loadDescriptions`.)
+
+The benchmarks run offline: the worker inventory is stubbed so that every
+platform is built locally, and the output of the generator is discarded.
+
+Options:
+
+  --repeat N   the number of timed runs of each scenario (default: 3)
+  --update     save the results as the new baselines
+  --list       list the scenarios
+  --baselines  the baselines file (default: benchmarks/baselines.json)
+
+The results are compared with the baselines, and any phase which is slower
+(or uses more memory) than its baseline by more than the baselines'
+`thresholds` is reported as a regression (and the benchmark exits with 1).
+Differences smaller than the `minSeconds` and `minMB` noise floors are
+ignored. Baselines are machine specific, so they should be (re)recorded
+(`--update`) on the machine which checks them.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+from doit.loader import generate_tasks
+
+from cfdoit.cli import loadCfdoitConfig
+from cfdoit.config import Config
+from cfdoit.workerTasks import WorkerTask
+import cfdoit.dodo
+import cfdoit.taskGenerator
+
+from benchmarks.synthDescriptions import (
+  registerSyntheticSnipets, writeSyntheticTree
+)
+
+scenarios = {
+  'small' : {
+    'numPackages' : 5, 'numProjects' : 5, 'sourcesPerProject' : 10,
+    'snipetDepth' : 1, 'platforms' : [ 'linux-x86_64' ], 'numDescFiles' : 5
+  },
+  'medium' : {
+    'numPackages' : 20, 'numProjects' : 20, 'sourcesPerProject' : 25,
+    'snipetDepth' : 3, 'platforms' : [ 'linux-x86_64', 'linux-aarch64' ],
+    'numDescFiles' : 50
+  },
+  'large' : {
+    'numPackages' : 50, 'numProjects' : 50, 'sourcesPerProject' : 40,
+    'snipetDepth' : 5,
+    'platforms'   : [ 'linux-x86_64', 'linux-aarch64', 'linux-riscv64' ],
+    'numDescFiles' : 200
+  },
+  'deep' : {
+    'numPackages' : 5, 'numProjects' : 5, 'sourcesPerProject' : 20,
+    'snipetDepth' : 20, 'platforms' : [ 'linux-x86_64' ], 'numDescFiles' : 5
+  }
+}
+
+phases = [ 'tomlLoad', 'yamlLoad', 'merge', 'generation', 'taskYield' ]
+
+defaultThresholds = {
+  'seconds'    : 0.25,
+  'peakMB'     : 0.25,
+  'minSeconds' : 0.01,
+  'minMB'      : 1.0
+}
+
+def baselinesPath() :
+  return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+def stubWorkerInventory(treeDir, somePlatforms) :
+  """
+  Stub the taskManager's worker inventory so that every platform is built
+  (locally) in the `treeDir`.
+  """
+  WorkerTask.availablePlatforms = { 'any' : True }
+  for aPlatform in somePlatforms :
+    WorkerTask.availablePlatforms[aPlatform] = True
+  WorkerTask.availableTools   = {}
+  WorkerTask.availableWorkers = {}
+  WorkerTask.baseDirectory    = treeDir
+
+def descriptionFiles(somePaths) :
+  descFiles = []
+  for aPath in somePaths :
+    if os.path.isdir(aPath) :
+      for aDir, someSubDirs, someFiles in os.walk(aPath) :
+        for aFile in sorted(someFiles) :
+          if aFile.endswith('.yaml') : descFiles.append(os.path.join(aDir, aFile))
+    else :
+      descFiles.append(aPath)
+  return descFiles
+
+class PhaseRecorder :
+  """
+  Record the duration (and, if tracing, the peak memory) of each phase.
+  """
+
+  def __init__(self, tracing) :
+    self.tracing = tracing
+    self.results = {}
+
+  @contextlib.contextmanager
+  def phase(self, aPhase) :
+    if self.tracing :
+      tracemalloc.reset_peak()
+      startMemory = tracemalloc.get_traced_memory()[0]
+    startTime = time.perf_counter()
+    yield
+    result = { 'seconds' : time.perf_counter() - startTime }
+    if self.tracing :
+      peakMemory = tracemalloc.get_traced_memory()[1]
+      result['peakMB'] = (peakMemory - startMemory) / (1024*1024)
+    self.results[aPhase] = result
+
+def runPhases(treeDir, someParameters, tracing=False) :
+  """
+  Run (once) each of the phases over the synthetic tree in `treeDir`,
+  returning the recorded results (and the number of tasks generated).
+  """
+  recorder = PhaseRecorder(tracing)
+  oldDir   = os.getcwd()
+  os.chdir(treeDir)
+  try :
+    with recorder.phase('tomlLoad') :
+      Config.config = {}
+      Config.updateConfig(loadCfdoitConfig())
+
+    descPaths = Config.config['GLOBAL']['build'].get('descPaths', [])
+    with recorder.phase('yamlLoad') :
+      documents = []
+      for aPath in descriptionFiles(descPaths) :
+        with open(aPath) as yamlFile :
+          documents.append(yaml.safe_load(yamlFile.read()))
+
+    with recorder.phase('merge') :
+      descriptions = {}
+      for aDocument in documents :
+        Config.mergeData(descriptions, aDocument, '.')
+      Config.descriptions = descriptions
+
+    stubWorkerInventory(treeDir, someParameters['platforms'])
+    registerSyntheticSnipets(someParameters['snipetDepth'])
+    cfdoit.taskGenerator.clearRootTaskCache()
+    with recorder.phase('generation') :
+      with open(os.devnull, 'w') as devNull :
+        with contextlib.redirect_stdout(devNull) :
+          taskDicts = list(cfdoit.dodo.task_genTasks())
+
+    with recorder.phase('taskYield') :
+      doitTasks = generate_tasks(
+        'genTasks', (aTaskDict for aTaskDict in taskDicts),
+        cfdoit.dodo.task_genTasks.__doc__
+      )
+  finally :
+    os.chdir(oldDir)
+  return recorder.results, len(doitTasks)
+
+def benchmarkScenario(aScenario, someParameters, numRepeats) :
+  """
+  Benchmark the scenario, returning the best time and the peak memory of each
+  phase.
+  """
+  with tempfile.TemporaryDirectory(prefix='cfdoit-bench-') as treeDir :
+    writeSyntheticTree(treeDir, someParameters)
+
+    results = {}
+    for aRepeat in range(numRepeats) :
+      someResults, numTasks = runPhases(treeDir, someParameters)
+      for aPhase, aResult in someResults.items() :
+        if aPhase not in results or aResult['seconds'] < results[aPhase]['seconds'] :
+          results[aPhase] = { 'seconds' : aResult['seconds'] }
+
+    tracemalloc.start()
+    try :
+      someResults, numTasks = runPhases(treeDir, someParameters, tracing=True)
+    finally :
+      tracemalloc.stop()
+    for aPhase, aResult in someResults.items() :
+      results[aPhase]['peakMB'] = aResult['peakMB']
+
+  results['numTasks'] = numTasks
+  return results
+
+def loadBaselines(aPath) :
+  if not os.path.exists(aPath) : return { 'thresholds' : defaultThresholds }
+  with open(aPath) as baselinesFile :
+    return json.load(baselinesFile)
+
+def compareWithBaseline(aScenario, results, baselines) :
+  """
+  Print the results of the scenario (compared with its baseline) and return
+  the list of regressions.
+  """
+  thresholds = dict(defaultThresholds)
+  thresholds.update(baselines.get('thresholds', {}))
+  baseline    = baselines.get('scenarios', {}).get(aScenario, {})
+  regressions = []
+
+  print(f"\n{aScenario} ({results['numTasks']} tasks)")
+  print(f"  {'phase':12} {'seconds':>10} {'baseline':>10} {'peakMB':>10} {'baseline':>10}")
+  for aPhase in phases :
+    aResult   = results[aPhase]
+    aBaseline = baseline.get(aPhase, {})
+    marks     = ""
+    for aMetric, aMinimum in [ ('seconds', 'minSeconds'), ('peakMB', 'minMB') ] :
+      if aMetric not in aBaseline : continue
+      limit = aBaseline[aMetric] * (1 + thresholds[aMetric])
+      if aResult[aMetric] > limit and \
+        aResult[aMetric] - aBaseline[aMetric] > thresholds[aMinimum] :
+        regressions.append(f"{aScenario}.{aPhase}.{aMetric}")
+        marks += f" REGRESSION({aMetric})"
+    baseSeconds = aBaseline.get('seconds', float('nan'))
+    baseMB      = aBaseline.get('peakMB',  float('nan'))
+    print(
+      f"  {aPhase:12} {aResult['seconds']:10.4f} {baseSeconds:10.4f}" +
+      f" {aResult['peakMB']:10.2f} {baseMB:10.2f}{marks}"
+    )
+  return regressions
+
+def saveBaselines(aPath, baselines, allResults) :
+  if 'thresholds' not in baselines : baselines['thresholds'] = defaultThresholds
+  if 'scenarios'  not in baselines : baselines['scenarios']  = {}
+  for aScenario, results in allResults.items() :
+    baselines['scenarios'][aScenario] = {
+      aPhase : {
+        'seconds' : round(results[aPhase]['seconds'], 4),
+        'peakMB'  : round(results[aPhase]['peakMB'], 2)
+      } for aPhase in phases
+    }
+    baselines['scenarios'][aScenario]['numTasks'] = results['numTasks']
+  with open(aPath, 'w') as baselinesFile :
+    json.dump(baselines, baselinesFile, indent=2, sort_keys=True)
+    baselinesFile.write("\n")
+  print(f"\nSaved the baselines to {aPath}")
+
+def main(someArgs) :
+  numRepeats   = 3
+  update       = False
+  theBaselines = baselinesPath()
+  toRun        = []
+  while someArgs :
+    anArg = someArgs.pop(0)
+    if   anArg == '--repeat'    : numRepeats   = int(someArgs.pop(0))
+    elif anArg == '--update'    : update       = True
+    elif anArg == '--baselines' : theBaselines = someArgs.pop(0)
+    elif anArg == '--list' :
+      print(yaml.dump(scenarios))
+      return 0
+    elif anArg in scenarios     : toRun.append(anArg)
+    else :
+      print(f"Unknown scenario or option: {anArg}")
+      return 1
+  if not toRun : toRun = [ 'small', 'medium' ]
+
+  baselines   = loadBaselines(theBaselines)
+  allResults  = {}
+  regressions = []
+  for aScenario in toRun :
+    allResults[aScenario] = benchmarkScenario(
+      aScenario, scenarios[aScenario], numRepeats
+    )
+    regressions.extend(
+      compareWithBaseline(aScenario, allResults[aScenario], baselines)
+    )
+
+  if update :
+    saveBaselines(theBaselines, baselines, allResults)
+    return 0
+  if regressions :
+    print(f"\nRegressions: {', '.join(regressions)}")
+    return 1
+  return 0
+
+if __name__ == '__main__' :
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,467 @@
+"""
+A simulated (local) ComputeFarm TaskManager.
+
+The simulated TaskManager speaks the same newline terminated JSON protocol as
+a real TaskManager (see `cfdoit.computeFarmTools`):
+
+- a `workerQuery` is answered with the (simulated) worker inventory,
+
+- a `taskRequest` waits for a free (simulated) worker (other than any of its
+  `excludeWorkers`, preferring, for up to the `preferredWait`, any of the
+  `preferredWorkers` of its `affinity` hints), reports the `worker`, "runs"
+  the task for a (randomly distributed) latency, and then streams a (randomly
+  distributed) number and size of `msg`s followed by a `returncode`,
+
+- a `blobQuery` is answered with the `missing` blobs (of its `hashes`) and a
+  `blobPut` stores (and verifies) its `blobs` in the (simulated) blob store,
+
+- a task with a `staging` dict fails unless all of its `inputs` are in the
+  blob store, and then sends a `target` message for each of its `targets`
+  (as a `delta` against its `base`, when the base is in the blob store). A
+  (simulated) target is the concatenation of the task's inputs followed by
+  its name,
+
+- a `cancelRequest` cancels the running (task or batch) request with the
+  given `requestId`, and is acknowledged with a `cancelled` message,
+
+- a `batchRequest` runs each of its tasks (concurrently if requested), tagging
+  every message with the task's `taskName` (and the `returncode` with the
+  task's `duration` and `worker`),
+
+- a `simStats` request (only understood by this simulation) is answered with
+  the (client visible) timings of every task run, so that a benchmark can
+  compute dispatch latencies (and optionally empties the workers' caches).
+
+Faults can be injected: tasks can fail (`failRate`), connections can be
+refused (`refuseRate`) or dropped part way through a task (`dropRate`), and
+tasks can be slowed down (`slowRate`, `slowFactor`), as can every task run by
+the first `slowWorkers` workers.
+
+Each worker has a (simulated) warm cache of the root tasks (the `taskName` of
+a task's `env`) it has run; the latency of a task whose root task is not in
+its worker's cache is multiplied by the `coldFactor`.
+
+Distributions are dicts with a `dist` key (`fixed`, `uniform`, `exponential`
+or `lognormal`) and its parameters (`value`; `low` and `high`; `mean`; `mean`
+and `sigma`).
+
+The simulated TaskManager can be run on its own:
+
+    python -m benchmarks.simTaskManager [--port PORT] [--config JSON]
+"""
+
+import json
+import math
+import random
+import socketserver
+import sys
+import threading
+import time
+
+from cfdoit.staging import blobHash, encodeBytes, decodeBytes, blockDelta
+
+defaultSimConfig = {
+  'host'        : '127.0.0.1',
+  'port'        : 0,  # (0 asks the OS for a free port)
+  'numWorkers'  : 8,
+  'platforms'   : [ 'linux-x86_64' ],
+  'tools'       : [ 'g++', 'install', 'ar', 'cmake', 'ninja', 'curl', 'tar' ],
+  'latency'     : { 'dist' : 'lognormal', 'mean' : 0.02, 'sigma' : 0.5 },
+  'numMsgs'     : { 'dist' : 'uniform', 'low' : 1, 'high' : 10 },
+  'msgBytes'    : { 'dist' : 'exponential', 'mean' : 200 },
+  'failRate'    : 0.0,
+  'refuseRate'  : 0.0,
+  'dropRate'    : 0.0,
+  'slowRate'    : 0.0,
+  'slowFactor'  : 10.0,
+  'slowWorkers' : 0,
+  'coldFactor'  : 1.0,
+  'seed'        : 1
+}
+
+def sampleFrom(aDistribution, aRandom) :
+  """
+  Return a (non-negative) sample from `aDistribution` using `aRandom`.
+  """
+  if not isinstance(aDistribution, dict) : return max(0, aDistribution)
+  aDist = aDistribution.get('dist', 'fixed')
+  if aDist == 'fixed' :
+    aSample = aDistribution.get('value', 0)
+  elif aDist == 'uniform' :
+    aSample = aRandom.uniform(aDistribution['low'], aDistribution['high'])
+  elif aDist == 'exponential' :
+    aSample = aRandom.expovariate(1.0 / aDistribution['mean'])
+  elif aDist == 'lognormal' :
+    # parameterized by the distribution's (arithmetic) mean
+    sigma   = aDistribution.get('sigma', 0.5)
+    mu      = math.log(aDistribution['mean']) - sigma * sigma / 2
+    aSample = aRandom.lognormvariate(mu, sigma)
+  else :
+    print(f"Unknown distribution: {aDist}")
+    aSample = 0
+  return max(0, aSample)
+
+class SimRequestHandler(socketserver.StreamRequestHandler) :
+  """
+  Handle one (simulated) TaskManager connection.
+  """
+
+  def sendMessage(self, aMessage) :
+    self.wfile.write((json.dumps(aMessage) + "\n").encode())
+    self.wfile.flush()
+
+  def handle(self) :
+    simTM   = self.server.simTM
+    aLine   = self.rfile.readline()
+    if not aLine : return
+    if simTM.chance('refuseRate') : return
+    try :
+      aRequest = json.loads(aLine.decode())
+    except Exception as err :
+      print(f"Could not decode the request: {repr(err)}")
+      return
+    receivedAt  = time.time()
+    requestType = aRequest.get('type', None)
+    try :
+      if requestType == 'workerQuery' :
+        self.sendMessage(simTM.inventory())
+      elif requestType == 'taskRequest' :
+        simTM.runTask(self, aRequest, receivedAt, False)
+      elif requestType == 'batchRequest' :
+        simTM.runBatch(self, aRequest, receivedAt)
+      elif requestType == 'blobQuery' :
+        self.sendMessage({ 'missing' : simTM.missingBlobs(aRequest.get('hashes', [])) })
+      elif requestType == 'blobPut' :
+        self.sendMessage({ 'stored' : simTM.storeBlobs(aRequest.get('blobs', [])) })
+      elif requestType == 'cancelRequest' :
+        requestId = aRequest.get('requestId', None)
+        self.sendMessage({ 'cancelled' : requestId, 'found' : simTM.cancel(requestId) })
+      elif requestType == 'simStats' :
+        if aRequest.get('coldCaches', False) : simTM.coldCaches()
+        self.sendMessage(simTM.statistics(aRequest.get('reset', False)))
+      else :
+        print(f"Unknown request type: {requestType}")
+    except (BrokenPipeError, ConnectionResetError) :
+      pass  # the client has gone away
+
+class SimServer(socketserver.ThreadingTCPServer) :
+  allow_reuse_address = True
+  daemon_threads      = True
+  # (the default backlog of 5 makes bursts of connections wait for SYN retries)
+  request_queue_size  = 128
+
+class DroppedConnection(Exception) :
+  pass
+
+class SimulatedTaskManager :
+  """
+  A simulated TaskManager (see the module documentation) configured by the
+  `someConfig` overrides of the `defaultSimConfig`.
+  """
+
+  def __init__(self, someConfig={}) :
+    self.config = dict(defaultSimConfig)
+    self.config.update(someConfig)
+    self.random     = random.Random(self.config['seed'])
+    self.randomLock = threading.Lock()
+    self.freeNames  = [ f"simWorker{aWorker}" for aWorker in range(self.config['numWorkers']) ]
+    self.slowNames  = self.freeNames[:self.config['slowWorkers']]
+    self.namesFree  = threading.Condition()
+    self.running    = {}  # requestId -> cancelled Event
+    self.warm       = { aWorkerName : set() for aWorkerName in self.freeNames }
+    self.blobs      = {}
+    self.statsLock  = threading.Lock()
+    self.tasks      = {}
+    self.counts     = {}
+    self.server     = None
+    self.thread     = None
+
+  def start(self) :
+    """
+    Start serving (in a background thread), returning the (host, port).
+    """
+    self.server = SimServer((self.config['host'], self.config['port']), SimRequestHandler)
+    self.server.simTM = self
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    return self.server.server_address
+
+  def stop(self) :
+    if self.server is None : return
+    self.server.shutdown()
+    self.server.server_close()
+    self.server = None
+
+  def sample(self, aKey) :
+    with self.randomLock :
+      return sampleFrom(self.config[aKey], self.random)
+
+  def chance(self, aKey) :
+    if not self.config[aKey] : return False
+    with self.randomLock :
+      return self.random.random() < self.config[aKey]
+
+  def count(self, aKey) :
+    with self.statsLock :
+      self.counts[aKey] = self.counts.get(aKey, 0) + 1
+
+  def inventory(self) :
+    """
+    Return the (simulated) worker inventory as a `workerQuery` reply.
+    """
+    workerType = 'simWorker'
+    return {
+      'tools'     : { aTool : [ workerType ] for aTool in self.config['tools'] },
+      'workers'   : { workerType : { 'numWorkers' : self.config['numWorkers'] } },
+      'hostTypes' : { aPlatform : [ workerType ] for aPlatform in self.config['platforms'] }
+    }
+
+  def acquireWorker(self, excludeWorkers=[], preferredWorkers=[], preferredWait=0) :
+    """
+    Wait for (and return) a free worker which is not excluded, preferring
+    (for up to `preferredWait` seconds) any of the `preferredWorkers`.
+    """
+    deadline = time.time() + preferredWait
+    with self.namesFree :
+      while True :
+        freeNames = [
+          aWorkerName for aWorkerName in reversed(self.freeNames)
+          if aWorkerName not in excludeWorkers
+        ]
+        preferred = [
+          aWorkerName for aWorkerName in preferredWorkers if aWorkerName in freeNames
+        ]
+        aTimeOut = None
+        if preferred :
+          aWorkerName = preferred[0]
+        elif freeNames and (not preferredWorkers or deadline <= time.time()) :
+          aWorkerName = freeNames[0]
+        else :
+          if freeNames : aTimeOut = deadline - time.time()
+          self.namesFree.wait(aTimeOut)
+          continue
+        self.freeNames.remove(aWorkerName)
+        return aWorkerName
+
+  def releaseWorker(self, aWorkerName) :
+    with self.namesFree :
+      self.freeNames.append(aWorkerName)
+      self.namesFree.notify_all()
+
+  def missingBlobs(self, someHashes) :
+    with self.statsLock :
+      return [ aHash for aHash in someHashes if aHash not in self.blobs ]
+
+  def storeBlobs(self, someBlobs) :
+    """
+    Store (and count) the (verified) `someBlobs`, returning the number stored.
+    """
+    numStored = 0
+    for aBlob in someBlobs :
+      someBytes = decodeBytes(aBlob['data'])
+      if blobHash(someBytes) != aBlob['hash'] : continue
+      with self.statsLock :
+        self.blobs[aBlob['hash']] = someBytes
+        self.counts['blobsPut']     = self.counts.get('blobsPut', 0) + 1
+        self.counts['blobBytesPut'] = self.counts.get('blobBytesPut', 0) + len(someBytes)
+      numStored += 1
+    return numStored
+
+  def stagedTargets(self, aTaskName, aStaging, inBatch) :
+    """
+    Return the `target` messages of a staged task (or None if any of its
+    inputs are missing from the blob store).
+    """
+    with self.statsLock :
+      inputs = []
+      for relPath, aHash in sorted(aStaging.get('inputs', {}).items()) :
+        if aHash not in self.blobs : return None
+        inputs.append(self.blobs[aHash])
+    someBytes = b"".join(inputs) + aTaskName.encode()
+    aHash     = blobHash(someBytes)
+    blockSize = aStaging.get('blockSize', 65536)
+    targetMsgs = []
+    for relPath in aStaging.get('targets', []) :
+      aMsg = { 'target' : relPath, 'hash' : aHash }
+      if inBatch : aMsg['taskName'] = aTaskName
+      with self.statsLock :
+        self.blobs[aHash] = someBytes
+        baseBytes = self.blobs.get(aStaging.get('bases', {}).get(relPath, None), None)
+      if baseBytes is not None :
+        aMsg['base']  = blobHash(baseBytes)
+        aMsg['delta'] = blockDelta(baseBytes, someBytes, blockSize)
+      else :
+        aMsg['data']  = encodeBytes(someBytes)
+      self.count('targets')
+      with self.statsLock :
+        self.counts['targetBytesSent'] = self.counts.get('targetBytesSent', 0) + \
+          len(json.dumps(aMsg))
+      targetMsgs.append(aMsg)
+    return targetMsgs
+
+  def cancellable(self, aRequestId) :
+    """
+    Return the Event which is set when the request `aRequestId` is cancelled.
+    """
+    cancelled = threading.Event()
+    if aRequestId :
+      with self.statsLock : self.running[aRequestId] = cancelled
+    return cancelled
+
+  def finished(self, aRequestId) :
+    with self.statsLock :
+      if aRequestId in self.running : del self.running[aRequestId]
+
+  def cancel(self, aRequestId) :
+    """
+    Cancel the running request `aRequestId`, returning True if it was found.
+    """
+    with self.statsLock :
+      if aRequestId not in self.running : return False
+      self.running[aRequestId].set()
+    self.count('cancelRequests')
+    return True
+
+  def simulateTask(self, aTask, receivedAt, sendMessage, inBatch, cancelled) :
+    """
+    "Run" one task (described by the `aTask` request) sending its messages
+    using `sendMessage`, and recording its timings. The task stops (without a
+    reply) if `cancelled` is set.
+    """
+    aTaskName   = aTask['taskName']
+    affinity    = aTask.get('affinity', None) or {}
+    preferred   = affinity.get('preferredWorkers', [])
+    aWorkerName = self.acquireWorker(
+      aTask.get('excludeWorkers', []), preferred, affinity.get('preferredWait', 0)
+    )
+    if aWorkerName in preferred : self.count('affinityHits')
+    startedAt   = time.time()
+    try :
+      if not inBatch : sendMessage({ 'worker' : aWorkerName })
+      latency = self.sample('latency')
+      if self.chance('slowRate') or aWorkerName in self.slowNames :
+        latency *= self.config['slowFactor']
+        self.count('slowed')
+      aRootTask = aTask.get('env', {}).get('taskName', aTaskName)
+      with self.statsLock :
+        isCold = aRootTask not in self.warm[aWorkerName]
+        self.warm[aWorkerName].add(aRootTask)
+      if isCold :
+        latency *= self.config['coldFactor']
+        self.count('coldStarts')
+      if cancelled.wait(latency) :
+        self.count('cancelled')
+        raise DroppedConnection(aTaskName)
+      numMsgs = int(self.sample('numMsgs'))
+      for aMsg in range(numMsgs) :
+        aMessage = { 'msg' : 'x' * int(self.sample('msgBytes')) }
+        if inBatch : aMessage['taskName'] = aTaskName
+        sendMessage(aMessage)
+        if aMsg == numMsgs // 2 and self.chance('dropRate') :
+          self.count('dropped')
+          raise DroppedConnection(aTaskName)
+      returnCode = 0
+      if 'staging' in aTask :
+        targetMsgs = self.stagedTargets(aTaskName, aTask['staging'], inBatch)
+        if targetMsgs is None :
+          returnCode = 2
+          self.count('missingInputs')
+        else :
+          for aMsg in targetMsgs : sendMessage(aMsg)
+      if returnCode == 0 and self.chance('failRate') :
+        returnCode = 1
+        self.count('failed')
+      finishedAt = time.time()
+      aReply = {
+        'returncode' : returnCode,
+        'duration'   : finishedAt - startedAt,
+        'worker'     : aWorkerName
+      }
+      if inBatch : aReply['taskName'] = aTaskName
+      sendMessage(aReply)
+    finally :
+      self.releaseWorker(aWorkerName)
+    with self.statsLock :
+      self.tasks[aTaskName] = {
+        'receivedAt' : receivedAt,
+        'startedAt'  : startedAt,
+        'finishedAt' : finishedAt,
+        'service'    : latency,
+        'numMsgs'    : numMsgs,
+        'worker'     : aWorkerName
+      }
+    self.count('tasks')
+
+  def runTask(self, aHandler, aRequest, receivedAt, inBatch) :
+    aRequestId = aRequest.get('requestId', None)
+    try :
+      self.simulateTask(
+        aRequest, receivedAt, aHandler.sendMessage, inBatch,
+        self.cancellable(aRequestId)
+      )
+    except DroppedConnection :
+      pass  # (the connection is closed when the handler returns)
+    finally :
+      self.finished(aRequestId)
+
+  def runBatch(self, aHandler, aRequest, receivedAt) :
+    self.count('batches')
+    aRequestId = aRequest.get('requestId', None)
+    cancelled  = self.cancellable(aRequestId)
+    sendLock   = threading.Lock()
+    def sendMessage(aMessage) :
+      with sendLock : aHandler.sendMessage(aMessage)
+    def runOne(aTask) :
+      try :
+        self.simulateTask(aTask, receivedAt, sendMessage, True, cancelled)
+      except DroppedConnection :
+        # close the whole batch connection
+        try :
+          aHandler.connection.shutdown(2)
+        except OSError :
+          pass
+      except OSError :
+        pass  # the connection has already been dropped
+    if aRequest.get('runConcurrently', False) :
+      threads = [
+        threading.Thread(target=runOne, args=(aTask,)) for aTask in aRequest['tasks']
+      ]
+      for aThread in threads : aThread.start()
+      for aThread in threads : aThread.join()
+    else :
+      for aTask in aRequest['tasks'] :
+        if not cancelled.is_set() : runOne(aTask)
+    self.finished(aRequestId)
+
+  def coldCaches(self) :
+    with self.statsLock :
+      for aWorkerName in self.warm : self.warm[aWorkerName] = set()
+
+  def statistics(self, reset=False) :
+    """
+    Return (and optionally reset) the recorded task timings and counts.
+    """
+    with self.statsLock :
+      stats = { 'tasks' : dict(self.tasks), 'counts' : dict(self.counts) }
+      if reset :
+        self.tasks  = {}
+        self.counts = {}
+    return stats
+
+if __name__ == '__main__' :
+  simConfig = {}
+  someArgs  = sys.argv[1:]
+  while someArgs :
+    anArg = someArgs.pop(0)
+    if   anArg == '--port'   : simConfig['port'] = int(someArgs.pop(0))
+    elif anArg == '--config' : simConfig.update(json.loads(someArgs.pop(0)))
+    else :
+      print("usage: python -m benchmarks.simTaskManager [--port PORT] [--config JSON]")
+      sys.exit(1)
+  simTM = SimulatedTaskManager(simConfig)
+  host, port = simTM.start()
+  print(f"port {port}", flush=True)
+  try :
+    while True : time.sleep(3600)
+  except KeyboardInterrupt :
+    simTM.stop()
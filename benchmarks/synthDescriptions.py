@@ -0,0 +1,194 @@
+"""
+A generator of synthetic (but structurally realistic) `cfdoit` project trees.
+
+A synthetic tree consists of a `cfdoit.toml` configuration together with a
+`descriptions` directory of YAML task descriptions containing:
+
+- `numPackages` (cmakeCompile) packages,
+
+- `numProjects` projects, each of which links `sourcesPerProject` sources
+  into a command. Each source depends upon one of the packages, and is
+  compiled using the synthetic `benchCompile` snipet, which is a `gppCompile`
+  whose snipet dependencies are `snipetDepth` (synthetic) layers deep.
+
+The descriptions are spread over `numDescFiles` YAML files, and the tasks are
+generated for each of the `platforms`.
+
+The tree can also be written from the command line:
+
+    python -m benchmarks.synthDescriptions DIR [key=value ...]
+"""
+
+import copy
+import importlib
+import os
+import sys
+
+import yaml
+
+from cfdoit.taskSnipets.dsl import TaskSnipets
+# REQUIRED: its side-effects register the (gppCompile) snipets used below
+importlib.import_module('cfdoit.taskSnipets.ansiCSnipets')
+
+defaultParameters = {
+  'numPackages'       : 10,
+  'numProjects'       : 10,
+  'sourcesPerProject' : 10,
+  'snipetDepth'       : 2,
+  'platforms'         : [ 'linux-x86_64' ],
+  'numDescFiles'      : 10
+}
+
+def registerSyntheticSnipets(snipetDepth) :
+  """
+  (Re)register the `benchLayer1` ... `benchLayer<snipetDepth>` chain of
+  environment only snipets, and the `benchCompile` snipet which depends upon
+  the deepest layer.
+
+  Each layer adds environment variables which refer to those of the layer
+  below, so that deeper layers also exercise the environment expansion.
+  """
+  gppCompileDef = TaskSnipets.theSnipets['linux']['gppCompile']
+  gppCompile    = gppCompileDef['snipetFunc']
+
+  lowerLayer = 'srcBase'
+  lowerFlags = '-I$srcIncludes'
+  for aLayer in range(1, snipetDepth+1) :
+    layerName = f"benchLayer{aLayer}"
+
+    @TaskSnipets.addSnipet('linux', layerName, {
+      'snipetDeps'  : [ lowerLayer ],
+      'environment' : [
+        { f"layer{aLayer}Flags" : f"{lowerFlags} -DLAYER{aLayer}" },
+        { f"layer{aLayer}Dir"   : f"$srcDir/layer{aLayer}" }
+      ]
+    })
+    def benchLayer(snipetDef, theEnv, theTasks) :
+      """
+      A synthetic (environment only) snipet layer.
+      """
+      pass
+
+    lowerLayer = layerName
+    lowerFlags = f"$layer{aLayer}Flags"
+
+  benchCompileDef = copy.deepcopy(
+    { aKey : aValue for aKey, aValue in gppCompileDef.items() if aKey != 'snipetFunc' }
+  )
+  benchCompileDef['snipetDeps'] = [ lowerLayer ]
+
+  @TaskSnipets.addSnipet('linux', 'benchCompile', benchCompileDef)
+  def benchCompile(snipetDef, theEnv, theTasks) :
+    """
+    A `gppCompile` with a synthetic depth of snipet dependencies.
+    """
+    gppCompile(snipetDef, theEnv, theTasks)
+
+def syntheticDescriptions(someParameters) :
+  """
+  Return the list of the (YAML) description documents (dicts) of a synthetic
+  tree.
+  """
+  numPackages = someParameters['numPackages']
+  documents   = []
+
+  for aPkg in range(numPackages) :
+    documents.append({ 'packages' : { f"pkg{aPkg}" : {
+      'taskSnipet'  : 'cmakeCompile',
+      'environment' : {
+        'repoProvider' : 'github',
+        'repoPath'     : f"synthetic/pkg{aPkg}",
+        'repoVersion'  : '1.0.0'
+      },
+      'created' : { 'includes' : [ f"pkg{aPkg}/pkg{aPkg}.hpp" ] },
+      'tools'   : [ 'cmake', 'ninja' ]
+    }}})
+
+  for aProj in range(someParameters['numProjects']) :
+    projects = {}
+    objects  = []
+    for aSrc in range(someParameters['sourcesPerProject']) :
+      srcName = f"p{aProj}s{aSrc}"
+      aPkg    = f"pkg{(aProj + aSrc) % numPackages}" if numPackages else None
+      srcDef  = {
+        'taskSnipet'   : 'benchCompile',
+        'created'      : [ f"{srcName}.o" ],
+        'dependencies' : {
+          'srcIncludes' : [ f"p{aProj}.hpp" ]
+        }
+      }
+      if aPkg :
+        srcDef['dependencies']['packages']    = [ aPkg ]
+        srcDef['dependencies']['pkgIncludes'] = [ f"{aPkg}/{aPkg}.hpp" ]
+      projects[f"{srcName}.cpp"] = srcDef
+      objects.append(f"{srcName}.o")
+    projects[f"prog{aProj}"] = {
+      'taskSnipet'   : 'gppInstallCommand',
+      'created'      : [ f"prog{aProj}" ],
+      'dependencies' : {
+        'cObj'       : objects,
+        'systemLibs' : [ 'm' ]
+      }
+    }
+    documents.append({ 'projects' : projects })
+
+  return documents
+
+def writeSyntheticTree(aDir, someParameters={}) :
+  """
+  Write a synthetic tree (with the `someParameters` overriding the
+  `defaultParameters`) into the directory `aDir`.
+
+  Returns the (complete) parameters used.
+  """
+  parameters = dict(defaultParameters)
+  parameters.update(someParameters)
+
+  descDir = os.path.join(aDir, 'descriptions')
+  os.makedirs(descDir, exist_ok=True)
+
+  with open(os.path.join(aDir, 'cfdoit.toml'), 'w') as tomlFile :
+    platforms = ", ".join(f'"{aPlatform}"' for aPlatform in parameters['platforms'])
+    tomlFile.write(f"""[build]
+descPaths = [ "descriptions" ]
+platforms = [ {platforms} ]
+""")
+
+  # spread the documents (round robin) over the description files
+  numDescFiles = max(1, parameters['numDescFiles'])
+  descFiles    = [ [] for aFile in range(numDescFiles) ]
+  for anIndex, aDocument in enumerate(syntheticDescriptions(parameters)) :
+    descFiles[anIndex % numDescFiles].append(aDocument)
+
+  for anIndex, someDocuments in enumerate(descFiles) :
+    merged = {}
+    for aDocument in someDocuments :
+      for aKey, aValue in aDocument.items() :
+        if aKey not in merged : merged[aKey] = {}
+        merged[aKey].update(aValue)
+    descPath = os.path.join(descDir, f"desc{anIndex:04d}.yaml")
+    with open(descPath, 'w') as descFile :
+      yaml.safe_dump(merged, descFile, sort_keys=False)
+
+  return parameters
+
+def parseParameters(someArgs) :
+  """
+  Parse the `key=value` command line arguments (platforms are comma
+  separated).
+  """
+  parameters = {}
+  for anArg in someArgs :
+    aKey, aValue = anArg.split('=', 1)
+    if aKey not in defaultParameters :
+      print(f"Unknown parameter: {aKey}")
+      continue
+    if aKey == 'platforms' : parameters[aKey] = aValue.split(',')
+    else                   : parameters[aKey] = int(aValue)
+  return parameters
+
+if __name__ == '__main__' :
+  if len(sys.argv) < 2 :
+    print("usage: python -m benchmarks.synthDescriptions DIR [key=value ...]")
+    sys.exit(1)
+  print(yaml.dump(writeSyntheticTree(sys.argv[1], parseParameters(sys.argv[2:]))))
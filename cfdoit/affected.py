@@ -0,0 +1,121 @@
+"""
+The `cfdoit affected` command: which tasks does a change to some files affect?
+
+    cfdoit affected [--regenerate] [--groups] PATH ...
+
+Prints (one per line, in topological order) every task which is
+(transitively) affected by changes to the files `PATH ...`, using the
+reverse-dependency index (see `cfdoit.depIndex`) saved in the `cfdoit` state
+directory the last time the tasks were generated. A CI job can then run only
+the tasks a change touches:
+
+    cfdoit run $(git diff --name-only main | xargs cfdoit affected)
+
+If there is no index (or it is older than the configuration or the task
+descriptions, or `--regenerate` is given) the tasks are (quietly) regenerated
+first.
+
+The group tasks (`all`, `compile`, `link`, ...) are only listed if `--groups`
+is given, since running them would (re)check ALL of their grouped tasks.
+
+Reading the index only requires the standard library, so (unless the tasks
+must be regenerated) this command does not import `doit` at all.
+"""
+
+import contextlib
+import os
+import sys
+
+from cfdoit.depIndex import DependencyIndex
+
+def loadTomlConfig() :
+  """
+  Return the (shallow) merge of the global and local TOML configuration (or
+  an empty dict if no TOML parser is available).
+  """
+  try :
+    import tomllib
+  except ImportError :
+    return {}
+  from cfdoit.cli import globalConfigPath, localConfigPath
+
+  tomlConfig = {}
+  for aPath in [ globalConfigPath(), localConfigPath() ] :
+    if not os.path.exists(aPath) : continue
+    try :
+      with open(aPath, 'rb') as tomlFile :
+        someData = tomllib.load(tomlFile)
+    except Exception as err :
+      print(f"Could not read {aPath}", file=sys.stderr)
+      print(repr(err), file=sys.stderr)
+      continue
+    for aKey, aValue in someData.get('build', {}).items() :
+      tomlConfig[aKey] = aValue
+  return tomlConfig
+
+def configuredPaths(buildConfig) :
+  """
+  Return the list of the configuration and task description files which the
+  generated tasks (and so the index) depend upon (the description paths are
+  resolved in the same way as `Config.loadDescriptions` resolves them).
+  """
+  from cfdoit.cli import globalConfigPath, localConfigPath
+  from cfdoit.config import Config
+
+  somePaths = [ globalConfigPath(), localConfigPath() ]
+  for aPath in Config.descriptionPaths(buildConfig) :
+    if os.path.isdir(aPath) :
+      for aDir, someSubDirs, someFiles in os.walk(aPath) :
+        for aFile in someFiles :
+          if aFile.endswith('.yaml') :
+            somePaths.append(os.path.join(aDir, aFile))
+    else :
+      somePaths.append(aPath)
+  return [ aPath for aPath in somePaths if os.path.exists(aPath) ]
+
+def indexIsStale(indexPath, buildConfig) :
+  if not os.path.exists(indexPath) : return True
+  indexTime = os.path.getmtime(indexPath)
+  for aPath in configuredPaths(buildConfig) :
+    if indexTime < os.path.getmtime(aPath) : return True
+  return False
+
+def regenerateIndex() :
+  """
+  (Re)generate the tasks, which (re)saves the index. Any output of the
+  generation is sent to stderr so that stdout only lists the tasks.
+  """
+  from cfdoit.cli import loadCfdoitConfig
+  from cfdoit.config import Config
+  import cfdoit.dodo
+
+  with contextlib.redirect_stdout(sys.stderr) :
+    Config.updateConfig(loadCfdoitConfig())
+    Config.loadDescriptions()
+    for aTask in cfdoit.dodo.task_genTasks() : pass
+
+def affectedCommand(someArgs) :
+  """
+  Run the `cfdoit affected` command, returning its returncode.
+  """
+  regenerate = '--regenerate' in someArgs
+  withGroups = '--groups' in someArgs
+  somePaths  = [ anArg for anArg in someArgs if not anArg.startswith('--') ]
+  if not somePaths :
+    print("usage: cfdoit affected [--regenerate] [--groups] PATH ...")
+    return 1
+
+  buildConfig = loadTomlConfig()
+  indexPath   = DependencyIndex.indexPath(buildConfig.get('stateDir', '.cfdoit'))
+  if regenerate or indexIsStale(indexPath, buildConfig) : regenerateIndex()
+
+  anIndex = DependencyIndex.load(indexPath)
+  if anIndex is None :
+    print(f"No dependency index found in {indexPath}", file=sys.stderr)
+    return 1
+
+  someKnownPaths = [ anIndex.knownPath(aPath) for aPath in somePaths ]
+  for aTaskName in anIndex.affectedBy(someKnownPaths) :
+    if aTaskName in anIndex.groupTasks and not withGroups : continue
+    print(aTaskName)
+  return 0
@@ -0,0 +1,118 @@
+"""
+Coalesce work items, submitted concurrently by `doit`'s task threads, into
+batches which can be processed together.
+
+When `doit` runs tasks in parallel threads (`-n N -P thread`), each thread
+calls `BatchCoalescer.submit` and blocks. The first thread to submit an item
+for a given key becomes the batch "leader"; it waits (at most `window` seconds)
+for other threads to add items with the same key, and then runs the whole
+batch. Every submitting thread then receives its own item's result.
+
+A batch is closed (without waiting for the rest of the `window`) as soon as
+every (live) thread which has submitted items is waiting for a batch, since
+no other thread is then left to add an item. So when `doit` runs tasks
+serially, or in separate processes (`-P process`), where only one task runs
+in each process at a time, every item is run at once (in a batch of one).
+This is why `cfdoit` asks `doit` to run tasks in threads whenever remote
+batching has been enabled (see `WorkerTask.doitDefaults`), and warns if
+`doit` has been explicitly asked to use processes.
+"""
+
+import threading
+
+class Batch :
+  """
+  A collection of items (with the same key) waiting to be run together.
+  """
+
+  def __init__(self) :
+    self.items   = []
+    self.results = []
+    self.closed  = False
+    self.full    = threading.Event()
+    self.done    = threading.Event()
+
+class BatchCoalescer :
+  """
+  Coalesce concurrently submitted items into batches.
+
+  Parameters:
+
+    runBatch (callable) Called as `runBatch(key, items)` it MUST return a list
+                        of results, one for each item (in the same order).
+
+    window (float) The maximum time (in seconds) a batch leader waits for
+                   other items to arrive.
+
+    batchSizeFor (callable) Called as `batchSizeFor(key)` it returns the
+                   maximum number of items in a batch with this key.
+  """
+
+  def __init__(self, runBatch, window=0.05, batchSizeFor=None) :
+    self.runBatch     = runBatch
+    self.window       = window
+    self.batchSizeFor = batchSizeFor
+    if self.batchSizeFor is None : self.batchSizeFor = lambda aKey : 32
+    self.lock         = threading.Lock()
+    self.pending      = {}
+    self.submitters   = set()
+    self.waiting      = 0
+
+  def othersMaySubmit(self) :
+    """
+    Return True if some (live) thread which has submitted items is not
+    currently waiting for a batch. MUST be called with the lock held.
+    """
+    for aThread in list(self.submitters) :
+      if not aThread.is_alive() : self.submitters.discard(aThread)
+    return self.waiting < len(self.submitters)
+
+  def closeBatch(self, aKey, aBatch) :
+    """
+    Stop adding items to `aBatch`. MUST be called with the lock held.
+    """
+    aBatch.closed = True
+    if self.pending.get(aKey) is aBatch : del self.pending[aKey]
+    aBatch.full.set()
+
+  def submit(self, aKey, anItem) :
+    """
+    Add `anItem` to the (open) batch for `aKey`, wait for the batch to be run
+    and return this item's result.
+
+    If running the batch raised an exception, the exception is returned as this
+    item's result.
+    """
+    with self.lock :
+      self.submitters.add(threading.current_thread())
+      self.waiting += 1
+      isLeader = False
+      aBatch   = self.pending.get(aKey)
+      if aBatch is None :
+        aBatch   = Batch()
+        isLeader = True
+        self.pending[aKey] = aBatch
+      itemIndex = len(aBatch.items)
+      aBatch.items.append(anItem)
+      if self.batchSizeFor(aKey) <= len(aBatch.items) or \
+         not self.othersMaySubmit() :
+        self.closeBatch(aKey, aBatch)
+
+    try :
+      if isLeader :
+        aBatch.full.wait(self.window)
+        with self.lock :
+          if not aBatch.closed : self.closeBatch(aKey, aBatch)
+        try :
+          aBatch.results = self.runBatch(aKey, aBatch.items)
+        except Exception as err :
+          aBatch.results = [ err for anItem in aBatch.items ]
+        aBatch.done.set()
+      else :
+        aBatch.done.wait()
+    finally :
+      with self.lock :
+        self.waiting -= 1
+
+    if itemIndex < len(aBatch.results) : return aBatch.results[itemIndex]
+    return None
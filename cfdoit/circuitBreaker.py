@@ -0,0 +1,76 @@
+"""
+A (thread safe) circuit breaker guarding the connections to the TaskManager.
+
+When the TaskManager is down (or unreachable) every remote request would
+otherwise pay for its own connection failure (or time out) before falling
+back to running locally. Instead, the breaker counts consecutive failures:
+
+- `closed`:    requests are sent as usual. After `maxFailures` consecutive
+               failures the breaker opens.
+
+- `open`:      requests are NOT sent (tasks go straight to local execution)
+               until `coolDown` seconds have passed, when the breaker becomes
+               half-open.
+
+- `half-open`: a single "probe" request is allowed through. If it succeeds
+               the breaker closes, otherwise it opens again (for another
+               `coolDown`). If the probe's outcome is never recorded, another
+               probe is allowed after a further `coolDown`.
+"""
+
+import threading
+import time
+
+class CircuitBreaker :
+  """
+  A circuit breaker (see the module documentation).
+
+  Parameters:
+
+    maxFailures (int) The number of consecutive failures which open the
+                      breaker.
+
+    coolDown (float) The time (in seconds) the breaker stays open before
+                     allowing a probe request.
+  """
+
+  def __init__(self, maxFailures=3, coolDown=30.0) :
+    self.maxFailures = max(1, maxFailures)
+    self.coolDown    = coolDown
+    self.lock        = threading.Lock()
+    self.state       = 'closed'
+    self.failures    = 0
+    self.openedAt    = 0.0
+    self.probedAt    = 0.0
+
+  def allowRequest(self) :
+    """
+    Return True if a request may be sent to the TaskManager.
+    """
+    with self.lock :
+      if self.state == 'closed' : return True
+      now = time.time()
+      if self.state == 'open' :
+        if now < self.openedAt + self.coolDown : return False
+        self.state = 'half-open'
+      elif now < self.probedAt + self.coolDown :
+        return False  # (the probe is still running)
+      self.probedAt = now
+      print("Probing the taskManager")
+      return True
+
+  def recordSuccess(self) :
+    with self.lock :
+      if self.state != 'closed' : print("The taskManager has recovered")
+      self.state    = 'closed'
+      self.failures = 0
+
+  def recordFailure(self) :
+    with self.lock :
+      self.failures += 1
+      if self.state == 'half-open' or \
+         (self.state == 'closed' and self.maxFailures <= self.failures) :
+        if self.state == 'closed' :
+          print(f"The taskManager has failed {self.failures} times, running tasks locally for {self.coolDown}s")
+        self.state    = 'open'
+        self.openedAt = time.time()
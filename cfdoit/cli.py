@@ -1,54 +1,56 @@
-
 import os
 import sys
 #import yaml
 
-from doit.cmd_base import ModuleTaskLoader
-from doit.doit_cmd import DoitConfig, DoitMain
+from cfdoit.daemonClient import runViaDaemon
 
-from cfdoit.config import Config
-from cfdoit.workerTasks import WInfo
+# NOTE: `doit` (and all of the cfdoit modules which use it) are only imported
+# once we know that this command will NOT be run by a `cfdoit daemon`, so that
+# thin daemon clients start as quickly as possible.
 
-import cfdoit.dodo
+def globalConfigPath() :
+  return os.path.join(os.path.expanduser('~'), '.config', 'cfdoit', 'config.toml')
 
-def cli() :
-  """
-  The main entry point for the `cfdoit` tool.
-
-  We manipulate the original `doit` load order in order to:
-
-  1. Provide a global `Config` class containing the `doit` config
+def localConfigPath() :
+  return os.path.join('cfdoit.toml')
 
-  2. Load `doit` config from `$HOME/.config/cfdoit/config.toml` (if found) and
-     then merge any further configuration found in `./cfdoit.toml` (if found).
-
-  3. Load any task description files/directories specified in the TOML
-     `descPaths` array.
-  
-  4. Load the `doit` tasks from the `cfdoit.dodo.py` file.
+def loadCfdoitConfig() :
+  """
+  Load the `doit` config from `$HOME/.config/cfdoit/config.toml` (if found) and
+  then merge any further configuration found in `./cfdoit.toml` (if found).
 
+  Returns the merged configuration.
   """
+  from doit.doit_cmd import DoitConfig
+  from cfdoit.config import Config
 
   doitConfig   = DoitConfig()
   cfdoitConfig = {}
 
   # The user's global configuration file
-  gConfigPath = os.path.join(os.path.expanduser('~'), '.config', 'cfdoit', 'config.toml')
-  gConfig = doitConfig.load_config_toml(gConfigPath, '')
+  gConfig = doitConfig.load_config_toml(globalConfigPath(), '')
   Config.mergeData(cfdoitConfig, gConfig, '.')
 
   # The user's local configuration file
-  lConfigPath = os.path.join('cfdoit.toml')
-  lConfig = doitConfig.load_config_toml(lConfigPath, '')
+  lConfig = doitConfig.load_config_toml(localConfigPath(), '')
   Config.mergeData(cfdoitConfig, lConfig, '.')
 
-  # The cfdoit dodo file of tasks
-  taskLoader = ModuleTaskLoader(cfdoit.dodo)
+  return cfdoitConfig
+
+def newDoitMain(cfdoitConfig, taskLoader) :
+  """
+  Create a `DoitMain` (with our own additional commands) using the
+  `cfdoitConfig` configuration and the `taskLoader`.
+  """
+  from doit.doit_cmd import DoitMain
+  from cfdoit.config import Config
+  from cfdoit.workerTasks import WInfo
 
   # monkey patch the list of DOIT Commands to add our own addtions
-  oldCmds = list(DoitMain.DOIT_CMDS)
-  oldCmds.append(WInfo)
-  DoitMain.DOIT_CMDS = tuple(oldCmds)
+  if WInfo not in DoitMain.DOIT_CMDS :
+    oldCmds = list(DoitMain.DOIT_CMDS)
+    oldCmds.append(WInfo)
+    DoitMain.DOIT_CMDS = tuple(oldCmds)
 
   doitMain   = DoitMain(
     task_loader=taskLoader,
@@ -56,7 +58,84 @@ def cli() :
   )
 
   Config.mergeData(doitMain.config, cfdoitConfig, '.')
+  return doitMain
+
+def cli() :
+  """
+  The main entry point for the `cfdoit` tool.
+
+  If a `cfdoit daemon` is running (in this directory) the command is simply
+  sent to the daemon (see `cfdoit.daemon`). The `cfdoit watch` command runs an
+  incremental rebuild loop (see `cfdoit.watch`), while the `cfdoit affected`
+  command lists the tasks affected by changes to some files (see
+  `cfdoit.affected`). Otherwise, we manipulate the
+  original `doit` load order in order to:
+
+  1. Provide a global `Config` class containing the `doit` config
+
+  2. Load `doit` config from `$HOME/.config/cfdoit/config.toml` (if found) and
+     then merge any further configuration found in `./cfdoit.toml` (if found).
+
+  3. Load any task description files/directories specified in the TOML
+     `descPaths` array.
+
+  4. Start the (optional) jobserver shared by all local worker tasks.
+
+  5. Query the worker inventory (using the local worker pools if there is no
+     taskManager).
+
+  6. Cancel any in-flight remote requests if the build is interrupted (or
+     fails fast, see `cfdoit.inFlight`).
+
+  7. Load the `doit` tasks from the `cfdoit.dodo.py` file.
+
+  """
+
+  returnCode = runViaDaemon(sys.argv[1:])
+  if returnCode is not None : sys.exit(returnCode)
+
+  if sys.argv[1:2] == [ 'daemon' ] :
+    from cfdoit.daemon import daemonCommand
+    sys.exit(daemonCommand(sys.argv[2:]))
+
+  if sys.argv[1:2] == [ 'watch' ] :
+    from cfdoit.watch import watchCommand
+    sys.exit(watchCommand(sys.argv[2:]))
+
+  if sys.argv[1:2] == [ 'affected' ] :
+    from cfdoit.affected import affectedCommand
+    sys.exit(affectedCommand(sys.argv[2:]))
+
+  from doit.cmd_base import ModuleTaskLoader
+  from cfdoit.config import Config
+  from cfdoit.inFlight import InFlight
+  from cfdoit.jobServer import JobServer
+  from cfdoit.localFarm import LocalFarm
+  from cfdoit.workerTasks import WorkerTask
+  import cfdoit.dodo
+
+  cfdoitConfig = loadCfdoitConfig()
+
+  # The cfdoit dodo file of tasks
+  taskLoader = ModuleTaskLoader(cfdoit.dodo)
+
+  doitMain = newDoitMain(cfdoitConfig, taskLoader)
+
   Config.updateConfig(doitMain.config)
   Config.loadDescriptions()
 
+  # start the (optional) jobserver before doit forks any processes
+  JobServer.start()
+
+  # run the tasks concurrently in the local worker pools (if there are any)
+  if WorkerTask.availablePlatforms is None : WorkerTask.getWorkerTypes()
+  cfdoit.dodo.DOIT_CONFIG.update(LocalFarm.doitDefaults(cfdoitConfig))
+  # (remote tasks are only batched when doit runs tasks in threads)
+  cfdoit.dodo.DOIT_CONFIG.update(WorkerTask.doitDefaults(cfdoitConfig))
+  WorkerTask.checkBatching(sys.argv[1:], doitMain.config, cfdoit.dodo.DOIT_CONFIG)
+
+  # cancel any in-flight remote requests if the build is aborted
+  InFlight.beginRun(sys.argv[1:], doitMain.config)
+  InFlight.installSignalHandlers()
+
   sys.exit(doitMain.run(sys.argv[1:]))
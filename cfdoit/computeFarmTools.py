@@ -3,6 +3,18 @@ This "module" provides the (socket) methods required to access the TaskManager
 using the ComputeFarm JSON RPC protocol.
 
 This "module" is used by both the newTask and queryWorkers tools.
+
+Requests may specify (optional) deadlines (in seconds):
+
+- `connectTimeOut`: for connecting to the TaskManager,
+- `sendTimeOut`:    for sending the request,
+- `readTimeOut`:    for each read of the TaskManager's replies (i.e. the
+                    longest time the TaskManager may remain silent). A read
+                    which times out is reported (see `tcpTMReadMessages`)
+                    separately from a lost connection.
+
+Without deadlines the socket operations block (as before) until they
+succeed or fail.
 """
 
 import json
@@ -15,7 +27,7 @@ def tcpTMConnection(tmRequest) :
     tmSocket = socket.create_connection((
       tmRequest['host'],
       tmRequest['port']
-    ))
+    ), timeout=tmRequest.get('connectTimeOut', None))
     print(f"Connected to the taskManager on {tmRequest['host']}:{tmRequest['port']}")
   except ConnectionRefusedError as err :
     print(f"Could not connect to the taskManager on {tmRequest['host']}:{tmRequest['port']}")
@@ -29,7 +41,10 @@ def tcpTMConnection(tmRequest) :
 def tcpTMSentRequest(tmRequest, tmSocket) :
   # send task request
   try :
+    tmSocket.settimeout(tmRequest.get('sendTimeOut', None))
     tmSocket.sendall(json.dumps(tmRequest).encode() + b"\n")
+    # (the deadline for each of the subsequent reads)
+    tmSocket.settimeout(tmRequest.get('readTimeOut', None))
   except Exception as err :
     print("Lost connection to the taskManager while sending a request")
     print(f"Exception({err.__class__.__name__}): {str(err)}")
@@ -51,44 +66,159 @@ def tcpTMGetResult(tmSocket) :
 
 def tcpTMCloseConnection(tmSocket) :
   print("Closing the connection to the taskManager")
-  tmSocket.shutdown(socket.SHUT_RDWR)
+  try :
+    tmSocket.shutdown(socket.SHUT_RDWR)
+  except OSError :
+    pass  # the taskManager has already closed its end of the connection
   tmSocket.close()
 
-def tcpTMCollectResults(tmSocket, msgArray) :
-  
-  #returnCode = 1
-  moreToRead = True
-  while moreToRead :
-    print("Reading...")
+def tcpTMReadMessages(tmSocket, status=None) :
+  """
+  A generator which yields each (newline terminated) JSON message sent by the
+  TaskManager as a Python dict. The generator stops when the connection is
+  closed (or lost), or when a read times out (in which case `timedOut` is set
+  in the (optional) `status` dict).
+  """
+  buffer = b""
+  while True :
     data = None
-    try : 
+    try :
       data = tmSocket.recv(4096)
+    except socket.timeout :
+      print("The taskManager has been silent for too long")
+      if status is not None : status['timedOut'] = True
     except Exception as err :
       print("Lost connection to the taskManager")
       print(f"Exception({err.__class__.__name__}): {str(err)}")
-    if data :
-     aLine = data.decode().strip()
-     #print(f'Received: [{aLine}]')
-     if 'returncode' in aLine :
-       workerJson = json.loads(aLine)
-       if 'returncode' in workerJson :
-         #returnCode = workerJson['returncode']
-         moreToRead = False
-       if 'msg' in workerJson :
-        if msgArray : msgArray.append(workerJson['msg'])
-        else        : print(workerJson['msg'])
-    else : 
-      print("Data is empty!")
-      moreToRead = False
+    if not data : break
+    buffer += data
+    while b"\n" in buffer :
+      aLine, buffer = buffer.split(b"\n", 1)
+      aLine = aLine.strip()
+      if not aLine : continue
+      try :
+        yield json.loads(aLine.decode())
+      except Exception as err :
+        print(f"Could not decode the taskManager message: [{aLine}]")
+        print(f"Exception({err.__class__.__name__}): {str(err)}")
+  if buffer.strip() :
+    try :
+      yield json.loads(buffer.decode())
+    except Exception as err :
+      print(f"Could not decode the taskManager message: [{buffer}]")
+      print(f"Exception({err.__class__.__name__}): {str(err)}")
 
+def tcpTMRequestReply(tmRequest) :
+  """
+  Send `tmRequest` to the TaskManager (on a new connection) and return its
+  (first) reply, or None if the TaskManager could not be reached (or did not
+  reply).
+  """
+  tmSocket = tcpTMConnection(tmRequest)
+  if not tmSocket : return None
+  aReply = None
+  if tcpTMSentRequest(tmRequest, tmSocket) :
+    aReply = next(tcpTMReadMessages(tmSocket), None)
   tcpTMCloseConnection(tmSocket)
+  return aReply
+
+def tcpTMCollectResults(tmSocket, msgArray) :
+  """
+  Collect the `msg`s sent by the TaskManager (into `msgArray`, or print them if
+  `msgArray` is None) until the TaskManager sends a `returncode`.
+
+  Returns the `returncode` (or None if the connection was lost before a
+  `returncode` was received).
+  """
+
+  returnCode = None
+  for workerJson in tcpTMReadMessages(tmSocket) :
+    if 'msg' in workerJson :
+      if msgArray is not None : msgArray.append(workerJson['msg'])
+      else                    : print(workerJson['msg'])
+    if 'returncode' in workerJson :
+      returnCode = workerJson['returncode']
+      break
+
+  tcpTMCloseConnection(tmSocket)
+  return returnCode
+
+def tcpTMCollectTaskResult(tmSocket, aResult) :
+  """
+  Collect the `msg`s sent by the TaskManager for one task (into the `msgs`
+  list of the `aResult` dict, as they arrive) until the TaskManager sends a
+  `returncode`. The `worker` running the task is also recorded (as soon as the
+  TaskManager reports it), as are any (staged) `target` messages (in the
+  `targets` list).
+
+  Returns the `returncode` (also saved in `aResult`, None if the connection
+  was lost, or went idle (`timedOut` is then set in `aResult`), before a
+  `returncode` was received).
+  """
+
+  if 'msgs'    not in aResult : aResult['msgs']    = []
+  if 'targets' not in aResult : aResult['targets'] = []
+  returnCode = None
+  for workerJson in tcpTMReadMessages(tmSocket, aResult) :
+    if 'worker' in workerJson : aResult['worker'] = workerJson['worker']
+    if 'msg'    in workerJson : aResult['msgs'].append(workerJson['msg'])
+    if 'target' in workerJson : aResult['targets'].append(workerJson)
+    if 'returncode' in workerJson :
+      returnCode = workerJson['returncode']
+      break
+
+  aResult['returncode'] = returnCode
+  tcpTMCloseConnection(tmSocket)
+  return returnCode
+
+def tcpTMCollectBatchResults(tmSocket, taskNames, status=None) :
+  """
+  Collect the `msg`s and `returncode`s, for each of the tasks in a batch, sent
+  by the TaskManager. Each message sent by the TaskManager MUST contain the
+  `taskName` of the task in the batch to which it refers.
+
+  Returns a dict mapping each task name to a dict containing the task's
+  `returncode` (None if the task never completed), `msgs` (list), (staged)
+  `targets` (list of `target` messages), and `duration` and `worker` (if
+  reported by the TaskManager). If the connection went idle, `timedOut` is
+  set in the (optional) `status` dict.
+  """
+
+  results = {}
+  for aTaskName in taskNames :
+    results[aTaskName] = { 'returncode' : None, 'msgs' : [], 'targets' : [] }
+  toComplete = len(results)
+
+  for workerJson in tcpTMReadMessages(tmSocket, status) :
+    aTaskName = workerJson.get('taskName', None)
+    if aTaskName not in results : continue
+    aResult = results[aTaskName]
+    if 'msg' in workerJson : aResult['msgs'].append(workerJson['msg'])
+    if 'target' in workerJson : aResult['targets'].append(workerJson)
+    if 'duration' in workerJson : aResult['duration'] = workerJson['duration']
+    if 'worker'   in workerJson : aResult['worker']   = workerJson['worker']
+    if 'returncode' in workerJson and aResult['returncode'] is None :
+      aResult['returncode'] = workerJson['returncode']
+      toComplete -= 1
+      if toComplete < 1 : break
+
+  tcpTMCloseConnection(tmSocket)
+  return results
 
 def compileActionScript(someAliases, someEnvs, someActions) :
   """
   Create a (unix) shell script which can run the actions specified by the
   `someActions` (list of lists or strings) parameter using (unix shell)
-  environment variables specified in the `someEnvs` (list of dicts) parameter as
-  well as the aliases specified in the `someAliases` (dict) parameter.
+  environment variables specified in the `someEnvs` (a dict, or a list of
+  dicts) parameter as well as the aliases specified in the `someAliases`
+  (dict) parameter.
+
+  Each variable is exported (in order) as `export KEY="VALUE"`, so the shell
+  still expands any (runtime) `$NAME` references in the values. A (single)
+  dict is the (minimal) environment of a WorkerTask (see
+  `cfdoit.envHelpers.minimalEnvironment`), which is exported so that the
+  tools the actions run can read the variables listed in a snipet's
+  `exportEnvironment` (such as `CFLAGS` for CMake).
   """
 
   # consider using os.path.expanduser and our own normalizePath
@@ -102,6 +232,7 @@ def compileActionScript(someAliases, someEnvs, someActions) :
       actionScript.append(f"alias {aKey}=\"{aValue}\"")
 
   actionScript.append("# export the environment...")
+  if isinstance(someEnvs, dict) : someEnvs = [ someEnvs ]
   if isinstance(someEnvs, list) :
     for anEnv in someEnvs :
       if isinstance(anEnv, dict) :
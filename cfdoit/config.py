@@ -85,8 +85,56 @@ class Config :
     if 'host' not in tmConfig : tmConfig['host'] = '127.0.0.1'
     if 'port' not in tmConfig : tmConfig['port'] = 8888
 
+    # batching of (small) batchable remote tasks
+    if 'batch'              not in tmConfig : tmConfig['batch']              = False
+    if 'batchWindow'        not in tmConfig : tmConfig['batchWindow']        = 0.05
+    if 'batchTargetSeconds' not in tmConfig : tmConfig['batchTargetSeconds'] = 30.0
+    if 'maxBatchSize'       not in tmConfig : tmConfig['maxBatchSize']       = 32
+    if 'batchRetryRatio'    not in tmConfig : tmConfig['batchRetryRatio']    = 0.1
+
+    # (adaptive) remote task time outs
+    if 'timeOut'       not in tmConfig : tmConfig['timeOut']       = 100
+    if 'minTimeOut'    not in tmConfig : tmConfig['minTimeOut']    = 30
+    if 'maxTimeOut'    not in tmConfig : tmConfig['maxTimeOut']    = 3600
+    if 'timeOutFactor' not in tmConfig : tmConfig['timeOutFactor'] = 4.0
+
+    # speculative re-execution of straggling remote tasks
+    if 'speculate'           not in tmConfig : tmConfig['speculate']           = False
+    if 'speculatePercentile' not in tmConfig : tmConfig['speculatePercentile'] = 95
+    if 'speculateFactor'     not in tmConfig : tmConfig['speculateFactor']     = 1.5
+    if 'speculateMinSeconds' not in tmConfig : tmConfig['speculateMinSeconds'] = 5.0
+
+    # the cancellation of in-flight remote requests (see cfdoit.inFlight)
+    if 'cancelAckSeconds' not in tmConfig : tmConfig['cancelAckSeconds'] = 2.0
+
+    # connection deadlines (in seconds) and the circuit breaker which routes
+    # tasks straight to local execution while the taskManager is down (see
+    # cfdoit.circuitBreaker)
+    if 'connectTimeOut'  not in tmConfig : tmConfig['connectTimeOut']  = 5.0
+    if 'sendTimeOut'     not in tmConfig : tmConfig['sendTimeOut']     = 30.0
+    if 'queryTimeOut'    not in tmConfig : tmConfig['queryTimeOut']    = 10.0
+    # (the longest a remote request may be silent, 0 for no idle deadline)
+    if 'idleTimeOut'     not in tmConfig : tmConfig['idleTimeOut']     = 0
+    if 'breakerFailures' not in tmConfig : tmConfig['breakerFailures'] = 3
+    if 'breakerCoolDown' not in tmConfig : tmConfig['breakerCoolDown'] = 30.0
+
+    # (soft) worker affinity hints, so that incremental rebuilds are placed on
+    # the workers with warm caches and build directories
+    if 'affinity'            not in tmConfig : tmConfig['affinity']            = True
+    if 'affinityWaitSeconds' not in tmConfig : tmConfig['affinityWaitSeconds'] = 2.0
+
+    # the staging of remote tasks' inputs and targets (see cfdoit.staging)
+    if 'staging'            not in tmConfig : tmConfig['staging']            = False
+    if 'stagingBlockSize'   not in tmConfig : tmConfig['stagingBlockSize']   = 65536
+    if 'stagingMaxPutBytes' not in tmConfig : tmConfig['stagingMaxPutBytes'] = 8*1024*1024
+
     if 'dir'       not in bConfig : bConfig['dir']       = 'build'
     if 'platforms' not in bConfig : bConfig['platforms'] = []
+    if 'stateDir'  not in bConfig : bConfig['stateDir']  = '.cfdoit'
+    if 'link'      not in bConfig : bConfig['link']      = {}
+    if 'cmake'     not in bConfig : bConfig['cmake']     = {}
+    if 'localFarm' not in bConfig : bConfig['localFarm'] = {}
+    if 'scratch'   not in bConfig : bConfig['scratch']   = {}
 
   def printConfig() :
     """
@@ -162,16 +210,20 @@ class Config :
     loadDescriptionsFromModule('cfdoit.taskDescriptions', descriptions)
 
     descPaths = [ ]
-    buildDir  = '.'
     if 'build' in Config.config['GLOBAL'] :
-      bConfig = Config.config['GLOBAL']['build']
-      if 'descPaths' in bConfig : descPaths = bConfig['descPaths']
-      if 'projDescPath' in bConfig : descPaths.insert(0, bConfig['projDescPath'])
-      if 'buildDir'  in bConfig : buildDir  = bConfig['buildDir']
+      descPaths = Config.descriptionPaths(Config.config['GLOBAL']['build'])
     for aDescPath in descPaths :
-      if '$buildDir' in aDescPath :
-        aDescPath = aDescPath.replace('$buildDir', buildDir)
-        print(aDescPath)
       recursivelyLoadDescriptions(aDescPath, descriptions)
 
     Config.descriptions = descriptions
+
+  def descriptionPaths(bConfig) :
+    """
+    Return the task description paths of the `build` configuration `bConfig`:
+    the `projDescPath` followed by the `descPaths`, with any `$buildDir`
+    replaced by the `buildDir`.
+    """
+    descPaths = list(bConfig.get('descPaths', []))
+    if 'projDescPath' in bConfig : descPaths.insert(0, bConfig['projDescPath'])
+    buildDir  = bConfig.get('buildDir', '.')
+    return [ aDescPath.replace('$buildDir', buildDir) for aDescPath in descPaths ]
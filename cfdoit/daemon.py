@@ -0,0 +1,544 @@
+"""
+A long-lived `cfdoit daemon` which keeps its (warm) state resident between
+`cfdoit` commands.
+
+Every (non-daemon) `cfdoit` command pays the Python start up, the `doit`
+import, the TOML config parsing, the YAML description loading, the
+TaskManager worker query and the full task generation before it does any
+work. The daemon does all of this once, and then serves the `cfdoit` commands
+of thin clients (see `cfdoit.daemonClient`) over a Unix domain socket
+(`.cfdoit/daemon.sock` by default), streaming each command's output back to
+its client.
+
+The daemon keeps resident:
+
+- the `Config` (and task descriptions), which are reloaded whenever any of
+  the TOML config files, or any of the YAML description files (or
+  directories), change,
+
+- the generated tasks, which are regenerated whenever the worker inventory
+  or the configuration changes (if only a task description changes, only the
+  tasks of that description's root tasks are regenerated),
+
+- the worker inventory, which is re-queried from the TaskManager once it is
+  older than the `workerTTL` (seconds) key of the `daemon` configuration
+  (default: 300),
+
+- the jobserver, task history and any other process wide state.
+
+- the fingerprint (sizes and modification times) of the sources (the
+  `file_dep`s which are not the targets of other tasks) of the generated
+  tasks. Since task generation may also depend upon the project's sources
+  (for example scanned LaTeX dependencies or unity build weights), the root
+  tasks which generated tasks depending upon any changed source are
+  regenerated (as `cfdoit watch` does).
+
+Use `cfdoit daemon reload` to force all of the tasks to be regenerated.
+
+Commands:
+
+    cfdoit daemon [start]   start the daemon (in the foreground)
+    cfdoit daemon stop      stop the daemon
+    cfdoit daemon reload    reload the config and regenerate the tasks
+    cfdoit daemon status    report the daemon's state
+
+Commands are run one at a time (in the daemon's working directory). If a
+client disconnects (for example, when the user presses Ctrl-C) before its
+command has finished, the command's build is aborted and its in-flight remote
+requests are cancelled (see `InFlight`). Setting
+the `CFDOIT_NO_DAEMON` environment variable runs a command without the daemon.
+"""
+
+import io
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from doit import cmd_run
+from doit.cmd_base import ModuleTaskLoader
+
+from cfdoit.cli import globalConfigPath, localConfigPath, loadCfdoitConfig, newDoitMain
+from cfdoit.config import Config
+from cfdoit.daemonClient import daemonSocketPath, sendToDaemon
+from cfdoit.inFlight import InFlight
+from cfdoit.jobServer import JobServer
+from cfdoit.localFarm import LocalFarm
+from cfdoit.taskHistory import TaskHistory
+from cfdoit.workerTasks import WorkerTask
+
+import cfdoit.dodo
+from cfdoit.taskGenerator import (
+  clearRootTaskCache, invalidateRootTasksFor, task_genTasks
+)
+
+class DaemonOutput(io.TextIOBase) :
+  """
+  A (text) output stream which sends everything written to it to a daemon
+  client as `msg` messages.
+  """
+
+  def __init__(self, clientSocket) :
+    self.clientSocket = clientSocket
+    self.lock         = threading.Lock()
+
+  def writable(self) :
+    return True
+
+  def isatty(self) :
+    return False
+
+  def write(self, someText) :
+    if not someText : return 0
+    sendMessage(self.clientSocket, { 'msg' : someText }, self.lock)
+    return len(someText)
+
+class RequestOutput(io.TextIOBase) :
+  """
+  A (text) output stream, installed (once) as the daemon's `sys.stdout` and
+  `sys.stderr`, which sends the output of the threads running a client's
+  request to that client's `DaemonOutput`, and all other output to the
+  daemon's own stream.
+
+  The (one) running request is owned by the thread which handles it. Since
+  the threads which `doit` (and the WorkerTasks) start while the request runs
+  can not be traced back to it, every thread which is not one of the daemon's
+  own (registered, see `daemonThread`) threads is also assumed to belong to
+  the running request.
+
+  Class variables:
+    output:        The running request's output (or None).
+    owner:         The thread handling the running request (or None).
+    daemonThreads: The daemon's own (serving and client handling) threads.
+  """
+
+  output        = None
+  owner         = None
+  daemonThreads = set()
+  lock          = threading.Lock()
+
+  def __init__(self, aStream) :
+    self.stream = aStream
+
+  def install() :
+    """
+    Route the daemon's `sys.stdout` and `sys.stderr` (see `RequestOutput`).
+    """
+    if isinstance(sys.stdout, RequestOutput) : return
+    sys.stdout = RequestOutput(sys.stdout)
+    sys.stderr = RequestOutput(sys.stderr)
+    RequestOutput.daemonThread()
+
+  def daemonThread() :
+    """
+    Register the current thread as one of the daemon's own threads.
+    """
+    with RequestOutput.lock :
+      for aThread in list(RequestOutput.daemonThreads) :
+        if not aThread.is_alive() : RequestOutput.daemonThreads.discard(aThread)
+      RequestOutput.daemonThreads.add(threading.current_thread())
+
+  def begin(anOutput) :
+    """
+    Send the output of the request handled by the current thread to
+    `anOutput` (until `end` is called).
+    """
+    with RequestOutput.lock :
+      RequestOutput.output = anOutput
+      RequestOutput.owner  = threading.current_thread()
+
+  def end() :
+    with RequestOutput.lock :
+      RequestOutput.output = None
+      RequestOutput.owner  = None
+
+  def currentStream(self) :
+    anOutput = RequestOutput.output
+    if anOutput is None : return self.stream
+    aThread = threading.current_thread()
+    if aThread is RequestOutput.owner : return anOutput
+    if aThread in RequestOutput.daemonThreads : return self.stream
+    return anOutput
+
+  def writable(self) :
+    return True
+
+  def isatty(self) :
+    return False
+
+  def write(self, someText) :
+    return self.currentStream().write(someText)
+
+  def flush(self) :
+    self.currentStream().flush()
+
+def sendMessage(clientSocket, aMessage, aLock=None) :
+  """
+  Send one (newline terminated) JSON message to a daemon client (ignoring
+  clients which have gone away).
+  """
+  try :
+    if aLock is None :
+      clientSocket.sendall(json.dumps(aMessage).encode() + b"\n")
+    else :
+      with aLock :
+        clientSocket.sendall(json.dumps(aMessage).encode() + b"\n")
+  except OSError :
+    pass
+
+def copyTaskDict(aTaskDict) :
+  """
+  Return a copy of a (cached) generated task dict which `doit` can safely
+  modify (`doit` adds task names and extends the task dependencies).
+  """
+  newTaskDict = {}
+  for aKey, aValue in aTaskDict.items() :
+    if isinstance(aValue, list) : aValue = list(aValue)
+    newTaskDict[aKey] = aValue
+  return newTaskDict
+
+class CfdoitDaemon :
+  """
+  The (warm) state of the daemon.
+
+  Class variables:
+    cfdoitConfig:   The merged TOML configuration.
+    configStamp:    The fingerprint of the config and description files.
+    tasks:          The (cached) generated task dicts (or None).
+    sourceStamp:    The fingerprint of the generated tasks' sources.
+    workerStamp:    The fingerprint of the worker inventory.
+    workersQueried: The time the worker inventory was last queried.
+  """
+
+  cfdoitConfig   = None
+  configStamp    = None
+  tasks          = None
+  sourceStamp    = {}
+  workerStamp    = None
+  workersQueried = 0
+  startedAt      = 0
+  numRequests    = 0
+  running        = True
+  runLock        = threading.Lock()
+
+  def daemonConfig() :
+    if 'GLOBAL' not in Config.config : return {}
+    return Config.config['GLOBAL'].get('daemon', {})
+
+  def descriptionPaths() :
+    if 'GLOBAL' in Config.config and 'build' in Config.config['GLOBAL'] :
+      return Config.descriptionPaths(Config.config['GLOBAL']['build'])
+    return []
+
+  def computeConfigStamp() :
+    """
+    Return a fingerprint (the paths, sizes and modification times) of all of
+    the config and description files (and directories).
+    """
+    stamp = []
+    def stampPath(aPath) :
+      try :
+        aStat = os.stat(aPath)
+      except OSError :
+        stamp.append((aPath, None))
+        return
+      stamp.append((aPath, aStat.st_size, aStat.st_mtime_ns))
+      if os.path.isdir(aPath) :
+        for aDirEnt in sorted(os.scandir(aPath), key=lambda anEnt : anEnt.name) :
+          if aDirEnt.is_dir() or aDirEnt.name.endswith('.yaml') :
+            stampPath(os.path.join(aPath, aDirEnt.name))
+
+    for aPath in [ globalConfigPath(), localConfigPath() ] : stampPath(aPath)
+    for aPath in CfdoitDaemon.descriptionPaths() : stampPath(aPath)
+    return stamp
+
+  def computeSourceStamp() :
+    """
+    Return a fingerprint (a dict mapping each path to its size and
+    modification time) of the sources of the (cached) generated tasks.
+    """
+    if not CfdoitDaemon.tasks : return {}
+    targets = set()
+    for aTask in CfdoitDaemon.tasks :
+      targets.update(os.path.normpath(aTarget) for aTarget in aTask.get('targets', []))
+    stamp = {}
+    for aTask in CfdoitDaemon.tasks :
+      for aDep in aTask.get('file_dep', []) :
+        aPath = os.path.normpath(aDep)
+        if aPath in targets or aPath in stamp : continue
+        try :
+          aStat = os.stat(aPath)
+          stamp[aPath] = (aStat.st_size, aStat.st_mtime_ns)
+        except OSError :
+          stamp[aPath] = None
+    return stamp
+
+  def changedSources() :
+    """
+    Return the sources (of the cached tasks) which have changed since the
+    tasks were generated.
+    """
+    oldStamp = CfdoitDaemon.sourceStamp
+    newStamp = CfdoitDaemon.computeSourceStamp()
+    return [
+      aPath for aPath in set(oldStamp) | set(newStamp)
+      if oldStamp.get(aPath, None) != newStamp.get(aPath, None)
+    ]
+
+  def loadConfig() :
+    """
+    (Re)load the TOML configuration and the YAML task descriptions.
+    """
+    print("Loading the cfdoit configuration and task descriptions")
+    Config.config       = {}
+    Config.descriptions = {}
+    oldConfig = CfdoitDaemon.cfdoitConfig
+    CfdoitDaemon.cfdoitConfig = loadCfdoitConfig()
+    # only the root tasks whose descriptions have changed are regenerated,
+    # unless the configuration itself has changed
+    if CfdoitDaemon.cfdoitConfig != oldConfig : clearRootTaskCache()
+    doitMain = newDoitMain(CfdoitDaemon.cfdoitConfig, None)
+    Config.updateConfig(doitMain.config)
+    Config.loadDescriptions()
+    CfdoitDaemon.configStamp = CfdoitDaemon.computeConfigStamp()
+    CfdoitDaemon.tasks       = None
+    # (the circuit breaker's thresholds might have changed)
+    WorkerTask.tmBreaker     = None
+    JobServer.start()
+
+  def queryWorkers() :
+    """
+    (Re)query the worker inventory, invalidating the generated tasks if the
+    inventory has changed.
+    """
+    WorkerTask.availablePlatforms = None
+    WorkerTask.getWorkerTypes()
+    CfdoitDaemon.workersQueried = time.time()
+    workerStamp = json.dumps([
+      WorkerTask.availablePlatforms,
+      WorkerTask.availableTools,
+      WorkerTask.availableWorkers,
+      WorkerTask.baseDirectory
+    ], sort_keys=True, default=str)
+    if workerStamp != CfdoitDaemon.workerStamp :
+      CfdoitDaemon.workerStamp = workerStamp
+      CfdoitDaemon.tasks       = None
+      clearRootTaskCache()
+
+  def refresh(forceReload=False) :
+    """
+    Reload any (warm) state which is out of date.
+    """
+    if forceReload : clearRootTaskCache()
+    if forceReload or CfdoitDaemon.cfdoitConfig is None or \
+      CfdoitDaemon.computeConfigStamp() != CfdoitDaemon.configStamp :
+      CfdoitDaemon.loadConfig()
+    workerTTL = CfdoitDaemon.daemonConfig().get('workerTTL', 300)
+    if forceReload or workerTTL < time.time() - CfdoitDaemon.workersQueried :
+      CfdoitDaemon.queryWorkers()
+    if CfdoitDaemon.tasks is not None :
+      changed = CfdoitDaemon.changedSources()
+      if changed :
+        # (only the root tasks depending upon the changed sources are
+        # regenerated)
+        invalidateRootTasksFor(changed)
+        CfdoitDaemon.tasks = None
+    if CfdoitDaemon.tasks is None :
+      print("Generating the cfdoit tasks")
+      CfdoitDaemon.tasks       = list(task_genTasks())
+      CfdoitDaemon.sourceStamp = CfdoitDaemon.computeSourceStamp()
+
+  def cachedTaskLoader() :
+    """
+    Return a `doit` task loader which loads (copies of) the cached tasks.
+    """
+    def task_genTasks() :
+      for aTaskDict in CfdoitDaemon.tasks :
+        yield copyTaskDict(aTaskDict)
+    task_genTasks.__doc__ = cfdoit.dodo.task_genTasks.__doc__
+
+    return ModuleTaskLoader({
+      'task_genTasks' : task_genTasks,
+      'DOIT_CONFIG'   : CfdoitDaemon.doitDefaults()
+    })
+
+  def doitDefaults() :
+    someDefaults = LocalFarm.doitDefaults(CfdoitDaemon.cfdoitConfig)
+    someDefaults.update(WorkerTask.doitDefaults(CfdoitDaemon.cfdoitConfig))
+    return someDefaults
+
+  def runDoit(someArgs, anOutput, disconnected=None) :
+    """
+    Run one `doit` command (with all output sent to `anOutput`), returning its
+    returncode.
+
+    If the (optional) `disconnected` event is set (the client has gone
+    away) the build is aborted (see `InFlight`).
+    """
+    with CfdoitDaemon.runLock :
+      # (only the output of this request's threads is sent to `anOutput`,
+      # see `RequestOutput`)
+      RequestOutput.begin(anOutput)
+      # the default `run` reporter output stream is bound (to the original
+      # sys.stdout) when `doit` is imported
+      origOutfile = cmd_run.opt_outfile['default']
+      cmd_run.opt_outfile['default'] = anOutput
+      try :
+        CfdoitDaemon.refresh()
+        doitMain = newDoitMain(
+          CfdoitDaemon.cfdoitConfig, CfdoitDaemon.cachedTaskLoader()
+        )
+        InFlight.beginRun(someArgs, doitMain.config)
+        WorkerTask.checkBatching(
+          someArgs, doitMain.config, CfdoitDaemon.doitDefaults()
+        )
+        # (the client may have gone away while this command was waiting)
+        if disconnected is not None and disconnected.is_set() :
+          InFlight.abort("the cfdoit client disconnected")
+        returnCode = doitMain.run(someArgs)
+        # (some doit commands return None, which sys.exit treats as 0)
+        if returnCode is None : returnCode = 0
+      except Exception :
+        traceback.print_exc(file=anOutput)
+        returnCode = 3
+      finally :
+        cmd_run.opt_outfile['default'] = origOutfile
+        RequestOutput.end()
+        TaskHistory.save()
+        CfdoitDaemon.numRequests += 1
+    return returnCode
+
+  def status() :
+    return "\n".join([
+      f"cfdoit daemon (pid {os.getpid()}) serving {os.getcwd()}",
+      f"  up for {int(time.time() - CfdoitDaemon.startedAt)} seconds",
+      f"  requests served: {CfdoitDaemon.numRequests}",
+      f"  cached tasks: {len(CfdoitDaemon.tasks or [])}",
+      f"  worker inventory age: {int(time.time() - CfdoitDaemon.workersQueried)} seconds",
+      ""
+    ])
+
+  def watchClient(clientSocket, finished, disconnected) :
+    """
+    Abort the build (cancelling its in-flight remote requests) if the client
+    disconnects (for example, the user pressed Ctrl-C) before its command has
+    `finished`.
+    """
+    RequestOutput.daemonThread()
+    try :
+      while not finished.is_set() :
+        if not clientSocket.recv(4096) : break
+    except OSError :
+      pass
+    if finished.is_set() : return
+    disconnected.set()
+    InFlight.abort("the cfdoit client disconnected")
+
+  def handleClient(clientSocket) :
+    """
+    Handle one client's request.
+    """
+    RequestOutput.daemonThread()
+    try :
+      aRequest = None
+      buffer   = b""
+      while b"\n" not in buffer :
+        data = clientSocket.recv(65536)
+        if not data : return
+        buffer += data
+      aRequest = json.loads(buffer.split(b"\n", 1)[0].decode())
+      aCommand = aRequest.get('command', '')
+
+      if aCommand == 'doit' :
+        if os.path.realpath(aRequest.get('cwd', '')) != os.path.realpath(os.getcwd()) :
+          sendMessage(clientSocket, { 'fallback' : True })
+          return
+        finished     = threading.Event()
+        disconnected = threading.Event()
+        threading.Thread(
+          target=CfdoitDaemon.watchClient,
+          args=(clientSocket, finished, disconnected), daemon=True
+        ).start()
+        try :
+          returnCode = CfdoitDaemon.runDoit(
+            aRequest.get('args', []), DaemonOutput(clientSocket), disconnected
+          )
+        finally :
+          finished.set()
+        sendMessage(clientSocket, { 'returncode' : returnCode })
+      elif aCommand == 'reload' :
+        with CfdoitDaemon.runLock :
+          RequestOutput.begin(DaemonOutput(clientSocket))
+          try :
+            CfdoitDaemon.refresh(forceReload=True)
+          finally :
+            RequestOutput.end()
+        sendMessage(clientSocket, { 'returncode' : 0 })
+      elif aCommand == 'status' :
+        sendMessage(clientSocket, { 'msg' : CfdoitDaemon.status() })
+        sendMessage(clientSocket, { 'returncode' : 0 })
+      elif aCommand == 'stop' :
+        CfdoitDaemon.running = False
+        sendMessage(clientSocket, { 'msg' : "Stopping the cfdoit daemon\n" })
+        sendMessage(clientSocket, { 'returncode' : 0 })
+        # wake up the (blocked) accept
+        sendToDaemon({ 'command' : 'ping' })
+      else :
+        sendMessage(clientSocket, { 'returncode' : 0 })
+    except Exception as err :
+      print(f"Could not handle a cfdoit daemon request: {repr(err)}")
+    finally :
+      clientSocket.close()
+
+  def serve() :
+    """
+    Serve `cfdoit` commands (until stopped).
+    """
+    socketPath = daemonSocketPath()
+    if sendToDaemon({ 'command' : 'ping' }) is not None :
+      print(f"A cfdoit daemon is already running on {socketPath}")
+      return 1
+    if os.path.exists(socketPath) : os.unlink(socketPath)
+    os.makedirs(os.path.dirname(socketPath) or '.', exist_ok=True)
+
+    CfdoitDaemon.startedAt = time.time()
+    RequestOutput.install()
+    CfdoitDaemon.refresh()
+
+    serverSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    serverSocket.bind(socketPath)
+    serverSocket.listen()
+    print(f"The cfdoit daemon is serving {os.getcwd()} on {socketPath}")
+    try :
+      while CfdoitDaemon.running :
+        clientSocket, clientAddr = serverSocket.accept()
+        threading.Thread(
+          target=CfdoitDaemon.handleClient, args=(clientSocket,), daemon=True
+        ).start()
+    except KeyboardInterrupt :
+      pass
+    finally :
+      serverSocket.close()
+      if os.path.exists(socketPath) : os.unlink(socketPath)
+      TaskHistory.save()
+    print("The cfdoit daemon has stopped")
+    return 0
+
+def daemonCommand(someArgs) :
+  """
+  Run a `cfdoit daemon` command, returning its returncode.
+  """
+  aCommand = someArgs[0] if someArgs else 'start'
+  if aCommand == 'start' : return CfdoitDaemon.serve()
+  if aCommand in [ 'stop', 'reload', 'status' ] :
+    returnCode = sendToDaemon({ 'command' : aCommand })
+    if returnCode is None :
+      print("No cfdoit daemon is running")
+      return 1
+    return returnCode
+  print(f"Unknown cfdoit daemon command: {aCommand}")
+  print("usage: cfdoit daemon [start|stop|reload|status]")
+  return 1
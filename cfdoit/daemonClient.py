@@ -0,0 +1,118 @@
+"""
+The (thin) client side of the `cfdoit daemon` protocol.
+
+This module is imported by EVERY `cfdoit` command before anything else, so it
+MUST only import (fast) standard library modules. In particular it MUST NOT
+import `doit`, `yaml` or any of the task snipets.
+
+A client sends one (newline terminated) JSON request to the daemon's Unix
+domain socket:
+
+    { 'command' : 'doit', 'args' : [ ... ], 'cwd' : '/the/project/dir' }
+
+(or a `stop`, `reload` or `status` command) and then receives (newline
+terminated) JSON messages, in the style of the TaskManager protocol, until it
+receives a `returncode`:
+
+    { 'msg' : 'some output' }
+    { 'returncode' : 0 }
+
+If the daemon can not run the request it replies with `{ 'fallback' : True }`
+and the client runs the command itself.
+"""
+
+import json
+import os
+import socket
+import sys
+
+# The cfdoit commands which are never run by the daemon
+localCommands = [ 'daemon', 'watch', 'affected' ]
+
+def daemonSocketPath() :
+  """
+  Return the path to the daemon's Unix domain socket (which may be overridden
+  by the `CFDOIT_DAEMON_SOCKET` environment variable).
+  """
+  return os.environ.get(
+    'CFDOIT_DAEMON_SOCKET', os.path.join('.cfdoit', 'daemon.sock')
+  )
+
+def connectToDaemon() :
+  """
+  Return a socket connected to the daemon (or None if no daemon is running).
+  """
+  socketPath = daemonSocketPath()
+  if not os.path.exists(socketPath) : return None
+  daemonSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try :
+    daemonSocket.connect(socketPath)
+  except OSError :
+    daemonSocket.close()
+    return None
+  return daemonSocket
+
+def readDaemonMessages(daemonSocket) :
+  """
+  A generator which yields each (newline terminated) JSON message sent by the
+  daemon as a Python dict.
+  """
+  buffer = b""
+  while True :
+    try :
+      data = daemonSocket.recv(65536)
+    except OSError :
+      data = None
+    if not data : break
+    buffer += data
+    while b"\n" in buffer :
+      aLine, buffer = buffer.split(b"\n", 1)
+      if aLine.strip() : yield json.loads(aLine.decode())
+
+def sendToDaemon(aRequest) :
+  """
+  Send `aRequest` to the daemon, printing any output it sends back.
+
+  Returns the daemon's returncode, or None if there is no daemon (or the
+  daemon asked us to fall back to running the command ourselves).
+  """
+  daemonSocket = connectToDaemon()
+  if daemonSocket is None : return None
+  # if the connection is lost the command has (partially) run, so it MUST NOT
+  # be rerun locally
+  returnCode = 1
+  try :
+    daemonSocket.sendall(json.dumps(aRequest).encode() + b"\n")
+    for aMessage in readDaemonMessages(daemonSocket) :
+      if 'fallback' in aMessage :
+        returnCode = None
+        break
+      if 'msg' in aMessage :
+        sys.stdout.write(aMessage['msg'])
+        sys.stdout.flush()
+      if 'returncode' in aMessage :
+        returnCode = aMessage['returncode']
+        break
+  except BrokenPipeError :
+    pass  # our own output has been closed
+  except OSError as err :
+    print("Lost connection to the cfdoit daemon")
+    print(repr(err))
+  finally :
+    daemonSocket.close()
+  return returnCode
+
+def runViaDaemon(someArgs) :
+  """
+  Run the `cfdoit` (doit) command `someArgs` in a running daemon.
+
+  Returns the command's returncode, or None if the command should be run
+  locally.
+  """
+  if os.environ.get('CFDOIT_NO_DAEMON', '') : return None
+  if someArgs and someArgs[0] in localCommands : return None
+  return sendToDaemon({
+    'command' : 'doit',
+    'args'    : someArgs,
+    'cwd'     : os.getcwd()
+  })
@@ -0,0 +1,219 @@
+"""
+A reverse-dependency index of the generated `doit` tasks.
+
+The index maps each file to the tasks which depend upon it (through their
+`file_dep`s) and each task to the tasks which depend upon it (through their
+`task_dep`s, or through a `file_dep` on one of its `targets`). It can then
+quickly answer "which tasks does a change to these files affect?" without
+running `doit`'s full status check over every task.
+
+The index is built (and saved as `depIndex.json` in the `cfdoit` state
+directory) each time the tasks are generated, so that it can be queried (see
+`cfdoit.affected`) without regenerating the tasks.
+
+NOTE: this module MUST only import standard library modules.
+"""
+
+import json
+import os
+
+def normalizePath(aPath) :
+  return os.path.normpath(aPath)
+
+class DependencyIndex :
+  """
+  The reverse-dependency index of a list of generated (`doit`) task dicts.
+
+  Instance variables:
+    fileTasks:      A dict mapping each (normalized) file path to the list of
+                    tasks which have it as a `file_dep`.
+    targetTasks:    A dict mapping each (normalized) target path to the task
+                    which creates it.
+    taskDeps:       A dict mapping each task to the list of tasks it depends
+                    upon.
+    taskDependents: A dict mapping each task to the list of tasks which depend
+                    upon it.
+    groupTasks:     The list of tasks without any actions (which only group
+                    other tasks).
+  """
+
+  def __init__(self, someTaskDicts=[]) :
+    self.fileTasks      = {}
+    self.targetTasks    = {}
+    self.taskDeps       = {}
+    self.taskDependents = {}
+    self.groupTasks     = []
+
+    for aTaskDict in someTaskDicts :
+      aTaskName = aTaskDict.get('name', aTaskDict.get('basename', None))
+      if not aTaskName : continue
+      self.taskDeps[aTaskName] = []
+      self.taskDependents[aTaskName] = []
+      if not aTaskDict.get('actions', None) : self.groupTasks.append(aTaskName)
+      for aTarget in aTaskDict.get('targets', []) :
+        self.targetTasks[normalizePath(aTarget)] = aTaskName
+
+    for aTaskDict in someTaskDicts :
+      aTaskName = aTaskDict.get('name', aTaskDict.get('basename', None))
+      if not aTaskName : continue
+      for aFileDep in aTaskDict.get('file_dep', []) :
+        aFileDep = normalizePath(aFileDep)
+        if aFileDep not in self.fileTasks : self.fileTasks[aFileDep] = []
+        self.fileTasks[aFileDep].append(aTaskName)
+        if aFileDep in self.targetTasks :
+          self.addDependency(aTaskName, self.targetTasks[aFileDep])
+      for aTaskDep in aTaskDict.get('task_dep', []) :
+        self.addDependency(aTaskName, aTaskDep)
+
+  def indexPath(stateDir) :
+    """
+    Return the path to the (JSON) index file in the `stateDir`.
+    """
+    return os.path.join(stateDir, 'depIndex.json')
+
+  def toDict(self) :
+    return {
+      'fileTasks'      : self.fileTasks,
+      'targetTasks'    : self.targetTasks,
+      'taskDeps'       : self.taskDeps,
+      'taskDependents' : self.taskDependents,
+      'groupTasks'     : self.groupTasks
+    }
+
+  def fromDict(someData) :
+    anIndex = DependencyIndex()
+    anIndex.fileTasks      = someData.get('fileTasks', {})
+    anIndex.targetTasks    = someData.get('targetTasks', {})
+    anIndex.taskDeps       = someData.get('taskDeps', {})
+    anIndex.taskDependents = someData.get('taskDependents', {})
+    anIndex.groupTasks     = someData.get('groupTasks', [])
+    return anIndex
+
+  def save(self, indexPath) :
+    """
+    Save the index (atomically) to the `indexPath` JSON file.
+    """
+    try :
+      os.makedirs(os.path.dirname(indexPath) or '.', exist_ok=True)
+      tmpPath = indexPath + f".{os.getpid()}.tmp"
+      with open(tmpPath, 'w') as indexFile :
+        json.dump(self.toDict(), indexFile, sort_keys=True)
+      os.replace(tmpPath, indexPath)
+    except Exception as err :
+      print(f"Could not save the dependency index to {indexPath}")
+      print(repr(err))
+
+  def load(indexPath) :
+    """
+    Load (and return) the index saved in the `indexPath` JSON file (or None if
+    there is no (readable) index).
+    """
+    if not os.path.exists(indexPath) : return None
+    try :
+      with open(indexPath) as indexFile :
+        return DependencyIndex.fromDict(json.load(indexFile))
+    except Exception as err :
+      print(f"Could not load the dependency index from {indexPath}")
+      print(repr(err))
+    return None
+
+  def knownPath(self, aPath) :
+    """
+    Return the form of `aPath` (as given, relative to or absolute from the
+    current directory) which is known to the index (or the normalized
+    `aPath` if none are known).
+    """
+    aPath = normalizePath(aPath)
+    candidates = [ aPath ]
+    if os.path.isabs(aPath) :
+      candidates.append(normalizePath(os.path.relpath(aPath)))
+    else :
+      candidates.append(normalizePath(os.path.abspath(aPath)))
+    for aCandidate in candidates :
+      if aCandidate in self.fileTasks or aCandidate in self.targetTasks :
+        return aCandidate
+    return aPath
+
+  def addDependency(self, aTaskName, aDepName) :
+    """
+    Record that the task `aTaskName` depends upon the task `aDepName`.
+    """
+    if aDepName == aTaskName : return
+    if aDepName not in self.taskDependents : self.taskDependents[aDepName] = []
+    if aTaskName not in self.taskDeps : self.taskDeps[aTaskName] = []
+    if aTaskName not in self.taskDependents[aDepName] :
+      self.taskDependents[aDepName].append(aTaskName)
+    if aDepName not in self.taskDeps[aTaskName] :
+      self.taskDeps[aTaskName].append(aDepName)
+
+  def taskClosure(self, someTaskNames, someEdges) :
+    """
+    Return the set of tasks reachable from `someTaskNames` (inclusive) through
+    the `someEdges` (dict of lists).
+    """
+    closure = set()
+    toVisit = list(someTaskNames)
+    while toVisit :
+      aTaskName = toVisit.pop()
+      if aTaskName in closure : continue
+      closure.add(aTaskName)
+      toVisit.extend(someEdges.get(aTaskName, []))
+    return closure
+
+  def dependenciesOf(self, someTaskNames) :
+    """
+    Return the set of the tasks which the `someTaskNames` tasks (transitively)
+    depend upon (including the tasks themselves).
+    """
+    return self.taskClosure(someTaskNames, self.taskDeps)
+
+  def topologicalOrder(self, someTaskNames) :
+    """
+    Return the tasks in `someTaskNames` sorted so that every task comes after
+    all of the (listed) tasks it depends upon.
+    """
+    someTaskNames = set(someTaskNames)
+    numDeps = {}
+    for aTaskName in someTaskNames :
+      numDeps[aTaskName] = len([
+        aDepName for aDepName in self.taskDeps.get(aTaskName, [])
+        if aDepName in someTaskNames
+      ])
+    ready   = sorted(aTaskName for aTaskName, aNum in numDeps.items() if aNum == 0)
+    ordered = []
+    while ready :
+      aTaskName = ready.pop(0)
+      ordered.append(aTaskName)
+      newlyReady = []
+      for aDependent in self.taskDependents.get(aTaskName, []) :
+        if aDependent not in numDeps : continue
+        numDeps[aDependent] -= 1
+        if numDeps[aDependent] == 0 : newlyReady.append(aDependent)
+      ready = sorted(ready + newlyReady)
+    # (any dependency cycles are simply appended)
+    ordered.extend(sorted(someTaskNames - set(ordered)))
+    return ordered
+
+  def affectedBy(self, somePaths) :
+    """
+    Return the (topologically ordered) list of all of the tasks (transitively)
+    affected by changes to the files in `somePaths`.
+    """
+    directTasks = set()
+    for aPath in somePaths :
+      aPath = normalizePath(aPath)
+      directTasks.update(self.fileTasks.get(aPath, []))
+      # a changed (or removed) target affects the task which creates it
+      if aPath in self.targetTasks : directTasks.add(self.targetTasks[aPath])
+    return self.topologicalOrder(
+      self.taskClosure(directTasks, self.taskDependents)
+    )
+
+  def watchedFiles(self) :
+    """
+    Return the (sorted) list of the file dependencies which are not created by
+    any task (that is, the project's sources).
+    """
+    return sorted(
+      aPath for aPath in self.fileTasks if aPath not in self.targetTasks
+    )
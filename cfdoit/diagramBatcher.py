@@ -0,0 +1,279 @@
+"""
+Render many ConTeXt-MetaFun diagrams in one ConTeXt run.
+
+Running `lpilMagicRunner` once for each diagram pays the full ConTeXt start
+up (and format load) for every diagram. The `drawDiagramBatched` task snipet
+instead registers each of its diagrams (at task generation time) with the
+`DiagramBatcher`. When the first out-of-date diagram task is run, all of the
+registered (platform's) diagrams which were stale when their tasks were
+generated (their PDFs were missing, or older than their sources) are typeset
+together, one diagram per page, in a single ConTeXt run. The resulting PDF is
+then split into the individual `_v1_5.pdf` diagrams, each of which is
+(atomically) installed in the LaTeX build directory. The remaining diagram
+tasks simply pick up their (already rendered) result.
+
+The staleness of each diagram is decided once, at task generation time, so
+the (running) actions never query `doit`'s dependency manager. A stale
+diagram whose task `doit` then decides is up to date is merely rendered once
+too often, while a diagram which was not stale, but whose task `doit` does
+run, is rendered (on its own) by its own task.
+
+The format of each diagram's source is given by its `diagramFormat`:
+
+- `fragment` (the default): the source is a ConTeXt fragment (for example a
+  `\\startMPcode ... \\stopMPcode` MetaFun graphic) which is `\\input` into a
+  `\\startTEXpage` of the batch document. If the batch run fails (or the
+  batch PDF can not be split) each of the diagrams is re-rendered on its own
+  (in the same way, as a batch of one), so that successes and failures are
+  mapped back to the individual diagram tasks.
+
+- `document`: the source is a complete ConTeXt document, which is never
+  batched, but is rendered on its own using `lpilMagicRunner`.
+
+Splitting the batch PDF requires either `qpdf` or `pdfseparate` (and
+`pdfinfo`).
+
+The batches are configured by the `latex` configuration table:
+
+- `diagramBatchSize`: the maximum number of diagrams in a batch (default: 100)
+"""
+
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from doit.exceptions import TaskFailed
+
+from cfdoit.config import Config
+
+def runCommand(someArgs, cwd=None) :
+  """
+  Run a command, returning its (returncode, output).
+  """
+  try :
+    process = subprocess.run(
+      someArgs, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+      text=True
+    )
+    return (process.returncode, process.stdout)
+  except Exception as err :
+    return (1, repr(err))
+
+def countPdfPages(aPdfPath) :
+  """
+  Return the number of pages in the PDF file `aPdfPath` (or None).
+  """
+  if shutil.which('qpdf') :
+    returnCode, output = runCommand(['qpdf', '--show-npages', aPdfPath])
+    if returnCode == 0 : return int(output.strip())
+  elif shutil.which('pdfinfo') :
+    returnCode, output = runCommand(['pdfinfo', aPdfPath])
+    if returnCode == 0 :
+      for aLine in output.splitlines() :
+        if aLine.startswith('Pages:') : return int(aLine.split()[1])
+  return None
+
+def extractPdfPage(aPdfPath, pageNum, outPath) :
+  """
+  Extract the page `pageNum` (1 based) of the PDF `aPdfPath` into `outPath`.
+
+  Returns True if the page was extracted.
+  """
+  if shutil.which('qpdf') :
+    returnCode, output = runCommand([
+      'qpdf', '--empty', '--pages', aPdfPath, str(pageNum), '--', outPath
+    ])
+  elif shutil.which('pdfseparate') :
+    returnCode, output = runCommand([
+      'pdfseparate', '-f', str(pageNum), '-l', str(pageNum), aPdfPath, outPath
+    ])
+  else :
+    return False
+  return returnCode == 0 and os.path.exists(outPath)
+
+def sourceMTime(aPath) :
+  try :
+    return os.path.getmtime(aPath)
+  except OSError :
+    return None
+
+class DiagramBatcher :
+  """
+  The (process wide) registry of diagrams which can be rendered in batches.
+
+  Class variables:
+    diagrams: A dict mapping each platform to a dict mapping each diagram
+              source to its (latexDir, outPdf, diagramFormat).
+
+    stale:    A dict mapping each platform to the set of diagram sources
+              which were stale (at task generation time) and have not yet
+              been rendered.
+
+    results:  A dict mapping each (platform, diagram source) to the
+              (source modification time, ok, message) of its last rendering.
+  """
+
+  diagrams = {}
+  stale    = {}
+  results  = {}
+  lock     = threading.Lock()
+
+  def register(aPlatform, diagramTex, latexDir, outPdf, diagramFormat='fragment') :
+    """
+    Register a diagram (at task generation time), recording whether it is
+    stale (see `isStale`).
+    """
+    with DiagramBatcher.lock :
+      if aPlatform not in DiagramBatcher.diagrams :
+        DiagramBatcher.diagrams[aPlatform] = {}
+        DiagramBatcher.stale[aPlatform]    = set()
+      DiagramBatcher.diagrams[aPlatform][diagramTex] = (
+        latexDir, outPdf, diagramFormat
+      )
+      if DiagramBatcher.isStale(diagramTex, outPdf) :
+        DiagramBatcher.stale[aPlatform].add(diagramTex)
+      else :
+        DiagramBatcher.stale[aPlatform].discard(diagramTex)
+
+  def isStale(diagramTex, outPdf) :
+    """
+    Return True if the diagram's PDF is missing or older than its source.
+    """
+    pdfMTime = sourceMTime(outPdf)
+    texMTime = sourceMTime(diagramTex)
+    if pdfMTime is None or texMTime is None : return True
+    return pdfMTime < texMTime
+
+  def batchSize() :
+    if 'GLOBAL' not in Config.config : return 100
+    return Config.config['GLOBAL'].get('latex', {}).get('diagramBatchSize', 100)
+
+  def renderIndividually(diagramTex, latexDir, outPdf, diagramFormat) :
+    """
+    Render one diagram on its own (a fragment as a batch of one, a document
+    using `lpilMagicRunner`), returning (ok, message).
+    """
+    if diagramFormat == 'fragment' :
+      results, output = DiagramBatcher.renderBatch(
+        [ (diagramTex, latexDir, outPdf, diagramFormat) ]
+      )
+      if results is None : return (False, f"Could not render {diagramTex}:\n{output}")
+      return results[0]
+    returnCode, output = runCommand(['lpilMagicRunner', diagramTex, latexDir])
+    if returnCode != 0 or not os.path.exists(outPdf) :
+      return (False, f"Could not render {diagramTex}:\n{output}")
+    return (True, None)
+
+  def renderBatch(someJobs) :
+    """
+    Render a batch of (diagramTex, latexDir, outPdf, diagramFormat) fragment
+    jobs (which share the same latexDir) in one ConTeXt run.
+
+    Returns a (results, output) tuple, where results is a list of (ok,
+    message) results or None if the batch as a whole failed.
+    """
+    latexDir = someJobs[0][1]
+    os.makedirs(latexDir, exist_ok=True)
+    batchDir = tempfile.mkdtemp(prefix='.cfdoit-diagrams-', dir=latexDir)
+    try :
+      driver = [ "% cfdoit: batched diagrams (one diagram per page)", "\\starttext" ]
+      for diagramTex, aLatexDir, outPdf, diagramFormat in someJobs :
+        driver.append("\\startTEXpage")
+        driver.append(f"\\input{{{os.path.abspath(diagramTex)}}}")
+        driver.append("\\stopTEXpage")
+      driver.append("\\stoptext")
+      with open(os.path.join(batchDir, 'diagrams.tex'), 'w') as driverFile :
+        driverFile.write("\n".join(driver)+"\n")
+
+      if 1 < len(someJobs) :
+        print(f"Rendering {len(someJobs)} diagrams in one ConTeXt run")
+      returnCode, output = runCommand([
+        'context', '--batchmode', '--nonstopmode', '--purgeall', 'diagrams.tex'
+      ], cwd=batchDir)
+      batchPdf = os.path.join(batchDir, 'diagrams.pdf')
+      if returnCode != 0 or not os.path.exists(batchPdf) :
+        print("The batched ConTeXt run failed")
+        return (None, output)
+      if countPdfPages(batchPdf) != len(someJobs) :
+        print("The batched ConTeXt run produced the wrong number of pages")
+        return (None, output)
+
+      results = []
+      for pageNum, aJob in enumerate(someJobs, start=1) :
+        diagramTex, aLatexDir, outPdf, diagramFormat = aJob
+        tmpPdf = os.path.join(batchDir, f"page-{pageNum}.pdf")
+        if not extractPdfPage(batchPdf, pageNum, tmpPdf) :
+          return (None, f"Could not extract page {pageNum} of the batch PDF")
+        os.makedirs(os.path.dirname(outPdf) or '.', exist_ok=True)
+        os.replace(tmpPdf, outPdf)
+        results.append((True, None))
+      return (results, output)
+    finally :
+      shutil.rmtree(batchDir, ignore_errors=True)
+
+  def renderOutOfDateDiagrams(aPlatform, firstJob) :
+    """
+    Render the diagram `firstJob` together with any other (fragment) diagrams
+    registered for this platform (and the same latexDir) which were stale
+    when their tasks were generated. MUST be called with the lock held.
+    """
+    jobs = [ firstJob ]
+    if firstJob[3] == 'fragment' :
+      someDiagrams = DiagramBatcher.diagrams.get(aPlatform, {})
+      for diagramTex in sorted(DiagramBatcher.stale.get(aPlatform, set())) :
+        if DiagramBatcher.batchSize() <= len(jobs) : break
+        if diagramTex == firstJob[0] or diagramTex not in someDiagrams : continue
+        latexDir, outPdf, diagramFormat = someDiagrams[diagramTex]
+        if latexDir != firstJob[1] or diagramFormat != 'fragment' : continue
+        jobs.append((diagramTex, latexDir, outPdf, diagramFormat))
+
+    results = None
+    if 1 < len(jobs) : results, output = DiagramBatcher.renderBatch(jobs)
+    if results is None :
+      # render (in parallel) each diagram on its own so that we know which
+      # diagrams failed
+      with concurrent.futures.ThreadPoolExecutor() as executor :
+        futures = [
+          executor.submit(DiagramBatcher.renderIndividually, *aJob)
+          for aJob in jobs
+        ]
+        results = [ aFuture.result() for aFuture in futures ]
+
+    for aJob, (ok, message) in zip(jobs, results) :
+      DiagramBatcher.results[(aPlatform, aJob[0])] = (
+        sourceMTime(aJob[0]), ok, message
+      )
+      DiagramBatcher.stale.get(aPlatform, set()).discard(aJob[0])
+
+  def render(aPlatform, diagramTex, latexDir, outPdf) :
+    """
+    Return the (ok, message) result of rendering a diagram, rendering it (in a
+    batch) if it has not already been rendered from its current source.
+    """
+    with DiagramBatcher.lock :
+      diagramFormat = DiagramBatcher.diagrams.get(aPlatform, {}).get(
+        diagramTex, (None, None, 'fragment')
+      )[2]
+      aKey   = (aPlatform, diagramTex)
+      result = DiagramBatcher.results.pop(aKey, None)
+      if result is not None :
+        texMTime, ok, message = result
+        if texMTime == sourceMTime(diagramTex) and os.path.exists(outPdf) :
+          return (ok, message)
+      DiagramBatcher.renderOutOfDateDiagrams(
+        aPlatform, (diagramTex, latexDir, outPdf, diagramFormat)
+      )
+      texMTime, ok, message = DiagramBatcher.results.pop(aKey)
+      return (ok, message)
+
+def renderDiagram(aPlatform, diagramTex, latexDir, outPdf) :
+  """
+  A `doit` python action which renders the diagram `diagramTex` into the PDF
+  `outPdf` (see `DiagramBatcher`).
+  """
+  ok, message = DiagramBatcher.render(aPlatform, diagramTex, latexDir, outPdf)
+  if not ok : return TaskFailed(message)
+  return True
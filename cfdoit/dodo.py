@@ -14,3 +14,7 @@ import cfdoit.taskSnipets.latexSnipets
 # the whole doit system to register doit tasks
 
 from cfdoit.taskGenerator import task_genTasks
+
+# The `doit` defaults (updated by `cfdoit.cli`, for example to run the local
+# worker pools concurrently, see `cfdoit.localFarm`)
+DOIT_CONFIG = {}
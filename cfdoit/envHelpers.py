@@ -1,4 +1,11 @@
 
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import weakref
 from string import Template
 import yaml
 
@@ -99,6 +106,29 @@ def expandEnvInActions(snipetName, someActions, theEnv) :
       theActions.append(theActionLine)
   return theActions
 
+def expandEnvInPythonActions(snipetName, somePythonActions, theEnv) :
+  """
+  Expand all environment variable references in the (string) arguments of
+  each `doit` python action.
+
+  Each python action MUST be a tuple (or list) of a python callable and a list
+  of (string) arguments.
+
+  Environment variables MUST be provided in the `theEnv` parameter.
+
+  Returns the `doit` python actions with all environment variables expanded.
+  """
+
+  theActions = []
+  for aCallable, someArgs in somePythonActions :
+    theArgs = []
+    for anArg in someArgs :
+      if isinstance(anArg, str) :
+        anArg = expandEnvInStr(snipetName, anArg, theEnv)
+      theArgs.append(anArg)
+    theActions.append((aCallable, theArgs))
+  return theActions
+
 def checkVersion(aVersion) :
   """
   A `doit` extension to check (and save) package versions.
@@ -117,6 +147,114 @@ def checkVersion(aVersion) :
     return lastVersion == aVersion
   return versionChecker
 
+def remoteGitCommit(aUrl, aRevision) :
+  """
+  Return the commit id which the (branch, tag or HEAD) revision `aRevision`
+  currently names in the git repository `aUrl` (or None if it can not be
+  determined, for example when offline).
+  """
+  try :
+    aProc = subprocess.run(
+      [ 'git', 'ls-remote', aUrl, aRevision, aRevision + '^{}' ],
+      capture_output=True, text=True, timeout=60
+    )
+  except (OSError, subprocess.SubprocessError) :
+    return None
+  if aProc.returncode != 0 : return None
+  refs = {}
+  for aLine in aProc.stdout.splitlines() :
+    if '\t' not in aLine : continue
+    aCommit, aRef = aLine.split('\t', 1)
+    refs[aRef] = aCommit
+  # (an annotated tag names the commit it peels to)
+  for aRef in [
+    f"refs/tags/{aRevision}^{{}}", f"refs/tags/{aRevision}",
+    f"refs/heads/{aRevision}", aRevision
+  ] :
+    if aRef in refs : return refs[aRef]
+  return None
+
+def checkGitRevision(aRevision, aVersion="", aUrl=None, aWorktree=None) :
+  """
+  A `doit` extension to check (and save) git revisions.
+
+  A full (40 hexadecimal digit) commit id never changes, so it is checked (and
+  saved, together with `aVersion`) as a version (see `checkVersion`). Any other
+  revision (a branch, tag or HEAD) may move, so (if the repository `aUrl` and
+  the checked out worktree `aWorktree` are known) the commit checked out in
+  the worktree is compared with the commit the revision currently names in
+  the repository, otherwise the task is always (re)run.
+  """
+  if re.fullmatch(r'[0-9a-f]{40}', aRevision) :
+    return checkVersion(f"{aRevision} {aVersion}")
+  versionChecker = checkVersion(f"{aRevision} {aVersion}")
+  def revisionChecker(task, values) :
+    if not aUrl or not aWorktree : return False
+    if not versionChecker(task, values) : return False
+    try :
+      aProc = subprocess.run(
+        [ 'git', '-C', aWorktree, 'rev-parse', 'HEAD' ],
+        capture_output=True, text=True, timeout=60
+      )
+    except (OSError, subprocess.SubprocessError) :
+      return False
+    if aProc.returncode != 0 : return False
+    remoteCommit = remoteGitCommit(aUrl, aRevision)
+    return remoteCommit is not None and remoteCommit == aProc.stdout.strip()
+  return revisionChecker
+
+def installedFilesFingerprint(aPrefix, someManifests, aSubDir) :
+  """
+  Return a fingerprint (of the paths, sizes and modification times) of the
+  files, below `aSubDir` of the install prefix `aPrefix`, which are listed in
+  the (staged install) manifests `someManifests`. If any of the manifests does
+  not exist, all of the files below `aSubDir` are fingerprinted.
+  """
+  subDirPrefix = aSubDir.rstrip('/') + '/'
+  installedFiles = set()
+  for aManifest in someManifests :
+    if not os.path.isfile(aManifest) :
+      installedFiles = None
+      break
+    with open(aManifest) as manifestFile :
+      for aLine in manifestFile :
+        aFile = aLine.strip()
+        if aFile.startswith(subDirPrefix) : installedFiles.add(aFile)
+  if installedFiles is None :
+    installedFiles = set()
+    for aDir, someDirs, someFiles in os.walk(os.path.join(aPrefix, aSubDir)) :
+      for aFile in someFiles :
+        installedFiles.add(os.path.relpath(os.path.join(aDir, aFile), aPrefix))
+
+  aHash = hashlib.sha256()
+  for aFile in sorted(installedFiles) :
+    try :
+      aStat = os.stat(os.path.join(aPrefix, aFile))
+      aHash.update(f"{aFile} {aStat.st_size} {aStat.st_mtime_ns}\n".encode())
+    except OSError :
+      aHash.update(f"{aFile} missing\n".encode())
+  return aHash.hexdigest()
+
+def checkInstalledFiles(aPrefix, someManifests, aSubDir='include') :
+  """
+  A `doit` extension to check (and save) a fingerprint of the files a
+  collection of packages have installed (see `installedFilesFingerprint`).
+
+  Returns True if none of the installed files, below `aSubDir` of the install
+  prefix `aPrefix`, have changed (been added, removed or rewritten) since this
+  task was last run. (False otherwise)
+
+  If used as part of a task uptodate, the task will be (re)run whenever any of
+  the packages is reinstalled with different (header) files.
+  """
+  def installedChecker(task, values) :
+    aFingerprint = installedFilesFingerprint(aPrefix, someManifests, aSubDir)
+    def saveFingerprint() :
+      return {'saved-installed' : aFingerprint }
+    task.value_savers.append(saveFingerprint)
+    return values.get('saved-installed', "") == aFingerprint
+  return installedChecker
+
 def expandEnvInUptodates(snipetName, someUptodates, theEnv) :
   """
   Expand all environment varible refrences in each uptodate task in the
@@ -155,3 +293,86 @@ def expandEnvInList(snipetName, aList, theEnv) :
     if newValue := expandEnvInStr(snipetName, anItem, theEnv) :
       resultList.append(newValue)
   return resultList
+
+# a (shell) variable reference: `$name` or `${name...}`
+shellVarRegExp = re.compile(r'\$(?:\{([A-Za-z_][A-Za-z0-9_]*)|([A-Za-z_][A-Za-z0-9_]*))')
+
+class FrozenEnvironment(dict) :
+  """
+  An immutable (and so shareable) environment dict.
+  """
+
+  def readOnly(self, *args, **kwargs) :
+    raise TypeError("a FrozenEnvironment can not be changed")
+
+  __setitem__ = __delitem__ = __ior__ = readOnly
+  clear = pop = popitem = setdefault = update = readOnly
+
+  def __reduce__(self) :
+    return (FrozenEnvironment, (dict(self),))
+
+# The (interned) frozen environments shared by any number of tasks (each is
+# forgotten once no task uses it).
+frozenEnvironments = weakref.WeakValueDictionary()
+
+def referencedEnvKeys(someStrs) :
+  """
+  Return the set of the (shell) variable names referenced in the (nested
+  lists of) strings `someStrs`.
+  """
+  if isinstance(someStrs, str) : someStrs = [ someStrs ]
+  someKeys = set()
+  for aStr in someStrs :
+    if isinstance(aStr, (list, tuple)) :
+      someKeys.update(referencedEnvKeys(aStr))
+    elif isinstance(aStr, str) and '$' in aStr :
+      for bracedKey, plainKey in shellVarRegExp.findall(aStr) :
+        someKeys.add(bracedKey or plainKey)
+  return someKeys
+
+def minimalEnvironment(someActions, theEnv, exportKeys=[]) :
+  """
+  Return the (frozen, interned) environment a task's (unexpanded) `someActions`
+  actually need: the variables of `theEnv` which the actions reference
+  (directly, or through the values of other referenced variables) together
+  with the `exportKeys` (for example the variables read by the tools the
+  actions run, such as `CC` or `CFLAGS`). An `exportKeys` of True keeps the
+  whole of `theEnv`.
+
+  The actions MUST be the (unexpanded) templates, since expanding them
+  replaces the references to (most of) the variables by their values. (A
+  `$$NAME` reference to a variable only known when the actions run is still
+  found as a reference to `NAME`.)
+
+  The variables are ordered so that each variable follows the variables its
+  value references (so that they can be exported in order). Identical
+  environments are shared by all of the tasks which need them.
+  """
+  if exportKeys is True :
+    toVisit = list(theEnv.keys())
+  else :
+    if isinstance(exportKeys, str) : exportKeys = [ exportKeys ]
+    toVisit = list(exportKeys) + list(referencedEnvKeys(someActions))
+  theKeys = set()
+  while toVisit :
+    aKey = toVisit.pop()
+    if aKey in theKeys or aKey not in theEnv : continue
+    theKeys.add(aKey)
+    toVisit.extend(referencedEnvKeys(theEnv[aKey]))
+
+  anEnv = {}
+  def addKey(aKey) :
+    if aKey in anEnv or aKey not in theKeys : return
+    anEnv[aKey] = None  # (guards against circular references)
+    for aRefKey in sorted(referencedEnvKeys(theEnv[aKey])) : addKey(aRefKey)
+    aValue = theEnv[aKey]
+    if isinstance(aValue, str) : aValue = sys.intern(aValue)
+    del anEnv[aKey]
+    anEnv[sys.intern(aKey)] = aValue
+  for aKey in sorted(theKeys) : addKey(aKey)
+  envKey = json.dumps(list(anEnv.items()), default=str)
+  frozenEnv = frozenEnvironments.get(envKey, None)
+  if frozenEnv is None :
+    frozenEnv = FrozenEnvironment(anEnv)
+    frozenEnvironments[envKey] = frozenEnv
+  return frozenEnv
@@ -0,0 +1,246 @@
+"""
+A registry of the remote (`taskRequest` and `batchRequest`) requests which
+this `cfdoit` command has sent to the TaskManager, but which have not yet
+completed.
+
+When a build is aborted, either because the user has interrupted it (SIGINT
+or SIGTERM) or because a task has failed and `doit` is not running with
+`--continue` (fail-fast), every in-flight request is explicitly cancelled (by
+sending the TaskManager a `cancelRequest` containing its `requestId`) so that
+the farm's workers are reclaimed immediately, rather than running the tasks
+of an abandoned build to completion. We then wait (briefly) for the
+TaskManager to acknowledge each cancellation, and remove any (partial)
+targets which the cancelled tasks might have (re)written.
+
+Once a build has been aborted, no further remote requests are sent.
+
+The registry is per (Python) process. When `doit` runs tasks in several
+processes (`-P process` with `-n` greater than 1), each worker process
+registers (only) its own requests: a SIGINT or SIGTERM (which is delivered to
+all of the processes, whose signal handlers are inherited) still cancels
+every process's requests, but a fail-fast abort only cancels the requests of
+the process whose task failed (the requests of the other processes run to
+completion). Use `-P thread` for a fully cancellable build (a warning is
+printed otherwise). In daemon mode, a client which disconnects aborts the
+daemon's build (see `cfdoit.daemon`).
+
+The cancellation is configured by the `taskManager` configuration:
+
+- `cancelAckSeconds`: how long to wait for the TaskManager to acknowledge
+  each cancellation (default: 2.0)
+"""
+
+import os
+import signal
+import threading
+import time
+
+from cfdoit.config import Config
+from cfdoit.computeFarmTools import (
+  tcpTMConnection, tcpTMSentRequest, tcpTMCloseConnection
+)
+
+class InFlight :
+  """
+  The (process wide) registry of in-flight remote requests.
+
+  Class variables:
+    requests: A dict mapping each in-flight `requestId` to a dict containing
+              its `socket` and the `taskNames` it is running.
+    tasks:    A dict mapping the name of each task with an in-flight request
+              to its `targets` and the time its request was `started`.
+    aborted:  The reason the build was aborted (None while it is running).
+    failFast: Abort the build as soon as any task fails.
+  """
+
+  requests = {}
+  tasks    = {}
+  aborted  = None
+  failFast = True
+  lock     = threading.Lock()
+
+  def continueRequested(someArgs, doitConfig={}) :
+    """
+    Return True if `doit` has been asked (on the command line `someArgs` or
+    in the `doitConfig`) to continue running tasks after a task has failed.
+    """
+    continueTasks = bool(doitConfig.get('GLOBAL', {}).get('continue', False))
+    for anArg in someArgs :
+      if anArg == '--' : break
+      if anArg in [ '-c', '--continue' ] : continueTasks = True
+      elif anArg == '--no-continue'      : continueTasks = False
+    return continueTasks
+
+  def runsInProcesses(someArgs, doitConfig={}) :
+    """
+    Return True if `doit` has been asked (on the command line `someArgs` or
+    in the `doitConfig`) to run tasks in several (worker) processes.
+    """
+    gConfig    = doitConfig.get('GLOBAL', {})
+    numProcess = gConfig.get('num_process', 0)
+    parType    = gConfig.get('par_type', 'process')
+    someArgs   = iter(someArgs)
+    for anArg in someArgs :
+      if anArg == '--' : break
+      if anArg in [ '-n', '--process' ]               : numProcess = next(someArgs, 0)
+      elif anArg.startswith('--process=')             : numProcess = anArg.split('=', 1)[1]
+      elif anArg.startswith('-n')                     : numProcess = anArg[2:]
+      elif anArg in [ '-P', '--parallel-type' ]       : parType = next(someArgs, parType)
+      elif anArg.startswith('--parallel-type=')       : parType = anArg.split('=', 1)[1]
+      elif anArg.startswith('-P')                     : parType = anArg[2:]
+    try :
+      numProcess = int(numProcess)
+    except ValueError :
+      numProcess = 0
+    return 1 < numProcess and parType == 'process'
+
+  def beginRun(someArgs, doitConfig={}) :
+    """
+    Prepare for a new build (of the `doit` command `someArgs`).
+    """
+    with InFlight.lock :
+      InFlight.requests = {}
+      InFlight.tasks    = {}
+      InFlight.aborted  = None
+      InFlight.failFast = not InFlight.continueRequested(someArgs, doitConfig)
+    if InFlight.failFast and InFlight.runsInProcesses(someArgs, doitConfig) :
+      print("Warning: a failing task only cancels the remote requests of its own doit process (use -P thread)")
+
+  def isAborted() :
+    return InFlight.aborted is not None
+
+  def addTask(taskName, someTargets) :
+    with InFlight.lock :
+      InFlight.tasks[taskName] = {
+        'targets' : list(someTargets),
+        'started' : time.time()
+      }
+
+  def removeTask(taskName) :
+    with InFlight.lock :
+      if taskName in InFlight.tasks : del InFlight.tasks[taskName]
+
+  def register(requestId, tmSocket, someTaskNames) :
+    """
+    Register the (sent) request `requestId` whose results are being read from
+    `tmSocket`.
+
+    Returns False (and does NOT register the request) if the build has already
+    been aborted.
+    """
+    with InFlight.lock :
+      if InFlight.aborted is not None : return False
+      InFlight.requests[requestId] = {
+        'socket'    : tmSocket,
+        'taskNames' : list(someTaskNames)
+      }
+    return True
+
+  def unregister(requestId) :
+    with InFlight.lock :
+      if requestId in InFlight.requests : del InFlight.requests[requestId]
+
+  def sendCancel(requestId) :
+    """
+    Ask the TaskManager to cancel the request `requestId`, waiting (briefly)
+    for its acknowledgement.
+
+    Returns True if the TaskManager acknowledged the cancellation.
+    """
+    tmConfig = Config.config['GLOBAL']['taskManager']
+    cancelRequest = {
+      'host'           : tmConfig['host'],
+      'port'           : tmConfig['port'],
+      'type'           : "cancelRequest",
+      'requestId'      : requestId,
+      'connectTimeOut' : tmConfig['connectTimeOut'],
+      'sendTimeOut'    : tmConfig['sendTimeOut'],
+      'readTimeOut'    : tmConfig['cancelAckSeconds']
+    }
+    tmSocket = tcpTMConnection(cancelRequest)
+    if not tmSocket : return False
+    acknowledged = False
+    if tcpTMSentRequest(cancelRequest, tmSocket) :
+      try :
+        acknowledged = b'cancelled' in tmSocket.recv(4096)
+      except OSError :
+        pass  # an old (or busy) TaskManager which does not acknowledge
+    tcpTMCloseConnection(tmSocket)
+    return acknowledged
+
+  def cancel(requestId) :
+    """
+    Cancel the (single) in-flight request `requestId` and stop reading its
+    results.
+    """
+    with InFlight.lock :
+      aRequest = InFlight.requests.pop(requestId, None)
+    if aRequest is None : return
+    InFlight.sendCancel(requestId)
+    tcpTMCloseConnection(aRequest['socket'])
+
+  def removePartialTargets(someTaskNames, someTasks) :
+    """
+    Remove the targets (re)written by the (cancelled) tasks `someTaskNames`
+    (described in `someTasks`) since their requests were started.
+    """
+    for aTaskName in someTaskNames :
+      aTask = someTasks.get(aTaskName, None)
+      if aTask is None : continue
+      for aTarget in aTask['targets'] :
+        try :
+          if os.path.getmtime(aTarget) < aTask['started'] : continue
+          os.unlink(aTarget)
+          print(f"Removed the partial target {aTarget} of {aTaskName}")
+        except OSError :
+          pass  # the target was never (or was only partially) created
+
+  def abort(aReason) :
+    """
+    Abort the build: cancel all in-flight requests (in parallel), and
+    remove any of their tasks' partial targets.
+    """
+    with InFlight.lock :
+      if InFlight.aborted is not None : return
+      InFlight.aborted  = aReason
+      someRequests      = InFlight.requests
+      someTasks         = dict(InFlight.tasks)
+      InFlight.requests = {}
+    if not someRequests : return
+
+    print(f"Aborting the build ({aReason}): cancelling {len(someRequests)} remote requests")
+    acknowledged = []
+    def cancelOne(requestId) :
+      if InFlight.sendCancel(requestId) : acknowledged.append(requestId)
+    threads = [
+      threading.Thread(target=cancelOne, args=(requestId,), daemon=True)
+      for requestId in someRequests
+    ]
+    for aThread in threads : aThread.start()
+    for aThread in threads : aThread.join()
+    print(f"The taskManager acknowledged {len(acknowledged)} of {len(someRequests)} cancellations")
+
+    for aRequest in someRequests.values() :
+      tcpTMCloseConnection(aRequest['socket'])
+      InFlight.removePartialTargets(aRequest['taskNames'], someTasks)
+
+  def taskFailed(taskName) :
+    """
+    Abort the build (if failing fast) since the task `taskName` has failed.
+    """
+    if InFlight.failFast and InFlight.aborted is None :
+      InFlight.abort(f"{taskName} failed")
+
+  def installSignalHandlers() :
+    """
+    Abort the build whenever this (main) thread is sent a SIGINT or SIGTERM,
+    and then handle the signal as before.
+    """
+    for aSignal in [ signal.SIGINT, signal.SIGTERM ] :
+      oldHandler = signal.getsignal(aSignal)
+      def onSignal(signum, frame, oldHandler=oldHandler) :
+        InFlight.abort(f"interrupted by {signal.Signals(signum).name}")
+        if callable(oldHandler) : oldHandler(signum, frame)
+        elif signum == signal.SIGINT : raise KeyboardInterrupt()
+        else : raise SystemExit(128 + signum)
+      signal.signal(aSignal, onSignal)
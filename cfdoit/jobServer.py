@@ -0,0 +1,155 @@
+"""
+A GNU make compatible (FIFO based) jobserver shared by all of the (local)
+WorkerTasks run by one `cfdoit` command.
+
+The jobserver is a named pipe (FIFO) which initially contains one "token"
+for each job slot. Clients (GNU make >= 4.4, ninja >= 1.13, ...) find the
+jobserver through the `--jobserver-auth=fifo:PATH` option in the `MAKEFLAGS`
+environment variable, take a token before starting each additional job, and
+give it back when that job has finished.
+
+Every client also owns one implicit job slot. So that this implicit slot is
+also drawn from the pool, `cfdoit` takes a token (see `acquire`) before it
+starts each local WorkerTask (the client) and gives it back once the task has
+finished. Concurrent builds run by this `cfdoit` command therefore share a
+fixed pool of job slots, rather than each using every core.
+
+The jobserver is scoped to ONE `cfdoit` command (or one `cfdoit daemon`, which
+shares its jobserver between all of the commands it runs), NOT to the host:
+its FIFO lives in a private temporary directory, so separate `cfdoit`
+commands each have their own pool of job slots. Remote workers can not see
+the jobserver either, so only (local) WorkerTasks run while the jobserver is
+running use their (smaller) `jobServerLoad` (see `WorkerTask.localLoad`).
+
+The jobserver is enabled by the `jobServer` key of the `build` configuration.
+The number of job slots is given by the `jobServerSlots` key (which defaults to
+the number of cores on this host).
+"""
+
+import atexit
+import os
+import select
+import shutil
+import tempfile
+import threading
+
+from cfdoit.config import Config
+
+class JobServer :
+  """
+  The (single) jobserver for this `cfdoit` command.
+
+  Class variables:
+    fifoPath: The path to the jobserver's FIFO (None if not running).
+    numSlots: The total number of job slots.
+  """
+
+  fifoPath = None
+  numSlots = 0
+  readFd   = None
+  writeFd  = None
+  lock     = threading.Lock()
+
+  def isEnabled() :
+    """
+    Return True if the jobserver has been enabled in the configuration.
+    """
+    if 'GLOBAL' not in Config.config : return False
+    if 'build' not in Config.config['GLOBAL'] : return False
+    return bool(Config.config['GLOBAL']['build'].get('jobServer', False))
+
+  def start() :
+    """
+    Start the jobserver (if it has been enabled and is not already running).
+
+    The jobserver MUST be started before `doit` forks any processes (so that
+    all processes share the same jobserver).
+    """
+    if not JobServer.isEnabled() : return
+    with JobServer.lock :
+      if JobServer.fifoPath : return
+      bConfig  = Config.config['GLOBAL']['build']
+      numSlots = bConfig.get('jobServerSlots', None)
+      if not numSlots : numSlots = os.cpu_count() or 1
+      numSlots = max(1, int(numSlots))
+
+      fifoDir  = tempfile.mkdtemp(prefix='cfdoit-jobserver-')
+      fifoPath = os.path.join(fifoDir, 'fifo')
+      try :
+        os.mkfifo(fifoPath, 0o600)
+        # we hold both ends of the FIFO open so that it never reports EOF and
+        # the clients never block opening it
+        JobServer.readFd  = os.open(fifoPath, os.O_RDONLY | os.O_NONBLOCK)
+        JobServer.writeFd = os.open(fifoPath, os.O_WRONLY)
+        # (the implicit slot of each client is backed by a token cfdoit
+        # takes on the client's behalf, see `acquire`)
+        os.write(JobServer.writeFd, b'+' * numSlots)
+      except Exception as err :
+        print("Could not start the jobserver")
+        print(repr(err))
+        shutil.rmtree(fifoDir, ignore_errors=True)
+        return
+      JobServer.fifoPath = fifoPath
+      JobServer.numSlots = numSlots
+      atexit.register(JobServer.stop)
+      print(f"Started a jobserver with {numSlots} job slots on {fifoPath}")
+
+  def stop() :
+    """
+    Stop the jobserver (if it is running).
+    """
+    with JobServer.lock :
+      if not JobServer.fifoPath : return
+      for aFd in [ JobServer.readFd, JobServer.writeFd ] :
+        try :
+          os.close(aFd)
+        except OSError :
+          pass
+      shutil.rmtree(os.path.dirname(JobServer.fifoPath), ignore_errors=True)
+      JobServer.fifoPath = None
+      JobServer.readFd   = None
+      JobServer.writeFd  = None
+
+  def acquire() :
+    """
+    Wait for (and take) a token from the jobserver, returning the token (or
+    None if the jobserver is not running).
+    """
+    readFd = JobServer.readFd
+    if not JobServer.fifoPath or readFd is None : return None
+    while True :
+      try :
+        select.select([ readFd ], [], [])
+        aToken = os.read(readFd, 1)
+      except BlockingIOError :
+        continue  # (another client took the token first)
+      except OSError :
+        return None  # (the jobserver has been stopped)
+      if aToken : return aToken
+
+  def release(aToken) :
+    """
+    Give the token `aToken` (taken using `acquire`) back to the jobserver.
+    """
+    if aToken is None or JobServer.writeFd is None : return
+    try :
+      os.write(JobServer.writeFd, aToken)
+    except OSError :
+      pass  # (the jobserver has been stopped)
+
+  def makeFlags() :
+    """
+    Return the `MAKEFLAGS` which advertise the jobserver to its clients.
+    """
+    return f" -j{JobServer.numSlots} --jobserver-auth=fifo:{JobServer.fifoPath}"
+
+  def environment() :
+    """
+    Return a copy of the current process environment which advertises the
+    jobserver (or None if the jobserver is not running).
+    """
+    if not JobServer.fifoPath : return None
+    anEnv = os.environ.copy()
+    anEnv['MAKEFLAGS']        = JobServer.makeFlags()
+    anEnv['CFDOIT_JOBSERVER'] = JobServer.fifoPath
+    return anEnv
@@ -0,0 +1,208 @@
+"""
+Automatically discover the dependencies of a LaTeX document.
+
+The scanner parses a LaTeX source, and (recursively) all of the sources it
+`\\input`s or `\\include`s, looking for references to diagrams and to
+pygmented code chunks. By default:
+
+- a diagram is referenced as `\\includegraphics{NAME_v1_5}` (or
+  `NAME_v1_5.pdf`), and is drawn from `NAME.tex`,
+
+- a code chunk is referenced as `\\input{NAME.pygmented}` (or `\\include`,
+  `NAME.pygmented.tex`), and is highlighted from `NAME.chunk`.
+
+These patterns can be replaced using the `scanPatterns` table (with `diagrams`
+and `pygments` lists of regular expressions, each with one group capturing the
+name) of the `latex` configuration.
+
+The direct references found in each source file are cached (in the
+`latexScan.json` file in the `cfdoit` state directory) together with the
+file's size, modification time and content hash (and a hash of the scan
+patterns), so that large documents are only rescanned when their sources (or
+the `scanPatterns`) change.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+from cfdoit.config import Config
+
+defaultPatterns = {
+  'diagrams' : [
+    r'\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^}]*?)_v1_5(?:\.pdf)?\}'
+  ],
+  'pygments' : [
+    r'\\(?:input|include)\s*\{([^}]*?)\.pygmented(?:\.tex)?\}'
+  ]
+}
+
+inputPattern   = re.compile(r'\\(?:input|include)\s*\{([^}]+)\}')
+commentPattern = re.compile(r'(?<!\\)%.*$', re.MULTILINE)
+
+def latexConfig() :
+  if 'GLOBAL' not in Config.config : return {}
+  return Config.config['GLOBAL'].get('latex', {})
+
+def scanSource(someText, somePatterns) :
+  """
+  Scan the (LaTeX) text `someText` for its direct references.
+
+  Returns a dict with the `inputs`, `diagrams` and `pygments` lists.
+  """
+  someText = commentPattern.sub('', someText)
+  references = { 'inputs' : [], 'diagrams' : [], 'pygments' : [] }
+  pygmentedNames = []
+  for aPattern in somePatterns['pygments'] :
+    for aMatch in re.finditer(aPattern, someText) :
+      pygmentedNames.append(aMatch.group(1))
+      references['pygments'].append(aMatch.group(1)+'.chunk')
+  for aPattern in somePatterns['diagrams'] :
+    for aMatch in re.finditer(aPattern, someText) :
+      references['diagrams'].append(aMatch.group(1))
+  for aMatch in inputPattern.finditer(someText) :
+    anInput = aMatch.group(1).strip()
+    # the pygmented code chunks are generated (and have no references)
+    if anInput.removesuffix('.tex').removesuffix('.pygmented') in pygmentedNames :
+      continue
+    references['inputs'].append(anInput)
+  return references
+
+class LatexScanner :
+  """
+  The (persistent) cache of the direct references found in each LaTeX source.
+  """
+
+  cache   = None
+  changed = False
+  lock    = threading.Lock()
+
+  def cachePath() :
+    stateDir = '.cfdoit'
+    if 'GLOBAL' in Config.config :
+      stateDir = Config.config['GLOBAL'].get('build', {}).get('stateDir', stateDir)
+    return os.path.join(stateDir, 'latexScan.json')
+
+  def loadCache() :
+    if LatexScanner.cache is not None : return
+    LatexScanner.cache = {}
+    cachePath = LatexScanner.cachePath()
+    if not os.path.exists(cachePath) : return
+    try :
+      with open(cachePath) as cacheFile :
+        LatexScanner.cache = json.load(cacheFile)
+    except Exception as err :
+      print(f"Could not load the LaTeX scan cache from {cachePath}")
+      print(repr(err))
+
+  def saveCache() :
+    if not LatexScanner.changed : return
+    cachePath = LatexScanner.cachePath()
+    try :
+      os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+      tmpPath = cachePath + f".{os.getpid()}.tmp"
+      with open(tmpPath, 'w') as cacheFile :
+        json.dump(LatexScanner.cache, cacheFile, indent=1, sort_keys=True)
+      os.replace(tmpPath, cachePath)
+      LatexScanner.changed = False
+    except Exception as err :
+      print(f"Could not save the LaTeX scan cache to {cachePath}")
+      print(repr(err))
+
+  def patterns() :
+    scanPatterns = dict(defaultPatterns)
+    scanPatterns.update(latexConfig().get('scanPatterns', {}))
+    return scanPatterns
+
+  def patternsHash(somePatterns) :
+    """
+    Return a hash of the scan patterns `somePatterns` (and of the scanner's
+    own patterns).
+    """
+    allPatterns = dict(somePatterns)
+    allPatterns['inputs']   = inputPattern.pattern
+    allPatterns['comments'] = commentPattern.pattern
+    return hashlib.sha256(
+      json.dumps(allPatterns, sort_keys=True).encode('utf8')
+    ).hexdigest()
+
+  def directReferences(aPath) :
+    """
+    Return the (cached) direct references of the LaTeX source `aPath` (or None
+    if the source does not exist).
+
+    The cached references are only reused if they were found using the
+    current scan patterns.
+    """
+    try :
+      aStat = os.stat(aPath)
+    except OSError :
+      return None
+    somePatterns = LatexScanner.patterns()
+    patternsHash = LatexScanner.patternsHash(somePatterns)
+    cached = LatexScanner.cache.get(aPath, None)
+    if cached and cached.get('patterns', None) != patternsHash : cached = None
+    if cached and cached['size'] == aStat.st_size \
+              and cached['mtime'] == aStat.st_mtime :
+      return cached['references']
+
+    with open(aPath, 'rb') as sourceFile :
+      content = sourceFile.read()
+    contentHash = hashlib.sha256(content).hexdigest()
+    if cached and cached['hash'] == contentHash :
+      references = cached['references']
+    else :
+      references = scanSource(
+        content.decode('utf8', errors='replace'), somePatterns
+      )
+    LatexScanner.cache[aPath] = {
+      'size'       : aStat.st_size,
+      'mtime'      : aStat.st_mtime,
+      'hash'       : contentHash,
+      'patterns'   : patternsHash,
+      'references' : references
+    }
+    LatexScanner.changed = True
+    return references
+
+  def resolveInput(anInput, aDir) :
+    """
+    Return the path of the `\\input` source `anInput` (or None).
+    """
+    candidates = [ anInput ]
+    if not os.path.splitext(anInput)[1] : candidates.insert(0, anInput+'.tex')
+    for aCandidate in candidates :
+      for aBaseDir in [ aDir, '.' ] :
+        aPath = os.path.normpath(os.path.join(aBaseDir, aCandidate))
+        if os.path.isfile(aPath) : return aPath
+    return None
+
+  def scan(texPath) :
+    """
+    Return the dependencies of the LaTeX document `texPath` as a dict with:
+
+    - `sources`: the LaTeX sources (the document and all of its inputs)
+    - `diagrams`: the diagrams it references
+    - `pygments`: the code chunks it references
+    """
+    with LatexScanner.lock :
+      LatexScanner.loadCache()
+      dependencies = { 'sources' : [], 'diagrams' : [], 'pygments' : [] }
+      toScan = [ os.path.normpath(texPath) ]
+      while toScan :
+        aPath = toScan.pop(0)
+        if aPath in dependencies['sources'] : continue
+        references = LatexScanner.directReferences(aPath)
+        if references is None : continue
+        dependencies['sources'].append(aPath)
+        for aKey in [ 'diagrams', 'pygments' ] :
+          for aReference in references[aKey] :
+            if aReference not in dependencies[aKey] :
+              dependencies[aKey].append(aReference)
+        for anInput in references['inputs'] :
+          anInputPath = LatexScanner.resolveInput(anInput, os.path.dirname(aPath))
+          if anInputPath : toScan.append(anInputPath)
+      LatexScanner.saveCache()
+      return dependencies
@@ -0,0 +1,232 @@
+"""
+An embedded (in-process) "mini-farm" of local worker pools.
+
+When no ComputeFarm TaskManager can be contacted, the `workers` section of
+the task descriptions, for example:
+
+    workers:
+      gcc:
+        platform: amd64
+        capabilities:
+          - gcc
+          - cmake
+          - ninja
+        capacity: 8
+
+is used as a collection of local worker pools. Tasks are matched against the
+pools (by platform and by the tools they require) in the same way that
+`WorkerTask.getWorkersFor` matches them against remote workers, and are then
+run (locally) by one of their matching pools.
+
+Each pool has a `capacity` (in cores, defaulting to the number of cores on
+this host). Since all of the pools share this host's cores, if their combined
+capacity exceeds the number of cores, every pool's capacity is scaled down
+(proportionally) so that the cores are not double-booked. A pool admits a task only if the sum of the `estimatedLoad`s of
+its running tasks (including the new one) fits within its capacity (an idle
+pool always admits a task, so that no task can starve). The task waits until
+one of its matching pools can admit it, preferring the least loaded pool.
+
+Only pools whose platform is this host's platform (allowing for the usual
+aliases, so that `amd64` matches `x86_64`) are used. Tools which no pool
+declares as a capability are assumed to be provided by every pool if they can
+be found on this host's PATH.
+
+The mini-farm is only used when it has been enabled. Unless the
+`num_process` (or `par_type`) `doit` options have been configured, `doit` is
+then asked to run enough task threads to fill all of the pools.
+
+The mini-farm is configured by the `localFarm` table of the `build`
+configuration:
+
+- `enabled`: use the `workers` descriptions as local pools (default: false)
+"""
+
+import math
+import os
+import platform
+import shutil
+import threading
+
+from cfdoit.config import Config
+
+cpuAliases = {
+  'amd64'   : 'x86_64',
+  'x64'     : 'x86_64',
+  'arm64'   : 'aarch64',
+  'armv8'   : 'aarch64',
+  'i686'    : 'x86',
+  'i386'    : 'x86'
+}
+
+def normalizePlatform(aPlatform) :
+  """
+  Normalize a platform (`os-cpu` or just `cpu`) into an `os-cpu` platform
+  using the canonical cpu names.
+  """
+  aPlatform = str(aPlatform).lower()
+  if aPlatform == 'any' : return aPlatform
+  if '-' in aPlatform :
+    osType, cpuType = aPlatform.split('-', 1)
+  else :
+    osType, cpuType = platform.system().lower(), aPlatform
+  return f"{osType}-{cpuAliases.get(cpuType, cpuType)}"
+
+def hostPlatform() :
+  return normalizePlatform(platform.system().lower()+'-'+platform.machine().lower())
+
+class LocalPool :
+  """
+  A pool of local workers with a `capacity` (in cores) and `capabilities`.
+  """
+
+  def __init__(self, aName, aDesc) :
+    self.name         = aName
+    self.platform     = normalizePlatform(aDesc.get('platform', hostPlatform()))
+    self.capabilities = list(aDesc.get('capabilities', []))
+    self.capacity     = float(aDesc.get('capacity', os.cpu_count() or 1))
+    self.load         = 0.0
+    self.running      = 0
+
+  def canAdmit(self, estimatedLoad) :
+    return self.running == 0 or self.load + estimatedLoad <= self.capacity
+
+class LocalFarm :
+  """
+  The (process wide) local mini-farm.
+
+  Class variables:
+    pools:     A dict mapping each pool's name to its `LocalPool` (None if the
+               mini-farm is not in use).
+    condition: Signalled whenever a pool's load decreases.
+  """
+
+  pools     = None
+  condition = threading.Condition()
+
+  def farmConfig() :
+    if 'GLOBAL' not in Config.config : return {}
+    return Config.config['GLOBAL'].get('build', {}).get('localFarm', {})
+
+  def install() :
+    """
+    (Re)load the local pools from the `workers` descriptions, returning the
+    worker inventory (platforms, tools, workers) in the same form as a
+    TaskManager's `workerQuery` reply (or None if there are no local pools).
+    """
+    with LocalFarm.condition :
+      LocalFarm.pools = None
+      if not LocalFarm.farmConfig().get('enabled', False) : return None
+      workerDescs = Config.descriptions.get('workers', {})
+      if not isinstance(workerDescs, dict) : return None
+
+      pools = {}
+      for aName, aDesc in workerDescs.items() :
+        aPool = LocalPool(aName, aDesc or {})
+        if aPool.platform != hostPlatform() :
+          print(f"Ignoring the {aName} workers ({aPool.platform}) on this {hostPlatform()} host")
+          continue
+        pools[aName] = aPool
+      if not pools : return None
+      # (the pools share this host's cores)
+      numCores      = os.cpu_count() or 1
+      totalCapacity = sum(aPool.capacity for aPool in pools.values())
+      if numCores < totalCapacity :
+        print(f"Scaling the local pools' capacity ({totalCapacity}) to this host's {numCores} cores")
+        for aPool in pools.values() :
+          aPool.capacity = aPool.capacity * numCores / totalCapacity
+      LocalFarm.pools = pools
+
+    tools = {}
+    for aPool in pools.values() :
+      for aTool in aPool.capabilities :
+        if aTool not in tools : tools[aTool] = []
+        tools[aTool].append(aPool.name)
+    return {
+      'hostTypes' : { hostPlatform() : list(pools.keys()) },
+      'tools'     : tools,
+      'workers'   : {
+        aPool.name : {
+          'platform'     : aPool.platform,
+          'capabilities' : aPool.capabilities,
+          'capacity'     : aPool.capacity
+        } for aPool in pools.values()
+      }
+    }
+
+  def isActive() :
+    return LocalFarm.pools is not None
+
+  def hasPools(someWorkers) :
+    """
+    Return True if any of `someWorkers` is a local pool.
+    """
+    if not LocalFarm.pools : return False
+    return any(aWorker in LocalFarm.pools for aWorker in someWorkers)
+
+  def workersFor(aPlatform, requiredTools=[]) :
+    """
+    Return the names of the pools which can run a task requiring the
+    `aPlatform` platform and the `requiredTools` (or `localWorker` if no pool
+    can).
+    """
+    aPlatform = normalizePlatform(aPlatform)
+    if aPlatform != 'any' and aPlatform != hostPlatform() : return []
+
+    declaredTools = set()
+    for aPool in LocalFarm.pools.values() : declaredTools.update(aPool.capabilities)
+
+    if not isinstance(requiredTools, list) : requiredTools = [ requiredTools ]
+    workersFound = []
+    for aPool in LocalFarm.pools.values() :
+      canRun = True
+      for aTool in requiredTools :
+        if aTool in declaredTools :
+          if aTool not in aPool.capabilities : canRun = False
+        elif not shutil.which(aTool) :
+          canRun = False
+        if not canRun : break
+      if canRun : workersFound.append(aPool.name)
+    if not workersFound : return [ 'localWorker' ]
+    return workersFound
+
+  def admit(someWorkers, estimatedLoad) :
+    """
+    Wait until one of the `someWorkers` pools can admit a task with the
+    `estimatedLoad`, and return the (least loaded) pool which admitted it.
+    """
+    with LocalFarm.condition :
+      while True :
+        candidates = [
+          LocalFarm.pools[aWorker] for aWorker in someWorkers
+          if aWorker in LocalFarm.pools and \
+             LocalFarm.pools[aWorker].canAdmit(estimatedLoad)
+        ]
+        if candidates :
+          aPool = min(candidates, key=lambda aPool : aPool.load / aPool.capacity)
+          aPool.load    += estimatedLoad
+          aPool.running += 1
+          return aPool
+        LocalFarm.condition.wait()
+
+  def release(aPool, estimatedLoad) :
+    with LocalFarm.condition :
+      aPool.load     = max(0.0, aPool.load - estimatedLoad)
+      aPool.running -= 1
+      LocalFarm.condition.notify_all()
+
+  def doitDefaults(cfdoitConfig) :
+    """
+    Return the `doit` (DOIT_CONFIG) defaults required to run tasks
+    concurrently in the local pools (unless `num_process` or `par_type` have
+    been configured in `cfdoitConfig`).
+    """
+    if not LocalFarm.isActive() : return {}
+    gConfig = cfdoitConfig.get('GLOBAL', {})
+    for aKey in [ 'num_process', 'par_type' ] :
+      if aKey in gConfig : return {}
+    # (tasks are admitted with, by default, an estimatedLoad of 0.5)
+    totalCapacity = sum(aPool.capacity for aPool in LocalFarm.pools.values())
+    return {
+      'num_process' : max(1, math.ceil(totalCapacity / 0.5)),
+      'par_type'    : 'thread'
+    }
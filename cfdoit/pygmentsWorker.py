@@ -0,0 +1,181 @@
+"""
+Highlight LaTeX code chunks, in batches, using Pygments in a long-lived pool
+of worker processes.
+
+Running the `pygmentize` command for each code chunk pays the full Python
+interpreter start up, and Pygments lexer import, costs for every chunk. The
+`highlightCodeChunk` task snipet instead uses the `highlightChunk` `doit`
+python action, which submits its chunk to a (process wide) pool of worker
+processes which import Pygments only once. Chunks which are ready to be
+highlighted at the same time (when `doit` runs tasks in threads) are
+highlighted together in batches.
+
+Each `.pygmented.tex` file is only (re)written if its content has changed.
+
+The pool is configured by the `latex` configuration table:
+
+- `pygmentsWorkers`: the number of worker processes (default: the number of
+  cores, at most 4)
+- `pygmentsBatchSize`: the maximum number of chunks in a batch (default: 64)
+
+Pygments is an optional dependency which is only imported by the worker
+processes.
+"""
+
+import concurrent.futures
+import importlib
+import multiprocessing
+import os
+import threading
+
+from doit.exceptions import TaskFailed
+
+from cfdoit.config import Config
+from cfdoit.batching import BatchCoalescer
+
+# The lexers already loaded by this (worker) process
+loadedLexers = {}
+
+def initWorker() :
+  """
+  Import Pygments (once) when each worker process starts.
+  """
+  importlib.import_module('pygments.formatters')
+  importlib.import_module('pygments.lexers')
+
+def getLexer(lexerName, chunkPath, code) :
+  """
+  Return the Pygments lexer named `lexerName` (default: `cpp`). The `auto`
+  lexer is guessed from the chunk's file name (without its `.chunk` suffix),
+  or otherwise from its `code`.
+  """
+  from pygments.lexers import (
+    get_lexer_by_name, get_lexer_for_filename, guess_lexer
+  )
+  from pygments.util import ClassNotFound
+
+  if not lexerName : lexerName = 'cpp'
+  if lexerName != 'auto' :
+    if lexerName not in loadedLexers :
+      loadedLexers[lexerName] = get_lexer_by_name(lexerName)
+    return loadedLexers[lexerName]
+  try :
+    return get_lexer_for_filename(chunkPath.removesuffix('.chunk'))
+  except ClassNotFound :
+    return guess_lexer(code)
+
+def writeIfChanged(aPath, newContent) :
+  """
+  (Atomically) write `newContent` to the file `aPath`, but only if the file's
+  content would change.
+
+  Returns True if the file was written.
+  """
+  try :
+    with open(aPath) as oldFile :
+      if oldFile.read() == newContent : return False
+  except OSError :
+    pass
+  tmpPath = aPath + f".{os.getpid()}.tmp"
+  with open(tmpPath, 'w') as tmpFile :
+    tmpFile.write(newContent)
+  os.replace(tmpPath, aPath)
+  return True
+
+def highlightBatch(someJobs) :
+  """
+  Highlight a batch of code chunks (in a worker process).
+
+  Each job is a (chunkPath, outPath, lexerName) tuple.
+
+  Returns a list of (status, message) tuples, one for each job, where the
+  status is one of `written`, `unchanged` or `failed`.
+  """
+  from pygments import highlight
+  from pygments.formatters import LatexFormatter
+
+  formatter = LatexFormatter()
+  results   = []
+  for chunkPath, outPath, lexerName in someJobs :
+    try :
+      with open(chunkPath) as chunkFile :
+        code = chunkFile.read()
+      newContent = highlight(code, getLexer(lexerName, chunkPath, code), formatter)
+      if writeIfChanged(outPath, newContent) :
+        results.append(('written', None))
+      else :
+        results.append(('unchanged', None))
+    except Exception as err :
+      results.append(('failed', f"{chunkPath}: {repr(err)}"))
+  return results
+
+class PygmentsPool :
+  """
+  The (process wide) pool of Pygments worker processes.
+  """
+
+  pool       = None
+  numWorkers = 1
+  coalescer  = None
+  lock       = threading.Lock()
+
+  def latexConfig() :
+    if 'GLOBAL' not in Config.config : return {}
+    return Config.config['GLOBAL'].get('latex', {})
+
+  def getCoalescer() :
+    """
+    (Lazily) start the worker pool and return the coalescer of chunks.
+    """
+    with PygmentsPool.lock :
+      if PygmentsPool.coalescer is None :
+        latexConfig = PygmentsPool.latexConfig()
+        numWorkers  = latexConfig.get('pygmentsWorkers', 0)
+        if not numWorkers : numWorkers = min(4, os.cpu_count() or 1)
+        batchSize   = latexConfig.get('pygmentsBatchSize', 64)
+        # doit may be running threads, so we do not fork the workers
+        PygmentsPool.numWorkers = numWorkers
+        PygmentsPool.pool = concurrent.futures.ProcessPoolExecutor(
+          max_workers=numWorkers,
+          mp_context=multiprocessing.get_context('spawn'),
+          initializer=initWorker
+        )
+        PygmentsPool.coalescer = BatchCoalescer(
+          PygmentsPool.runBatch,
+          batchSizeFor=lambda aKey : batchSize
+        )
+      return PygmentsPool.coalescer
+
+  def runBatch(aKey, someJobs) :
+    """
+    Split a batch of jobs across the worker processes.
+    """
+    numWorkers = PygmentsPool.numWorkers
+    subBatches = [ someJobs[i::numWorkers] for i in range(numWorkers) ]
+    futures    = []
+    for aSubBatch in subBatches :
+      if aSubBatch : futures.append(PygmentsPool.pool.submit(highlightBatch, aSubBatch))
+    subResults = [ aFuture.result() for aFuture in futures ]
+
+    # re-interleave the results into the original job order
+    results = [ None for aJob in someJobs ]
+    for workerNum, someResults in enumerate(subResults) :
+      for resultNum, aResult in enumerate(someResults) :
+        results[workerNum + resultNum * numWorkers] = aResult
+    return results
+
+def highlightChunk(chunkPath, outPath, lexerName) :
+  """
+  A `doit` python action which highlights the code chunk `chunkPath` into the
+  LaTeX file `outPath` using the Pygments lexer named `lexerName` (`cpp` if
+  `lexerName` is empty, see `getLexer`).
+  """
+  result = PygmentsPool.getCoalescer().submit('pygments', (
+    chunkPath, outPath, lexerName
+  ))
+  if isinstance(result, Exception) :
+    return TaskFailed(f"Could not highlight {chunkPath}: {repr(result)}")
+  status, message = result
+  if status == 'failed' : return TaskFailed(message)
+  print(f"{status} {outPath}")
+  return True
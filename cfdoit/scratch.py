@@ -0,0 +1,276 @@
+"""
+Run local `WorkerTask`s in per-task scratch directories on a (memory
+backed) tmpfs, so that their throwaway intermediates (object files, CMake
+build trees, LaTeX aux files, ...) never touch the (slow) disk.
+
+When the scratch mode is enabled, each local task runs in its own scratch
+directory which mirrors this project's tree:
+
+- real (scratch) directories are created along the paths to the (output)
+  directories of the task's declared `targets`,
+
+- inside the output directories (and their sub-directories) ONLY the task's
+  declared `file_dep` inputs are (symbolically) linked (so that their
+  contents are read, in place, from the disk). The targets, and any other
+  files the task (re)writes there (unity sources, depfiles, aux files, ...),
+  are written into the scratch directory, never into the on-disk tree,
+
+- every other entry of the project's tree (outside of the output
+  directories) is (symbolically) linked.
+
+Undeclared inputs in the output directories are therefore NOT visible to
+the task, and tasks must not modify their declared inputs.
+
+Once the task has succeeded, only its declared targets are moved (or, when
+the scratch directory is on another filesystem, copied and then atomically
+replaced) back into the project's tree. Everything else is discarded along
+with the scratch directory. Tasks should therefore declare every output
+which later tasks need.
+
+Each task reserves part of a memory budget (the scratch space it used the
+last time it ran, or twice the size of its existing targets, but at least
+`minReserveMB`). A task which can not be reserved (the budget is exhausted,
+the tmpfs is full, or one of its targets lies outside of this project's
+tree) simply runs on disk as before. A task which fails because the tmpfs
+filled up is re-run on disk.
+
+The scratch mode is configured by the `scratch` table of the `build`
+configuration:
+
+- `enabled`:        run local tasks in scratch directories (default: false)
+- `dir`:            the directory in which the scratch directories are
+                    created (default: `/dev/shm`, if it exists)
+- `memoryBudgetMB`: the total scratch space all (concurrently running) tasks
+                    may reserve (default: 1024)
+- `minReserveMB`:   the minimum scratch space reserved by each task
+                    (default: 64)
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+from cfdoit.config import Config
+
+class Scratch :
+  """
+  The (process wide) scratch directories of the running local tasks.
+
+  Class variables:
+    reserved:  The number of bytes currently reserved (by running tasks).
+    usedBytes: A dict mapping each task's name to the scratch space (in
+               bytes) it used the last time it ran.
+  """
+
+  reserved  = 0
+  usedBytes = {}
+  lock      = threading.Lock()
+
+  def scratchConfig() :
+    if 'GLOBAL' not in Config.config : return {}
+    return Config.config['GLOBAL'].get('build', {}).get('scratch', {})
+
+  def isEnabled() :
+    return bool(Scratch.scratchConfig().get('enabled', False))
+
+  def scratchRoot() :
+    aDir = Scratch.scratchConfig().get('dir', None)
+    if aDir : return os.path.expanduser(aDir)
+    if os.path.isdir('/dev/shm') : return '/dev/shm'
+    return tempfile.gettempdir()
+
+  def minReserve() :
+    return int(Scratch.scratchConfig().get('minReserveMB', 64) * 1024 * 1024)
+
+  def targetPaths(aTask) :
+    """
+    Return the (normalized) relative paths of the targets of the doit task
+    `aTask` (or None if any target can not be run in a scratch directory).
+    """
+    relPaths = []
+    for aTarget in aTask.targets :
+      relPath = os.path.normpath(os.path.relpath(aTarget))
+      if os.path.isabs(relPath) or relPath.startswith('..') : return None
+      if os.path.isdir(relPath) : return None
+      relPaths.append(relPath)
+    return relPaths
+
+  def inputPaths(aTask) :
+    """
+    Return the (normalized) relative paths of the (in tree) `file_dep`
+    inputs of the doit task `aTask`.
+    """
+    relPaths = []
+    for aDep in aTask.file_dep :
+      relPath = os.path.normpath(os.path.relpath(aDep))
+      if os.path.isabs(relPath) or relPath.startswith('..') : continue
+      relPaths.append(relPath)
+    return relPaths
+
+  def reservationFor(aTask, relPaths) :
+    if aTask.name in Scratch.usedBytes :
+      return max(Scratch.minReserve(), Scratch.usedBytes[aTask.name])
+    targetBytes = 0
+    for relPath in relPaths :
+      if os.path.isfile(relPath) : targetBytes += os.path.getsize(relPath)
+    return max(Scratch.minReserve(), 2 * targetBytes)
+
+  def begin(aTask) :
+    """
+    Create a scratch directory for the doit task `aTask`, returning a dict
+    describing it (or None if the task should run on disk).
+    """
+    if not Scratch.isEnabled() : return None
+    relPaths = Scratch.targetPaths(aTask)
+    if not relPaths : return None
+
+    scratchRoot = Scratch.scratchRoot()
+    budget      = int(Scratch.scratchConfig().get('memoryBudgetMB', 1024) * 1024 * 1024)
+    reservation = Scratch.reservationFor(aTask, relPaths)
+    try :
+      freeBytes = shutil.disk_usage(scratchRoot).free
+    except OSError as err :
+      print(f"Could not use the scratch directory {scratchRoot}")
+      print(repr(err))
+      return None
+    with Scratch.lock :
+      if budget < Scratch.reserved + reservation or freeBytes < reservation :
+        print(f"Running {aTask.name} on disk (the scratch space is exhausted)")
+        return None
+      Scratch.reserved += reservation
+
+    aScratch = {
+      'taskName'    : aTask.name,
+      'targets'     : relPaths,
+      'reservation' : reservation,
+      'dir'         : None
+    }
+    try :
+      aScratch['dir'] = tempfile.mkdtemp(prefix='cfdoit-scratch-', dir=scratchRoot)
+      Scratch.mirrorTree(aScratch['dir'], relPaths, Scratch.inputPaths(aTask))
+    except OSError as err :
+      print(f"Could not create a scratch directory for {aTask.name}")
+      print(repr(err))
+      Scratch.end(aScratch)
+      return None
+    return aScratch
+
+  def mirrorTree(scratchDir, relPaths, depPaths=[]) :
+    """
+    Mirror this project's tree (the current directory) in `scratchDir` for a
+    task with the targets `relPaths` and the (declared) inputs `depPaths`.
+
+    Real (scratch) directories are created along the paths to the targets'
+    (output) directories. Outside of the output directories every other
+    entry is (symbolically) linked, but inside them ONLY the declared inputs
+    are linked, so that nothing the task (re)writes there can reach the
+    on-disk tree.
+    """
+    outputDirs  = set()
+    neededDirs  = set()
+    targetFiles = set(relPaths)
+    for relPath in relPaths :
+      aDir = os.path.dirname(relPath)
+      outputDirs.add(aDir)
+      while aDir :
+        neededDirs.add(aDir)
+        aDir = os.path.dirname(aDir)
+    depFiles = set()
+    for relPath in depPaths :
+      depFiles.add(relPath)
+      aDir = os.path.dirname(relPath)
+      while aDir :
+        neededDirs.add(aDir)
+        aDir = os.path.dirname(aDir)
+
+    def inOutputDir(relDir) :
+      for anOutputDir in outputDirs :
+        if not anOutputDir or relDir == anOutputDir or \
+           relDir.startswith(anOutputDir + os.sep) : return True
+      return False
+
+    def mirrorDir(relDir) :
+      srcDir   = relDir or '.'
+      restrict  = inOutputDir(relDir)
+      for anEntry in os.listdir(srcDir) :
+        relPath = os.path.join(relDir, anEntry)
+        dstPath = os.path.join(scratchDir, relPath)
+        if relPath in targetFiles : continue
+        isRealDir = os.path.isdir(relPath) and not os.path.islink(relPath)
+        if relPath in neededDirs and isRealDir :
+          os.mkdir(dstPath)
+          mirrorDir(relPath)
+        elif relPath in depFiles or not restrict :
+          os.symlink(os.path.abspath(relPath), dstPath)
+        # (anything else in an output directory is NOT mirrored)
+    mirrorDir('')
+
+    # (output directories which do not yet exist are created in scratch)
+    for aDir in outputDirs :
+      if aDir : os.makedirs(os.path.join(scratchDir, aDir), exist_ok=True)
+
+  def exhausted(aScratch) :
+    """
+    Return True if the scratch filesystem (used by `aScratch`) is (nearly)
+    full.
+    """
+    try :
+      return shutil.disk_usage(aScratch['dir']).free < Scratch.minReserve()
+    except OSError :
+      return True
+
+  def moveTargets(aScratch) :
+    """
+    Atomically move (or copy) the targets of `aScratch` back into this
+    project's tree.
+
+    Returns an error message (or None if all of the created targets were
+    moved).
+    """
+    aScratch['usedBytes'] = Scratch.usedSpace(aScratch)
+    for relPath in aScratch['targets'] :
+      srcPath = os.path.join(aScratch['dir'], relPath)
+      if not os.path.lexists(srcPath) : continue  # (not created in scratch)
+      try :
+        if os.path.dirname(relPath) :
+          os.makedirs(os.path.dirname(relPath), exist_ok=True)
+        try :
+          os.replace(srcPath, relPath)
+        except OSError :
+          # (the scratch directory is on another filesystem)
+          tmpPath = relPath + f".cfdoit-{os.getpid()}-{threading.get_ident()}.tmp"
+          shutil.copy2(srcPath, tmpPath)
+          os.replace(tmpPath, relPath)
+      except OSError as err :
+        return f"could not move the target {relPath} out of scratch: {repr(err)}"
+    return None
+
+  def usedSpace(aScratch) :
+    """
+    Return the space (in bytes) used by the (non mirrored) files in the
+    scratch directory of `aScratch`.
+    """
+    usedBytes = 0
+    for aDir, someDirs, someFiles in os.walk(aScratch['dir']) :
+      for aFile in someFiles :
+        try :
+          aStat = os.lstat(os.path.join(aDir, aFile))
+        except OSError :
+          continue
+        if stat.S_ISREG(aStat.st_mode) : usedBytes += aStat.st_size
+    return usedBytes
+
+  def end(aScratch) :
+    """
+    Remove the scratch directory of `aScratch` and release its reservation.
+    """
+    if aScratch['dir'] :
+      usedBytes = aScratch.get('usedBytes', None)
+      if usedBytes is None : usedBytes = Scratch.usedSpace(aScratch)
+      with Scratch.lock :
+        Scratch.usedBytes[aScratch['taskName']] = usedBytes
+      shutil.rmtree(aScratch['dir'], ignore_errors=True)
+    with Scratch.lock :
+      Scratch.reserved = max(0, Scratch.reserved - aScratch['reservation'])
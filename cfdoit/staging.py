@@ -0,0 +1,256 @@
+"""
+Stage a remote task's input files to (and its targets back from) workers
+which do NOT share this project's filesystem.
+
+Normally a remote worker runs a task in the same tree (shared using, for
+example, NFS) as `cfdoit` (see `WorkerTask.baseDirectory`). When staging is
+enabled (the `staging` key of the `taskManager` configuration), a remote task
+instead runs in the worker's (local) scratch space:
+
+- Before the task is sent, each of the task's `file_dep` inputs (inside this
+  project's tree) is hashed (SHA-256) and the TaskManager is asked (using a
+  `blobQuery`) which of these content-addressed blobs it does not already
+  hold. Only those blobs are sent (compressed, in `blobPut` requests). Blobs
+  known to be held by the TaskManager are remembered, so they are not even
+  queried again.
+
+- The `taskRequest` then carries a `staging` dict listing the `inputs`
+  (relative path to blob hash), the `targets` to be pulled back, and the
+  blob hashes of the current (local) copies of any targets (`bases`).
+
+- Once the task has run, the TaskManager sends one `target` message for
+  each target, containing either its (compressed) `data` or, when the worker
+  holds the target's `base` blob, a `delta` against that base: a list of
+  (aligned, `blockSize` byte) blocks, each either the index of a block of the
+  base (which is unchanged) or the (compressed) data of the new block. Large
+  artifacts which change only a little (libraries, archives, ...) are
+  therefore pulled back cheaply.
+
+- Each target is verified (against its hash) and then atomically replaced.
+
+The staging is configured by the `taskManager` configuration:
+
+- `staging`:             enable the staging (default: false)
+- `stagingBlockSize`:    the delta transfer block size (default: 65536)
+- `stagingMaxPutBytes`:  the maximum (uncompressed) size of one `blobPut`
+                         request (default: 8 MiB)
+"""
+
+import base64
+import hashlib
+import os
+import threading
+import zlib
+
+from cfdoit.config import Config
+from cfdoit.computeFarmTools import tcpTMRequestReply
+
+def blobHash(someBytes) :
+  return hashlib.sha256(someBytes).hexdigest()
+
+def encodeBytes(someBytes) :
+  return base64.b64encode(zlib.compress(someBytes)).decode()
+
+def decodeBytes(someText) :
+  return zlib.decompress(base64.b64decode(someText))
+
+def blockDelta(baseBytes, newBytes, blockSize) :
+  """
+  Return the delta (list) which rebuilds `newBytes` from `baseBytes`: each
+  (`blockSize`) block of `newBytes` is either the (int) index of an identical
+  block of `baseBytes`, or the (encoded) block itself.
+  """
+  baseBlocks = {}
+  for anIndex in range(0, (len(baseBytes) + blockSize - 1) // blockSize) :
+    aBlock = baseBytes[anIndex*blockSize:(anIndex+1)*blockSize]
+    baseBlocks.setdefault(blobHash(aBlock), anIndex)
+  delta = []
+  for anOffset in range(0, len(newBytes), blockSize) :
+    aBlock = newBytes[anOffset:anOffset+blockSize]
+    anIndex = baseBlocks.get(blobHash(aBlock), None)
+    if anIndex is not None : delta.append(anIndex)
+    else                   : delta.append(encodeBytes(aBlock))
+  return delta
+
+def applyDelta(baseBytes, delta, blockSize) :
+  """
+  Rebuild (and return) the bytes described by `delta` (see `blockDelta`)
+  from `baseBytes`.
+  """
+  someBlocks = []
+  for anItem in delta :
+    if isinstance(anItem, int) :
+      someBlocks.append(baseBytes[anItem*blockSize:(anItem+1)*blockSize])
+    else :
+      someBlocks.append(decodeBytes(anItem))
+  return b"".join(someBlocks)
+
+class Staging :
+  """
+  The (process wide) staging of remote tasks' inputs and targets.
+
+  Class variables:
+    hashCache:  A dict mapping each hashed path to its (mtime, size, hash).
+    knownBlobs: The set of the blob hashes the TaskManager is known to hold.
+  """
+
+  hashCache  = {}
+  knownBlobs = set()
+  lock       = threading.Lock()
+
+  def isEnabled() :
+    if 'GLOBAL' not in Config.config : return False
+    tmConfig = Config.config['GLOBAL'].get('taskManager', {})
+    return bool(tmConfig.get('staging', False))
+
+  def fileHash(aPath) :
+    """
+    Return the blob hash of the file `aPath` (rehashing the file only if it
+    has changed since it was last hashed).
+    """
+    aStat = os.stat(aPath)
+    aStamp = (aStat.st_mtime_ns, aStat.st_size)
+    with Staging.lock :
+      cached = Staging.hashCache.get(aPath, None)
+    if cached and cached[0] == aStamp : return cached[1]
+    with open(aPath, 'rb') as aFile :
+      aHash = blobHash(aFile.read())
+    with Staging.lock :
+      Staging.hashCache[aPath] = (aStamp, aHash)
+    return aHash
+
+  def stagedPath(aPath) :
+    """
+    Return the (normalized) relative path of `aPath` in the staged tree (or
+    None if `aPath` is outside this project's tree, and so is assumed to be
+    provided by the worker, for example a system header).
+    """
+    relPath = os.path.normpath(os.path.relpath(aPath))
+    if os.path.isabs(relPath) or relPath.startswith('..') : return None
+    return relPath
+
+  def tmRequest(aType, someFields) :
+    tmConfig = Config.config['GLOBAL']['taskManager']
+    aRequest = {
+      'host'           : tmConfig['host'],
+      'port'           : tmConfig['port'],
+      'type'           : aType,
+      'connectTimeOut' : tmConfig['connectTimeOut'],
+      'sendTimeOut'    : tmConfig['sendTimeOut'],
+      'readTimeOut'    : tmConfig['sendTimeOut']
+    }
+    aRequest.update(someFields)
+    return tcpTMRequestReply(aRequest)
+
+  def uploadBlobs(someBlobs) :
+    """
+    Send the TaskManager those of the `someBlobs` (dict of hash to path) it
+    does not already hold.
+
+    Returns False if the blobs could not be sent.
+    """
+    with Staging.lock :
+      toQuery = [ aHash for aHash in someBlobs if aHash not in Staging.knownBlobs ]
+    if not toQuery : return True
+    aReply = Staging.tmRequest('blobQuery', { 'hashes' : toQuery })
+    if aReply is None or 'missing' not in aReply : return False
+
+    maxPutBytes = Config.config['GLOBAL']['taskManager']['stagingMaxPutBytes']
+    toPut    = []
+    putBytes = 0
+    def putBlobs() :
+      if not toPut : return True
+      aReply = Staging.tmRequest('blobPut', { 'blobs' : toPut })
+      return aReply is not None and aReply.get('stored', -1) == len(toPut)
+    for aHash in aReply['missing'] :
+      if aHash not in someBlobs : continue
+      with open(someBlobs[aHash], 'rb') as aFile :
+        someBytes = aFile.read()
+      if blobHash(someBytes) != aHash : return False  # (changed while staging)
+      toPut.append({ 'hash' : aHash, 'data' : encodeBytes(someBytes) })
+      putBytes += len(someBytes)
+      if maxPutBytes <= putBytes :
+        if not putBlobs() : return False
+        toPut    = []
+        putBytes = 0
+    if not putBlobs() : return False
+    print(f"Staged {len(aReply['missing'])} of {len(someBlobs)} input blobs")
+
+    with Staging.lock : Staging.knownBlobs.update(toQuery)
+    return True
+
+  def stageTask(aTask) :
+    """
+    Stage the inputs of the doit task `aTask`, returning the `staging` dict
+    of its `taskRequest` (or None if its inputs could not be staged).
+    """
+    tmConfig = Config.config['GLOBAL']['taskManager']
+    inputs = {}
+    blobs  = {}
+    try :
+      for aPath in sorted(aTask.file_dep) :
+        relPath = Staging.stagedPath(aPath)
+        if relPath is None : continue
+        aHash = Staging.fileHash(aPath)
+        inputs[relPath] = aHash
+        blobs[aHash]    = aPath
+    except OSError as err :
+      print(f"Could not stage the inputs of {aTask.name}")
+      print(repr(err))
+      return None
+    if not Staging.uploadBlobs(blobs) : return None
+
+    targets = []
+    bases   = {}
+    for aTarget in aTask.targets :
+      relPath = Staging.stagedPath(aTarget)
+      if relPath is None : continue
+      targets.append(relPath)
+      if os.path.isfile(aTarget) : bases[relPath] = Staging.fileHash(aTarget)
+    return {
+      'inputs'    : inputs,
+      'targets'   : targets,
+      'bases'     : bases,
+      'blockSize' : tmConfig['stagingBlockSize']
+    }
+
+  def writeTargets(aStaging, someTargetMsgs) :
+    """
+    Verify and (atomically) write the (staged) targets described in the
+    `target` messages `someTargetMsgs`.
+
+    Returns an error message (or None if all of the targets were written).
+    """
+    blockSize = aStaging['blockSize']
+    received  = {}
+    for aMsg in someTargetMsgs :
+      relPath = aMsg['target']
+      if relPath not in aStaging['targets'] : continue
+      try :
+        if 'delta' in aMsg :
+          with open(relPath, 'rb') as aFile :
+            baseBytes = aFile.read()
+          if blobHash(baseBytes) != aMsg.get('base', None) :
+            return f"the local copy of {relPath} is not the base of its delta"
+          someBytes = applyDelta(baseBytes, aMsg['delta'], blockSize)
+        else :
+          someBytes = decodeBytes(aMsg.get('data', ''))
+      except Exception as err :
+        return f"could not decode the target {relPath}: {repr(err)}"
+      if blobHash(someBytes) != aMsg.get('hash', None) :
+        return f"the target {relPath} is corrupt"
+      received[relPath] = (someBytes, aMsg['hash'])
+
+    missing = [ relPath for relPath in aStaging['targets'] if relPath not in received ]
+    if missing : return f"the targets {', '.join(missing)} were not returned"
+
+    for relPath, (someBytes, aHash) in received.items() :
+      if os.path.dirname(relPath) :
+        os.makedirs(os.path.dirname(relPath), exist_ok=True)
+      tmpPath = relPath + f".cfdoit-{os.getpid()}-{threading.get_ident()}.tmp"
+      with open(tmpPath, 'wb') as aFile :
+        aFile.write(someBytes)
+      os.replace(tmpPath, relPath)
+    with Staging.lock :
+      Staging.knownBlobs.update(aHash for someBytes, aHash in received.values())
+    return None
@@ -4,6 +4,7 @@ data to automatically generate the required tasks.
 """
 
 import copy
+import json
 import os
 #import sys
 import yaml
@@ -16,17 +17,30 @@ from cfdoit.envHelpers import (
   expandEnvInStr,
   expandEnvInEnvironment,
   expandEnvInActions, 
+  expandEnvInPythonActions,
   expandEnvInUptodates,
-  expandEnvInList
+  expandEnvInList,
+  minimalEnvironment
 )
 
+from cfdoit.depIndex import DependencyIndex
 from cfdoit.workerTasks import WorkerTask
+from cfdoit.unityBuilds import planUnityBuilds
 
 moduleVerbose = True
 # moduleVerbose = False
 
 environments = {}
 
+# The (doit task name, description) of the shared (sub)tasks which have
+# already been generated, keyed by (platform, taskSnipet, taskName), see
+# `gen_SharedTasksFromRootTask`.
+sharedRootTasks = {}
+
+# The tasks generated for each root task (in long-lived processes), keyed by
+# (platform, rootType, taskName), see `gen_CachedTasksFromRootTasks`.
+rootTaskCache = {}
+
 def buildTasksFromDef(osType, aName, aDef, theEnv, theTasks) :
   """
   The core task generator method which recursively generates tasks given a tree
@@ -83,24 +97,39 @@ def buildTasksFromDef(osType, aName, aDef, theEnv, theTasks) :
 
   estimatedLoad = 0.5
   if 'estimatedLoad' in aDef : estimatedLoad = aDef['estimatedLoad']
+  jobServerLoad = None
+  if 'jobServerLoad' in aDef : jobServerLoad = aDef['jobServerLoad']
+  batchable = False
+  if 'batchable' in aDef : batchable = aDef['batchable']
 
   if 'actions' in aDef :
     theActions = expandEnvInActions(aName, aDef['actions'], theEnv)
     if 'tools' not in aDef : aDef['tools'] = []
     if 'useWorkerTask' in aDef :
+      # only the (shared, frozen) part of theEnv which the actions need is
+      # kept (and sent to the workers), see `minimalEnvironment`
+      exportKeys = aDef.get('exportEnvironment', [])
+      if exportKeys is not True :
+        exportKeys = WorkerTask.identityEnvKeys + list(exportKeys)
       curTask['actions'] = [
         WorkerTask({
           'actions'          : theActions,
-          'environment'      : theEnv,
+          'environment'      : minimalEnvironment(aDef['actions'], theEnv, exportKeys),
           'tools'            : requiredTools,
           'workers'          : availableWorkers,
           'baseDir'          : baseDir,
           'requiredPlatform' : requiredPlatform,
-          'estimatedLoad'    : estimatedLoad
+          'estimatedLoad'    : estimatedLoad,
+          'jobServerLoad'    : jobServerLoad,
+          'batchable'        : batchable
         })
       ]
     else: 
       curTask['actions'] = theActions
+  elif 'pythonActions' in aDef :
+    curTask['actions'] = expandEnvInPythonActions(
+      aName, aDef['pythonActions'], theEnv
+    )
   
   if 'uptodates' in aDef :
     curTask['uptodate'] = expandEnvInUptodates(aName, aDef['uptodates'], theEnv)
@@ -170,6 +199,101 @@ def gen_TasksFromRootTask(platform, taskName, taskDef, theTasks) :
   if 'doitTaskName' in theEnv : return theEnv['doitTaskName']
   return None
 
+def gen_SharedTasksFromRootTask(platform, taskName, taskDef, theTasks) :
+  """
+  Generate the doit tasks required to build a root task which may be shared
+  by (referenced from) many other tasks, for example a diagram used by many
+  LaTeX documents.
+
+  The tasks are only generated the first time a given (platform, taskSnipet,
+  taskName) is requested, later requests simply return the (registered) doit
+  task name. Since all of these requests share ONE doit task, a later request
+  whose description (for example the `environment` of a code chunk) differs
+  from the first raises a ValueError.
+  """
+  aKey    = (platform, taskDef.get('taskSnipet', None), taskName)
+  aDefKey = json.dumps(taskDef, sort_keys=True, default=str)
+  if aKey not in sharedRootTasks :
+    sharedRootTasks[aKey] = (
+      gen_TasksFromRootTask(platform, taskName, taskDef, theTasks), aDefKey
+    )
+  doitTaskName, sharedDefKey = sharedRootTasks[aKey]
+  if sharedDefKey != aDefKey :
+    raise ValueError(
+      f"The shared task {taskName} ({aKey[1]} on {platform}) is requested with conflicting descriptions: {sharedDefKey} and {aDefKey}"
+    )
+  return doitTaskName
+
+def clearRootTaskCache() :
+  """
+  Forget all of the (cached) root tasks (for example when the configuration or
+  the worker inventory changes).
+  """
+  rootTaskCache.clear()
+
+def invalidateRootTasksFor(somePaths) :
+  """
+  Forget the (cached) root tasks which generated any task with a file
+  dependency in `somePaths` (since the generation of, for example, LaTeX
+  documents depends upon their sources).
+  """
+  somePaths = set(os.path.normpath(aPath) for aPath in somePaths)
+  for aKey in list(rootTaskCache.keys()) :
+    for aTask in rootTaskCache[aKey]['tasks'] :
+      fileDeps = aTask.get('file_dep', [])
+      if any(os.path.normpath(aDep) in somePaths for aDep in fileDeps) :
+        del rootTaskCache[aKey]
+        break
+
+def gen_CachedTasksFromRootTasks(someRootTasks, theTasks) :
+  """
+  Generate the doit tasks required to build each of the (platform, rootType,
+  taskName, taskDef) root tasks in `someRootTasks`, reusing the tasks
+  generated (by this process) for any root task whose (platform specific)
+  description has not changed.
+
+  The cached root tasks are replayed first, so that the shared (sub)tasks
+  they generated are registered before any root task is (re)generated.
+
+  Returns the list of the root tasks' doit task names.
+  """
+  toGenerate = []
+  for aPlatform, aRootType, aTaskName, aTaskDef in someRootTasks :
+    aKey   = (aPlatform, aRootType, aTaskName)
+    defKey = json.dumps(aTaskDef, sort_keys=True, default=str)
+    cached = rootTaskCache.get(aKey, None)
+    if cached and cached['defKey'] == defKey :
+      theTasks.extend(cached['tasks'])
+      sharedRootTasks.update(cached['shared'])
+    else :
+      toGenerate.append((aKey, defKey, aTaskDef))
+
+  for aKey, defKey, aTaskDef in toGenerate :
+    aPlatform, aRootType, aTaskName = aKey
+    sharedBefore = set(sharedRootTasks.keys())
+    firstTask    = len(theTasks)
+    theTaskName  = gen_TasksFromRootTask(
+      aPlatform, aTaskName, copy.deepcopy(aTaskDef), theTasks
+    )
+    rootTaskCache[aKey] = {
+      'defKey'       : defKey,
+      'doitTaskName' : theTaskName,
+      'tasks'        : theTasks[firstTask:],
+      'shared'       : {
+        aSharedKey : aSharedName
+        for aSharedKey, aSharedName in sharedRootTasks.items()
+        if aSharedKey not in sharedBefore
+      }
+    }
+    if moduleVerbose : print("")
+
+  allTaskNames = []
+  for aPlatform, aRootType, aTaskName, aTaskDef in someRootTasks :
+    aKey = (aPlatform, aRootType, aTaskName)
+    if aKey in rootTaskCache and rootTaskCache[aKey]['doitTaskName'] :
+      allTaskNames.append(rootTaskCache[aKey]['doitTaskName'])
+  return allTaskNames
+
 def task_genTasks() :
   """
   ComputeFarm build task.
@@ -182,30 +306,27 @@ def task_genTasks() :
 
   theTasks     = []
   allTaskNames = []
+  sharedRootTasks.clear()
 
   buildConf = Config.config['GLOBAL']['build']
   platforms = []
   if 'platforms' in buildConf :
     platforms.extend(buildConf['platforms'])
   print(platforms)
+  rootTasks = []
   for aPlatform in platforms :
     if not WorkerTask.canBuildOn(aPlatform) : continue
     
     if 'packages' in projDesc :
       for aPkgName, aPkgDef in projDesc['packages'].items() :
-        theTaskName = gen_TasksFromRootTask(
-          aPlatform, aPkgName, copy.deepcopy(aPkgDef), theTasks
-        )
-        if theTaskName : allTaskNames.append(theTaskName)
-        if moduleVerbose : print("")
+        rootTasks.append((aPlatform, 'packages', aPkgName, aPkgDef))
 
     if 'projects' in projDesc :
-      for aProjName, aProjDef in projDesc['projects'].items() :
-        theTaskName = gen_TasksFromRootTask(
-          aPlatform, aProjName, copy.deepcopy(aProjDef), theTasks
-        )
-        if theTaskName : allTaskNames.append(theTaskName)
-        if moduleVerbose : print("")
+      projects = planUnityBuilds(aPlatform, projDesc['projects'])
+      for aProjName, aProjDef in projects.items() :
+        rootTasks.append((aPlatform, 'projects', aProjName, aProjDef))
+
+  allTaskNames.extend(gen_CachedTasksFromRootTasks(rootTasks, theTasks))
 
   if allTaskNames : 
     theTasks.append({
@@ -227,6 +348,10 @@ def task_genTasks() :
         'task_dep' : someSubTasks
       })
       
+  # persist the reverse-dependency index for `cfdoit affected`
+  stateDir = buildConf.get('stateDir', '.cfdoit')
+  DependencyIndex(theTasks).save(DependencyIndex.indexPath(stateDir))
+
   if moduleVerbose :
     print("---------------------------------------------------------------------")
 
@@ -0,0 +1,167 @@
+"""
+A persistent record of how long each `cfdoit` task took to run, and of which
+(remote) workers recently ran the tasks of each root task (package, project,
+...).
+
+The history is kept (as JSON) in the `taskHistory.json` file located in the
+`cfdoit` state directory (the `stateDir` key of the `build` configuration,
+which defaults to `.cfdoit`).
+
+Since `doit` can run tasks in threads (or processes), all access to the history
+is protected by a lock, and the history is merged (rather than overwritten)
+with any history saved by other processes when it is saved.
+
+The workers are recorded under each root task's "affinity key" (for example
+`root:linux-x86_64:xeus`, see `WorkerTask.affinityKey`), in the same history
+(so that they are saved and merged in the same way).
+"""
+
+import atexit
+import json
+import os
+import threading
+
+from cfdoit.config import Config
+
+# the maximum number of durations remembered for any one task
+maxDurations = 20
+
+# the maximum number of (distinct) workers remembered for any one root task
+maxWorkers = 3
+
+def percentileOf(someValues, aPercentile) :
+  """
+  Return the `aPercentile` (0-100) of the list of numbers `someValues`
+  (using the "nearest rank" method). Returns None if `someValues` is empty.
+  """
+  if not someValues : return None
+  sortedValues = sorted(someValues)
+  rank = int(round((aPercentile / 100.0) * (len(sortedValues) - 1)))
+  rank = max(0, min(rank, len(sortedValues) - 1))
+  return sortedValues[rank]
+
+class TaskHistory :
+  """
+  A global record of the durations of previously run tasks.
+
+  Class variables:
+    history: A dict mapping each task name to a dict containing the
+             `durations` (list of seconds) of the most recent runs.
+
+    lock:    A lock protecting the history from concurrent threads.
+  """
+
+  history  = None
+  changed  = {}
+  lock     = threading.Lock()
+
+  def historyPath() :
+    """
+    Return the path to the (JSON) history file.
+    """
+    stateDir = '.cfdoit'
+    if 'GLOBAL' in Config.config :
+      if 'build' in Config.config['GLOBAL'] :
+        bConfig = Config.config['GLOBAL']['build']
+        if 'stateDir' in bConfig : stateDir = bConfig['stateDir']
+    return os.path.join(stateDir, 'taskHistory.json')
+
+  def loadHistoryFile() :
+    """
+    Load (and return) the history saved in the history file (if any).
+    """
+    historyPath = TaskHistory.historyPath()
+    if not os.path.exists(historyPath) : return {}
+    try :
+      with open(historyPath) as historyFile :
+        return json.load(historyFile)
+    except Exception as err :
+      print(f"Could not load the task history from {historyPath}")
+      print(repr(err))
+    return {}
+
+  def load() :
+    """
+    (Lazily) load the history. MUST be called with the lock held.
+    """
+    if TaskHistory.history is None :
+      TaskHistory.history = TaskHistory.loadHistoryFile()
+      atexit.register(TaskHistory.save)
+
+  def save() :
+    """
+    Merge any changed task histories into the history file.
+    """
+    with TaskHistory.lock :
+      if not TaskHistory.changed : return
+      savedHistory = TaskHistory.loadHistoryFile()
+      for aTaskName in TaskHistory.changed :
+        savedHistory[aTaskName] = TaskHistory.history[aTaskName]
+      historyPath = TaskHistory.historyPath()
+      try :
+        os.makedirs(os.path.dirname(historyPath), exist_ok=True)
+        tmpPath = historyPath + f".{os.getpid()}.tmp"
+        with open(tmpPath, 'w') as historyFile :
+          json.dump(savedHistory, historyFile, indent=1, sort_keys=True)
+        os.replace(tmpPath, historyPath)
+        TaskHistory.changed = {}
+      except Exception as err :
+        print(f"Could not save the task history to {historyPath}")
+        print(repr(err))
+
+  def recordDuration(taskName, seconds) :
+    """
+    Record that the task `taskName` took `seconds` to run.
+    """
+    with TaskHistory.lock :
+      TaskHistory.load()
+      if taskName not in TaskHistory.history :
+        TaskHistory.history[taskName] = {}
+      taskHistory = TaskHistory.history[taskName]
+      if 'durations' not in taskHistory : taskHistory['durations'] = []
+      taskHistory['durations'].append(round(seconds, 3))
+      del taskHistory['durations'][:-maxDurations]
+      TaskHistory.changed[taskName] = True
+
+  def recordWorker(affinityKey, workerName) :
+    """
+    Record that the worker `workerName` (most recently) ran a task of the root
+    task with the `affinityKey`.
+    """
+    with TaskHistory.lock :
+      TaskHistory.load()
+      if affinityKey not in TaskHistory.history :
+        TaskHistory.history[affinityKey] = {}
+      keyHistory = TaskHistory.history[affinityKey]
+      someWorkers = [ workerName ]
+      for aWorker in keyHistory.get('workers', []) :
+        if aWorker != workerName : someWorkers.append(aWorker)
+      if someWorkers[:maxWorkers] == keyHistory.get('workers', None) : return
+      keyHistory['workers'] = someWorkers[:maxWorkers]
+      TaskHistory.changed[affinityKey] = True
+
+  def workersFor(affinityKey) :
+    """
+    Return the workers (most recent first) which ran the tasks of the root
+    task with the `affinityKey`.
+    """
+    with TaskHistory.lock :
+      TaskHistory.load()
+      if affinityKey not in TaskHistory.history : return []
+      return list(TaskHistory.history[affinityKey].get('workers', []))
+
+  def durationsFor(taskName) :
+    """
+    Return the list of (recent) durations recorded for the task `taskName`.
+    """
+    with TaskHistory.lock :
+      TaskHistory.load()
+      if taskName not in TaskHistory.history : return []
+      return list(TaskHistory.history[taskName].get('durations', []))
+
+  def expectedDuration(taskName, aPercentile=50) :
+    """
+    Return the `aPercentile` of the recorded durations of the task `taskName`
+    (or None if the task has never been run).
+    """
+    return percentileOf(TaskHistory.durationsFor(taskName), aPercentile)
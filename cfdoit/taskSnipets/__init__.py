@@ -63,7 +63,7 @@ task's `taskSnipet` key. The resulting merged dict/object is expanded by the
    following keys:
 
    - doitTaskName
-   - actions
+   - actions (or pythonActions)
    - uptodates
    - targest
    - fileDependencies
@@ -74,6 +74,11 @@ task's `taskSnipet` key. The resulting merged dict/object is expanded by the
    collection of `actions`, then the `buildTasksFromDef` wraps these values up
    into a `doit` task dict/object which is then added to the `theTasks` list.
 
+   The (optional) `pythonActions` key provides `doit` python actions, as a
+   list of (callable, list of string arguments) tuples, which are run locally
+   by the `cfdoit` process itself. They are only used if there are no
+   (shell) `actions`.
+
 Once this recursive depth first, top to bottom, build sequence is complete, the
 `task_genTasks` method walks through the `theTasks` list and creates a `doit`
 task for each task definition.
@@ -4,6 +4,7 @@ Task snipets used for compiling, linking and then installing ANSI-C source code.
 import os
 #import yaml
 
+from cfdoit.config import Config
 from cfdoit.taskSnipets.dsl import ( TaskSnipets )
 from cfdoit.envHelpers import ( 
   expandEnvInStr, expandEnvInList, findEnvInSnipetDef
@@ -76,6 +77,111 @@ def collectAnsiCDependencies(snipetName, snipetDef, theEnv) :
 
   return (pkgDeps, pkgLibs, systemLibs, cObjs, pkgIncludes, srcIncludes)
 
+def collectPrecompiledHeaders(snipetName, snipetDef, theEnv) :
+  """
+  Collect the `precompiledHeader(s)` (the names of `gppPrecompiledHeader`
+  tasks) from the `dependencies` of the `snipetDef` parameter.
+
+  Returns the `pch` task dependencies, the `.gch` file dependencies and the
+  compiler flags required to use these precompiled headers.
+  """
+  pchDeps  = []
+  pchFiles = []
+  pchFlags = []
+  if 'dependencies' in snipetDef :
+    deps = snipetDef['dependencies']
+
+    pchNames = []
+    if 'precompiledHeader'  in deps : pchNames.extend(deps['precompiledHeader'])
+    if 'precompiledHeaders' in deps : pchNames.extend(deps['precompiledHeaders'])
+    for aPchName in pchNames :
+      pchDeps.append(f"pch-{aPchName}.{theEnv['platform']}")
+      pchFiles.append(f"${{buildDir}}/pch/{aPchName}.hpp.gch")
+      pchFlags.append(f"-include ${{buildDir}}/pch/{aPchName}.hpp")
+    if pchFlags : pchFlags.append('-Winvalid-pch')
+
+  pchDeps  = expandEnvInList(snipetName, pchDeps,  theEnv)
+  pchFiles = expandEnvInList(snipetName, pchFiles, theEnv)
+  pchFlags = expandEnvInList(snipetName, pchFlags, theEnv)
+
+  return (pchDeps, pchFiles, pchFlags)
+
+def collectLinkOptions(snipetDef) :
+  """
+  Collect the link options from the `link` table of the `build` configuration
+  overridden by any `link` key in the `snipetDef` parameter.
+
+  The link options are:
+
+  - `mode`: `default` or `fast`
+  - `linker`: (fast mode) `auto` (probe for `mold` then `lld`), or the name
+    of the linker to use (`mold`, `lld`, `gold`, `bfd`)
+  - `splitDwarf`: (fast mode) compile with `-gsplit-dwarf`
+  - `gdbIndex`: (fast mode) link with `--gdb-index`
+  - `thinArchives`: (fast mode) create thin archives for `intermediate`
+    static libraries
+  """
+  linkOptions = {
+    'mode'         : 'default',
+    'linker'       : 'auto',
+    'splitDwarf'   : False,
+    'gdbIndex'     : False,
+    'thinArchives' : True
+  }
+  if 'GLOBAL' in Config.config :
+    if 'build' in Config.config['GLOBAL'] :
+      if 'link' in Config.config['GLOBAL']['build'] :
+        linkOptions.update(Config.config['GLOBAL']['build']['link'])
+  if 'link' in snipetDef and isinstance(snipetDef['link'], dict) :
+    linkOptions.update(snipetDef['link'])
+  return linkOptions
+
+def setCompileFlags(snipetName, snipetDef, theEnv) :
+  """
+  Set the default CFLAGS and INCLUDES (if they have not already been set).
+
+  In the fast link mode, with `splitDwarf`, the debug information is split
+  into `.dwo` files (so that the linker has much less to do).
+  """
+  if 'CFLAGS' not in theEnv :
+    theEnv['CFLAGS'] = "-Wall"
+    linkOptions = collectLinkOptions(snipetDef)
+    if linkOptions['mode'] == 'fast' and linkOptions['splitDwarf'] :
+      theEnv['CFLAGS'] += " -g -gsplit-dwarf"
+  if 'INCLUDES' not in theEnv :
+    theEnv['INCLUDES'] = expandEnvInStr(snipetName,"-I$pkgIncludes -I$srcIncludes", theEnv)
+
+def splitDwarfTargets(snipetDef, theEnv) :
+  """
+  Return the (`.dwo`) debug information targets written (alongside the
+  object file `out`) when compiling with `-gsplit-dwarf`.
+  """
+  if '-gsplit-dwarf' not in theEnv.get('CFLAGS', '').split() : return []
+  anObj = findEnvInSnipetDef('out', snipetDef)
+  return [ os.path.splitext(anObj)[0] + '.dwo' ]
+
+def linkerFlags(linkOptions, aGpp) :
+  """
+  Return the g++ flags which select (and configure) the linker.
+
+  The `auto` linker is probed for, by the shell, on the worker which runs the
+  link, by asking the compiler `aGpp` to run each linker (falling back to the
+  default linker).
+  """
+  if linkOptions['mode'] != 'fast' : return ""
+  gdbIndex = ""
+  if linkOptions['gdbIndex'] : gdbIndex = " -Wl,--gdb-index"
+  aLinker = linkOptions['linker']
+  if aLinker == 'auto' :
+    def probe(aName) :
+      return f"{aGpp} -fuse-ld={aName} -Wl,--version >/dev/null 2>&1"
+    return (
+      "$(" + probe('mold') + " && echo -fuse-ld=mold" + gdbIndex +
+      " || ( " + probe('lld') + " && echo -fuse-ld=lld" + gdbIndex + " ) )"
+    )
+  if aLinker == 'bfd' : return "-fuse-ld=bfd"  # bfd has no --gdb-index
+  return f"-fuse-ld={aLinker}" + gdbIndex
+
 @TaskSnipets.addSnipet('linux', 'srcBase', {
   'snipetDeps'  : [ 'buildBase'    ],
   'environment' : [
@@ -106,9 +212,11 @@ def srcBase(snipetDef, theEnv, theTasks) :
   ],
   'actions' : [ 
     'mkdir -p $buildDir',
-    '$gpp $CFLAGS $INCLUDES -c -o $out $in'
+    '$gpp $CFLAGS $PCHFLAGS $INCLUDES -c -o $out $in'
   ],
   'tools'   : [ 'g++' ],
+  # small compiles can be sent to the taskManager in batches
+  'batchable'     : True,
   'useWorkerTask' : True
 })
 def gppCompile(snipetDef, theEnv, theTasks) :
@@ -118,23 +226,140 @@ def gppCompile(snipetDef, theEnv, theTasks) :
   Adds the standard CFLAGS and INCLUDES environment variables
 
   Adds the srcBaseName (computed from the srcName environment variable)
+
+  Adds the PCHFLAGS required to use any `precompiledHeaders` listed in the
+  `dependencies` (see the `gppPrecompiledHeader` snipet).
   """
   #print(yaml.dump(snipetDef))
 
-  if 'CFLAGS' not in theEnv : theEnv['CFLAGS'] = "-Wall"
-  if 'INCLUDES' not in theEnv :
-    theEnv['INCLUDES'] = expandEnvInStr('gccCompile',"-I$pkgIncludes -I$srcIncludes", theEnv)
+  setCompileFlags('gccCompile', snipetDef, theEnv)
   theEnv['srcBaseName'] = os.path.splitext(theEnv['taskName'])[0]
 
   pkgDeps, pkgLibs, systemLibs, cObjs, pkgIncludes, srcIncludes = \
     collectAnsiCDependencies('gccCompile', snipetDef, theEnv)
 
-  snipetDef['fileDependencies'] = pkgIncludes +  srcIncludes + [
+  pchDeps, pchFiles, pchFlags = \
+    collectPrecompiledHeaders('gccCompile', snipetDef, theEnv)
+  theEnv['PCHFLAGS'] = " ".join(pchFlags)
+
+  snipetDef['fileDependencies'] = pkgIncludes +  srcIncludes + pchFiles + [
     findEnvInSnipetDef('in', snipetDef)
   ]
-  snipetDef['taskDependencies'] = pkgDeps
+  snipetDef['taskDependencies'] = pkgDeps + pchDeps
   snipetDef['targets']          = [ 
     findEnvInSnipetDef('out', snipetDef)
+  ] + splitDwarfTargets(snipetDef, theEnv)
+
+@TaskSnipets.addSnipet('linux', 'gppUnityCompile', {
+  'snipetDeps'       : [ 'srcBase' ],
+  'platformSpecific' : True,
+  'environment'      : [
+    { 'doitTaskName' : 'compile-$taskName'         },
+    { 'unityDir'     : '$buildDir/unity'           },
+    { 'in'           : '$unityDir/${taskName}.cpp' },
+    { 'out'          : '$buildDir/${taskName}.o'   }
+  ],
+  'actions' : [
+    'mkdir -p $unityDir',
+    "printf '#include \"%s\"\\n' $unityIncludes > $in",
+    '$gpp $CFLAGS $PCHFLAGS $INCLUDES -c -o $out $in'
+  ],
+  'tools'   : [ 'g++' ],
+  'useWorkerTask' : True
+})
+def gppUnityCompile(snipetDef, theEnv, theTasks) :
+  """
+  Compile a "unity" (amalgamation) translation unit which includes each of the
+  sources listed in the `unitySources` key.
+
+  These snipets are generated by `cfdoit.unityBuilds.planUnityBuilds` for
+  projects which specify a `unity` build.
+  """
+  setCompileFlags('gppUnityCompile', snipetDef, theEnv)
+
+  pkgDeps, pkgLibs, systemLibs, cObjs, pkgIncludes, srcIncludes = \
+    collectAnsiCDependencies('gppUnityCompile', snipetDef, theEnv)
+
+  pchDeps, pchFiles, pchFlags = \
+    collectPrecompiledHeaders('gppUnityCompile', snipetDef, theEnv)
+  theEnv['PCHFLAGS'] = " ".join(pchFlags)
+
+  # the unity sources are included relative to the unity source's directory
+  srcDir   = expandEnvInStr('gppUnityCompile', '$srcDir', theEnv)
+  unityDir = expandEnvInStr('gppUnityCompile', '$buildDir/unity', theEnv)
+  sources  = []
+  includes = []
+  for aSrcName in snipetDef['unitySources'] :
+    sources.append(os.path.join(srcDir, aSrcName))
+    includes.append(os.path.relpath(sources[-1], unityDir))
+  theEnv['unityIncludes'] = " ".join(includes)
+
+  snipetDef['fileDependencies'] = pkgIncludes + srcIncludes + pchFiles + sources
+  snipetDef['taskDependencies'] = pkgDeps + pchDeps
+  snipetDef['targets']          = [
+    findEnvInSnipetDef('out', snipetDef)
+  ] + splitDwarfTargets(snipetDef, theEnv)
+
+@TaskSnipets.addSnipet('linux', 'gppPrecompiledHeader', {
+  'snipetDeps'       : [ 'srcBase' ],
+  'platformSpecific' : True,
+  'environment'      : [
+    { 'doitTaskName' : 'pch-$taskName'          },
+    { 'pchDir'       : '$buildDir/pch'          },
+    { 'pchHeader'    : '$pchDir/${taskName}.hpp' },
+    { 'out'          : '${pchHeader}.gch'       }
+  ],
+  'actions' : [
+    'mkdir -p $pchDir',
+    "printf '#include <%s>\\n' $pchIncludes > $pchHeader",
+    '$gpp $CFLAGS $INCLUDES -x c++-header -o $out $pchHeader'
+  ],
+  'tools'   : [ 'g++' ],
+  'useWorkerTask' : True
+})
+def gppPrecompiledHeader(snipetDef, theEnv, theTasks) :
+  """
+  Precompile a collection of (heavy) package headers into a gcc `.gch`.
+
+  The headers are listed in the `pkgIncludes` of the `dependencies`. The
+  precompiled header is built once for each platform and is rebuilt whenever
+  the CFLAGS or INCLUDES change, or any of the headers installed by the
+  packages listed in the `dependencies` change (see `checkInstalledFiles`).
+
+  Precompiled headers are NOT used automatically: a `gppCompile` (or
+  `gppUnityCompile`) task only uses the precompiled header if it lists this
+  task's name in its `dependencies` `precompiledHeaders`. The gppCompile task
+  MUST use the same CFLAGS (gcc will warn, and then ignore the `.gch`, if it
+  can not be used).
+  """
+  setCompileFlags('gppPrecompiledHeader', snipetDef, theEnv)
+
+  pkgDeps, pkgLibs, systemLibs, cObjs, pkgIncludes, srcIncludes = \
+    collectAnsiCDependencies('gppPrecompiledHeader', snipetDef, theEnv)
+
+  headers = []
+  if 'dependencies' in snipetDef :
+    deps = snipetDef['dependencies']
+    if 'pkgInclude'  in deps : headers.extend(deps['pkgInclude'])
+    if 'pkgIncludes' in deps : headers.extend(deps['pkgIncludes'])
+  theEnv['pchIncludes'] = " ".join(headers)
+
+  # the packages' installed headers (listed in their staged install
+  # manifests) are fingerprinted, since the listed headers include others
+  manifests = []
+  for aPkgDep in pkgDeps :
+    aPkgName = aPkgDep.split('.')[1]
+    manifests.append(f"$localDir/share/cfdoit/manifests/{aPkgName}")
+  uptodates = [
+    "checkVersion('$CFLAGS $INCLUDES $pchIncludes')",
+    f"checkInstalledFiles('$localDir', {manifests!r})"
+  ]
+
+  snipetDef['fileDependencies'] = pkgIncludes
+  snipetDef['taskDependencies'] = pkgDeps
+  snipetDef['uptodates']        = uptodates
+  snipetDef['targets']          = [
+    findEnvInSnipetDef('out', snipetDef)
   ]
 
 @TaskSnipets.addSnipet('linux', 'gppInstallCommand', {
@@ -146,7 +371,7 @@ def gppCompile(snipetDef, theEnv, theTasks) :
     { 'LINKFLAGS'    : ' '                   },
   ],
   'actions' : [
-    '$gpp -o $out $in $LINKFLAGS $LIBS',
+    '$gpp $LINKERFLAGS -o $out $in $LINKFLAGS $LIBS',
   #  'install $out $where'
   ],
   'tools'   : [ 'g++', 'install' ],
@@ -160,11 +385,17 @@ def gppInstallCommand(snipetDef, theEnv, theTasks) :
   $LIBS variable.
 
   Gathers together the collection of sources into the $in varialbe.
+
+  In the fast link mode (see `collectLinkOptions`) the $LINKERFLAGS select a
+  faster linker (`mold` or `lld`).
   """
   pkgDeps, pkgLibs, systemLibs, cObjs, pkgIncludes, srcIncludes = \
     collectAnsiCDependencies('gccInstallCommand', snipetDef, theEnv)
   
   theEnv['LIBS'] = " ".join(pkgLibs + systemLibs)
+  theEnv['LINKERFLAGS'] = linkerFlags(
+    collectLinkOptions(snipetDef), theEnv.get('gpp', 'g++')
+  )
 
   # TODO: how do we infer or otherwise specify the "src dependencies" (srcDeps)?
   
@@ -184,18 +415,51 @@ def gppInstallCommand(snipetDef, theEnv, theTasks) :
   'snipetDeps'       : [ 'srcBase' ],
   'platformSpecific' : True,
   'environment'      : [
-    { 'doitTaskName' : 'library-$taskName' },
-    { 'ar'           : 'ar'                }
+    { 'doitTaskName' : 'library-$taskName'               },
+    { 'ar'           : 'ar'                              },
+    { 'out'          : '$buildDir/lib/lib${taskName}.a'  }
   ],
   'actions' : [
-    '$ar rcs $out $in',
-    'install $out $where'
+    'mkdir -p $buildDir/lib',
+    # (re)create the archive whenever its list of members, or its type
+    # (regular or thin, see $ARFLAGS), changes
+    'if [ "$ARFLAGS $in" != "$$(cat $out.members 2>/dev/null)" ] ; then rm -f $out ; fi',
+    '$ar $ARFLAGS $out $in',
+    'echo "$ARFLAGS $in" > $out.members'
   ],
-  'tool' : [ 'ar', 'install' ],
+  'tools' : [ 'ar', 'install' ],
   'useWorkerTask' : True
 })
 def gccInstallStaticLibrary(snipetDef, theEnv, theTasks) :
   """
   Perform the creation and install of a "standard" static library
+
+  The library's objects are listed in the `cObj` `dependencies`.
+
+  In the fast link mode (see `collectLinkOptions`) only the changed members of
+  an existing archive are updated. A library marked as `intermediate` (used
+  only to link other commands in this build) is not installed, and (with
+  `thinArchives`) is created as a thin archive which references, rather than
+  copies, its objects.
   """
-  pass
+  pkgDeps, pkgLibs, systemLibs, cObjs, pkgIncludes, srcIncludes = \
+    collectAnsiCDependencies('gccInstallStaticLibrary', snipetDef, theEnv)
+
+  theEnv['in'] = " ".join(cObjs)
+
+  linkOptions  = collectLinkOptions(snipetDef)
+  intermediate = snipetDef.get('intermediate', False)
+  theEnv['ARFLAGS'] = 'rcs'
+  if linkOptions['mode'] == 'fast' :
+    theEnv['ARFLAGS'] = 'rcsu'
+    if intermediate and linkOptions['thinArchives'] :
+      theEnv['ARFLAGS'] = 'rcsuT'
+
+  targets = [ findEnvInSnipetDef('out', snipetDef) ]
+  if not intermediate :
+    snipetDef['actions'].append('install $out $where')
+    targets.append('$where/lib${taskName}.a')
+
+  snipetDef['fileDependencies'] = cObjs
+  snipetDef['taskDependencies'] = pkgDeps
+  snipetDef['targets']          = targets
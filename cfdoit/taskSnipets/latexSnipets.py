@@ -13,10 +13,22 @@ from cfdoit.taskSnipets.dsl import (
   #findEnvInSnipetDef
 )
 
+from cfdoit.config import Config
+from cfdoit.diagramBatcher import DiagramBatcher, renderDiagram
+from cfdoit.envHelpers import expandEnvInStr, findEnvInSnipetDef
+from cfdoit.latexScanner import LatexScanner
+from cfdoit.pygmentsWorker import highlightChunk
 from cfdoit.taskGenerator import (
-  gen_TasksFromRootTask
+  gen_SharedTasksFromRootTask
 )
 
+def latexConfig() :
+  """
+  Return the `latex` configuration table (if any).
+  """
+  if 'GLOBAL' not in Config.config : return {}
+  return Config.config['GLOBAL'].get('latex', {})
+
 @TaskSnipets.addSnipet('linux', 'latexBase', {
   'snipetDeps'  : [ 'buildBase'    ],
   'environment' : [
@@ -59,6 +71,46 @@ def drawDiagram(snipetDef, theEnv, theTasks) :
     snipetDef, 'targets', [ '$latexDir/${taskName}_v1_5.pdf' ]
   )
 
+@TaskSnipets.addSnipet('linux', 'drawDiagramBatched', {
+  'snipetDeps'       : [ 'latexBase' ],
+  'platformSpecific' : True,
+  'environment'      : [
+    {
+      'doitTaskName'  : 'latex-diagram-$taskName',
+      'in'            : '${taskName}.tex',
+      'diagramFormat' : 'fragment'
+    }
+  ],
+  'pythonActions' : [
+    ( renderDiagram, [
+      '$platform', '$in', '$latexDir', '$latexDir/${taskName}_v1_5.pdf'
+    ] )
+  ]
+})
+def drawDiagramBatched(snipetDef, theEnv, theTasks) :
+  """
+  Draw a diagram using ConTeXt-MetaFun together with all of the other
+  out-of-date diagrams (of this platform) in one ConTeXt run (see
+  `cfdoit.diagramBatcher`).
+
+  The diagram's `diagramFormat` is either `fragment` (the default, a ConTeXt
+  fragment which can be batched) or `document` (a complete ConTeXt document
+  which is rendered on its own using `lpilMagicRunner`).
+  """
+  DiagramBatcher.register(
+    theEnv['platform'],
+    expandEnvInStr('drawDiagramBatched', '${taskName}.tex', theEnv),
+    expandEnvInStr('drawDiagramBatched', '$latexDir', theEnv),
+    expandEnvInStr('drawDiagramBatched', '$latexDir/${taskName}_v1_5.pdf', theEnv),
+    findEnvInSnipetDef('diagramFormat', snipetDef) or 'fragment'
+  )
+  snipetExtendList(
+    snipetDef, 'fileDependencies', [ '${taskName}.tex' ]
+  )
+  snipetExtendList(
+    snipetDef, 'targets', [ '$latexDir/${taskName}_v1_5.pdf' ]
+  )
+
 @TaskSnipets.addSnipet('linux', 'pygmentizeCodeChunk', {
   'snipetDeps'       : [ 'latexBase' ],
   'platformSpecific' : True,
@@ -70,7 +122,7 @@ def drawDiagram(snipetDef, theEnv, theTasks) :
   ],
   'actions' : [
     'cd $latexDir',
-    'pygmentize -f latex -l cpp -o $out $in'
+    'pygmentize -f latex $lexerFlag -o $out $in'
   ],
   'tool' : [ 'pygments' ],
   'baseDir' : '$latexDir',
@@ -79,9 +131,14 @@ def drawDiagram(snipetDef, theEnv, theTasks) :
 def pygmentizeCodeChunk(snipetDef, theEnv, theTasks) :
   """
   LaTeX-colourize code chunks using the python Pygments tool
+
+  The lexer is taken from the chunk's `lexer` metadata (default: `cpp`). The
+  `auto` lexer asks `pygmentize` to guess the lexer from the chunk's content.
   """
   theEnv['out'] = theEnv['taskName'].removesuffix('.chunk') \
     + '.pygmented.tex'
+  theEnv['lexerFlag'] = '-l '+theEnv.get('lexer', 'cpp')
+  if theEnv.get('lexer', 'cpp') == 'auto' : theEnv['lexerFlag'] = '-g'
   snipetExtendList(
     snipetDef, 'fileDependencies', [ '$latexDir/$taskName' ]
   )
@@ -89,6 +146,74 @@ def pygmentizeCodeChunk(snipetDef, theEnv, theTasks) :
     snipetDef, 'targets', [ '$latexDir/$out' ]
   )
 
+@TaskSnipets.addSnipet('linux', 'highlightCodeChunk', {
+  'snipetDeps'       : [ 'latexBase' ],
+  'platformSpecific' : True,
+  'environment'      : [
+    {
+      'doitTaskName' : 'latex-pygment-$taskName',
+      'in'           : '$latexDir/$taskName'
+    }
+  ],
+  'pythonActions' : [
+    ( highlightChunk, [ '$in', '$latexDir/$out', '$lexer' ] )
+  ]
+})
+def highlightCodeChunk(snipetDef, theEnv, theTasks) :
+  """
+  LaTeX-colourize code chunks using Pygments in a long-lived pool of worker
+  processes (see `cfdoit.pygmentsWorker`).
+
+  The lexer is taken from the chunk's `lexer` metadata (default: `cpp`). The
+  `auto` lexer is guessed from the chunk's file name (or content).
+  """
+  theEnv['out'] = theEnv['taskName'].removesuffix('.chunk') \
+    + '.pygmented.tex'
+  if 'lexer' not in theEnv : theEnv['lexer'] = 'cpp'
+  snipetExtendList(
+    snipetDef, 'fileDependencies', [ '$latexDir/$taskName' ]
+  )
+  snipetExtendList(
+    snipetDef, 'targets', [ '$latexDir/$out' ]
+  )
+
+def codeChunkMetadata(aCodeChunk) :
+  """
+  Return the name and the (optional) metadata (for example the `lexer`) of a
+  code chunk listed in a document's `pygments` dependencies. A code chunk is
+  either listed by name or as a dict with a `chunk` (name) key.
+  """
+  if isinstance(aCodeChunk, dict) :
+    metadata = dict(aCodeChunk)
+    return (metadata.pop('chunk'), metadata)
+  return (aCodeChunk, {})
+
+def scanDependencies(snipetDef, theEnv, fileDeps) :
+  """
+  Merge the dependencies discovered by scanning the document's source into
+  the listed `dependencies` (and add its other sources to the `fileDeps`).
+  """
+  if 'dependencies' not in snipetDef : snipetDef['dependencies'] = {}
+  dependencies = snipetDef['dependencies']
+  if not dependencies.get('scan', latexConfig().get('scanDependencies', False)) :
+    return
+
+  scanned = LatexScanner.scan(theEnv['taskName'])
+  for aSource in scanned['sources'][1:] : fileDeps.append(aSource)
+
+  if 'diagrams' not in dependencies : dependencies['diagrams'] = []
+  for aDiagram in scanned['diagrams'] :
+    if aDiagram not in dependencies['diagrams'] :
+      dependencies['diagrams'].append(aDiagram)
+
+  if 'pygments' not in dependencies : dependencies['pygments'] = []
+  knownChunks = [
+    codeChunkMetadata(aCodeChunk)[0] for aCodeChunk in dependencies['pygments']
+  ]
+  for aCodeChunk in scanned['pygments'] :
+    if aCodeChunk not in knownChunks :
+      dependencies['pygments'].append(aCodeChunk)
+
 @TaskSnipets.addSnipet('linux', 'typesetLatex', {
   'snipetDeps'       : [ 'latexBase' ],
   'platformSpecific' : True,
@@ -107,33 +232,59 @@ def pygmentizeCodeChunk(snipetDef, theEnv, theTasks) :
 def typesetLatex(snipetDef, theEnv, theTasks) :
   """
   Typeset a LPiL LaTeX document (and all of its parts)
+
+  The diagram and code chunk tasks are shared by all documents which use them
+  (they are only generated once for each platform).
+
+  Code chunks are highlighted by the `pygmentize` command, or, if the `latex`
+  configuration's `pygmentsMode` is `inProcess`, by the `highlightCodeChunk`
+  snipet.
+
+  Diagrams are drawn one at a time, or, if the `latex` configuration's
+  `diagramMode` is `batched`, by the `drawDiagramBatched` snipet.
+
+  If the document's `dependencies` has `scan: true` (or the `latex`
+  configuration's `scanDependencies` is true) then the diagrams, code chunks
+  and `\\input`/`\\include`d sources of the document are (also) discovered by
+  scanning its source (see `cfdoit.latexScanner`).
   """
   fileDeps = []
 
   if 'platform' in theEnv :
+    scanDependencies(snipetDef, theEnv, fileDeps)
     if 'dependencies' in snipetDef :
       dependencies = snipetDef['dependencies']
       if 'diagrams' in dependencies :
         #print("diagrams:")
+        diagramSnipet = 'drawDiagram'
+        if latexConfig().get('diagramMode', 'single') == 'batched' :
+          diagramSnipet = 'drawDiagramBatched'
         for aDiagram in dependencies['diagrams'] :
           fileDeps.append('$latexDir/'+aDiagram+'_v1_5.pdf')
           #print(f"  {aDiagram}")
-          gen_TasksFromRootTask(
+          gen_SharedTasksFromRootTask(
             theEnv['platform'],
             aDiagram,
-            { 'taskSnipet' : 'drawDiagram' },
+            { 'taskSnipet' : diagramSnipet },
             theTasks)
       if 'pygments' in dependencies :
         #print("pygments:")
+        chunkSnipet = 'pygmentizeCodeChunk'
+        if latexConfig().get('pygmentsMode', 'cli') == 'inProcess' :
+          chunkSnipet = 'highlightCodeChunk'
         for aCodeChunk in dependencies['pygments'] :
           #print(f"  {aCodeChunk}")
+          aCodeChunk, metadata = codeChunkMetadata(aCodeChunk)
           fileDeps.append(
             '$latexDir/'+aCodeChunk.removesuffix('.chunk')+'.pygmented.tex'
           )
-          gen_TasksFromRootTask(
+          chunkDef = { 'taskSnipet' : chunkSnipet }
+          if 'lexer' in metadata :
+            chunkDef['environment'] = { 'lexer' : metadata['lexer'] }
+          gen_SharedTasksFromRootTask(
             theEnv['platform'],
             aCodeChunk,
-            { 'taskSnipet' : 'pygmentizeCodeChunk' },
+            chunkDef,
             theTasks)
   
   fileDeps.append('$taskName')
@@ -5,6 +5,10 @@ GitHub packages.
 
 #import yaml
 
+import copy
+import re
+
+from cfdoit.config import Config
 from cfdoit.taskSnipets.dsl import TaskSnipets, snipetExtendList
 
 @TaskSnipets.addSnipet('linux', 'packageBase', {
@@ -54,25 +58,164 @@ def gitHubDownload(snipetDef, theEnv, theTasks) :
   """
   pass
 
+@TaskSnipets.addSnipet('linux', 'gitFetch', {
+  'snipetDeps'  : [ 'packageBase' ],
+  'environment' : [
+    { 'doitTaskName' : 'download-extract.$taskName' },
+    { 'mirrorsDir'   : '$baseBuildDir/mirrors'      },
+    { 'mirrorDir'    : '$mirrorsDir/$mirrorName'    }
+  ],
+  'actions' : [
+    'mkdir -p $mirrorsDir',
+    # create, or (incrementally) update, the shared bare mirror and add this
+    # package's worktree, holding the mirror's lock so that parallel (platform)
+    # tasks share a single fetch
+    [
+      '( flock 9 &&',
+      '{ if [ ! -d $mirrorDir ] ; then',
+      'rm -rf $mirrorDir.tmp &&',
+      'git clone --mirror --quiet $repoUrl $mirrorDir.tmp &&',
+      'mv $mirrorDir.tmp $mirrorDir ;',
+      'elif echo "$repoRevision" | grep -qE "^[0-9a-f]{40}$$" &&',
+      'git -C $mirrorDir cat-file -e "$repoRevision^{commit}" 2>/dev/null ; then',
+      'echo "$repoRevision is already in the $mirrorName mirror" ;',
+      'else git -C $mirrorDir fetch --prune --quiet origin ; fi ; } &&',
+      'if [ ! -e $pkgDir/.git ] ; then',
+      'rm -rf $pkgDir && git -C $mirrorDir worktree prune &&',
+      'git -C $mirrorDir worktree add --quiet --detach --no-checkout',
+      '"$$(realpath -m $pkgDir)" "$repoRevision" ; fi',
+      ') 9> $mirrorDir.lock || exit 1'
+    ],
+    # resolve the revision against the (updated) mirror, since in the
+    # worktree `HEAD` (or a stale branch) would name the current checkout
+    [
+      'repoCommit=$$(git -C $mirrorDir rev-parse --verify --quiet "$repoRevision^{commit}")',
+      '|| { echo "Could not resolve $repoRevision in the $mirrorName mirror" ; exit 1 ; }'
+    ],
+    'cd $pkgDir',
+    [
+      'if [ -n "$sparsePaths" ] ; then git sparse-checkout set --no-cone $sparsePaths ;',
+      'elif [ "$$(git config --get core.sparseCheckout)" = "true" ] ; then',
+      'git sparse-checkout disable ; fi'
+    ],
+    'git checkout --quiet --detach --force "$$repoCommit"',
+    'git rev-parse HEAD'
+  ],
+  'uptodates' : [ "checkGitRevision('$repoRevision', '$repoUrl $sparsePaths', '$repoUrl', '$pkgDir')" ],
+  'targets'   : [ '$pkgDir/.git' ],
+  'tools'     : [ 'git' ],
+  'useWorkerTask' : True
+})
+def gitFetch(snipetDef, theEnv, theTasks) :
+  """
+  fetch the sources of any git revision (a branch, tag or commit) using a
+  shared (bare) local mirror of the repository
+
+  Each repository is mirrored once (in `$baseBuildDir/mirrors`, shared by all
+  platforms) and the mirror is updated incrementally using `git fetch`
+  (which is skipped if the requested commit is already in the mirror). The
+  requested revision is then checked out into a (cheap) worktree of the
+  mirror in `$pkgDir`. Updating the mirror is protected by a (per mirror)
+  `flock` lock so that parallel platform tasks share a single fetch.
+
+  The package description SHOULD define the following environment variables:
+
+    - repoUrl: the git URL of the repository (any URL `git` understands,
+      including local `file://` URLs), OR
+    - repoPath: (the GitHub  user/repoName)
+
+    - repoRevision: (a branch, tag or commit, defaulting to the repoVersion,
+      if defined, or HEAD)
+
+    - sparsePaths: (optional) the (space separated) paths to sparsely check
+      out
+
+  The requested revision is resolved (to a commit) against the mirror once it
+  has been updated. Tasks for full commit ids are only rerun if the commit
+  changes, tasks for branches, tags or HEAD are rerun whenever the commit the
+  revision names in the repository (see `git ls-remote`) differs from the
+  commit checked out.
+  """
+  if 'repoUrl' not in theEnv :
+    theEnv['repoUrl'] = f"https://github.com/{theEnv.get('repoPath', '')}.git"
+  if 'repoRevision' not in theEnv :
+    theEnv['repoRevision'] = theEnv.get('repoVersion', 'HEAD')
+  if 'sparsePaths' not in theEnv : theEnv['sparsePaths'] = ''
+  mirrorName = re.sub(r'^[a-z+]+://', '', theEnv['repoUrl']).strip('/')
+  theEnv['mirrorName'] = re.sub(r'[^A-Za-z0-9._-]+', '_', mirrorName)
+
 @TaskSnipets.addSnipet('linux', 'cmakeCompile', {
   'snipetDeps'       : [ 'gitHubDownload' ],
   'platformSpecific' : True,
+  # (read by cmake itself, rather than referenced by the actions)
+  'exportEnvironment' : [
+    'CFLAGS', 'CXXFLAGS', 'LDFLAGS', 'CMAKE_PREFIX_PATH', 'PKG_CONFIG_PATH'
+  ],
   'environment'      : [
     { 'doitTaskName' : 'compile-install.$taskName' }
   ],
   'actions' : [
     'mkdir -p $pkgDir/build',
     'cd $pkgDir/build',
+    # fingerprint the effective configure inputs (the configure command, the
+    # toolchain and the top-level CMake files)
+    [
+      'cmakeFingerprint=$$( {',
+      'echo "$cmakeConfigure" ;',
+      'for aCompiler in $${CC:-cc} $${CXX:-c++} ; do',
+      'command -v $$aCompiler ; $$aCompiler --version 2>/dev/null | head -n 1 ;',
+      'done ;',
+      'cat ../CMakeLists.txt ../CMakePresets.json 2>/dev/null ;',
+      '} | sha256sum | cut -d " " -f 1 )'
+    ],
+    [
+      'if [ "$cmakeCacheConfigure" = "yes" ] && [ -f CMakeCache.txt ]',
+      '&& [ "$$(cat .cfdoit-configure 2>/dev/null)" = "$$cmakeFingerprint" ] ;',
+      'then echo "The CMake configuration of $taskName is up to date" ;',
+      'else rm -f .cfdoit-configure && $cmakeConfigure',
+      '&& echo "$$cmakeFingerprint" > .cfdoit-configure ; fi'
+    ],
+    # when cfdoit's jobserver is running ninja (>= 1.13) shares its job slots
+    'if [ -n "$$CFDOIT_JOBSERVER" ] ; then ninja ; else ninja -j $$(nproc) ; fi',
+    'if [ "$cmakeStagedInstall" != "yes" ] ; then ninja install ; fi',
+    # install into this package's own staging prefix...
     [
-      'cmake $cmakeOptions ..',
-      '-D CMAKE_GENERATOR=Ninja',
-      '-D CMAKE_PREFIX_PATH=$installPrefix',
-      '-D CMAKE_INSTALL_PREFIX=$installPrefix'
+      'if [ "$cmakeStagedInstall" = "yes" ] ; then',
+      'rm -rf ../stage && cmake --install . --prefix ../stage &&',
+      '( cd ../stage && find . ! -type d | sed -e "s|^[.]/||" | LC_ALL=C sort ) > ../manifest.new',
+      '|| exit 1 ; fi'
     ],
-    'ninja -j $$(nproc) install'
+    # ... (atomically) merge each staged file into the shared prefix...
+    [
+      'if [ "$cmakeStagedInstall" = "yes" ] ; then',
+      'while read aFile ; do',
+      'aTmpFile="$installPrefix/$$aFile.cfdoit-$taskName" ;',
+      'mkdir -p "$$(dirname "$installPrefix/$$aFile")" &&',
+      '{ cp -P -p -l "../stage/$$aFile" "$$aTmpFile" 2>/dev/null',
+      '|| cp -P -p --reflink=auto "../stage/$$aFile" "$$aTmpFile" ; } &&',
+      'mv -f "$$aTmpFile" "$installPrefix/$$aFile" || exit 1 ;',
+      'done < ../manifest.new ; fi'
+    ],
+    # ... and then remove the files of the previous install which are no
+    # longer installed (unless another package's manifest lists them)
+    [
+      'if [ "$cmakeStagedInstall" = "yes" ] ; then',
+      'mkdir -p $manifestsDir &&',
+      'for aManifest in $manifestsDir/* ; do',
+      '[ -f "$$aManifest" ] && [ "$$aManifest" != "$manifestsDir/$taskName" ] && cat "$$aManifest" ;',
+      'done > ../manifest.others ;',
+      'if [ -f $manifestsDir/$taskName ] ; then',
+      'LC_ALL=C comm -23 $manifestsDir/$taskName ../manifest.new | while read aFile ; do',
+      'grep -qxF "$$aFile" ../manifest.others || rm -f "$installPrefix/$$aFile" ;',
+      'done ; fi ;',
+      'mv -f ../manifest.new $manifestsDir/$taskName && rm -f ../manifest.others ; fi'
+    ]
   ],
-  # make sure only ONE task gets done on this machine while this task is running.
+  # ninja uses every core, so (locally, or remotely) this build takes (most
+  # of) the host's capacity...
   'estimatedLoad' : 10.0,
+  # ... unless this command's jobserver limits ninja's jobs (see `JobServer`)
+  'jobServerLoad' : 1.0,
   'dependencies' : {
     'files' : [
       'CMakeLists.txt'
@@ -98,7 +241,54 @@ def cmakeCompile(snipetDef, theEnv, theTasks) :
     creates:
       libs:
       includes:
+
+  When the jobserver is running, concurrent (local) package builds share its
+  job slots, so they no longer need to be serialized by a large
+  estimatedLoad (and use the smaller `jobServerLoad` instead). Remote workers
+  can not see the jobserver, so remote builds keep the large estimatedLoad.
+
+  By default each package is installed into its own staging prefix
+  (`$pkgDir/stage`, using `cmake --install --prefix`) and the staged files are
+  then merged into the shared `$localDir` (as hard links, or reflinks/copies,
+  each of which is atomically moved into place). The list of installed files
+  is recorded in the package's manifest
+  (`$localDir/share/cfdoit/manifests/$taskName`), which is used to remove the
+  files which a new version of the package no longer installs. Since
+  concurrent package installs no longer clobber each other, independent
+  packages can be built in parallel on one host (while the jobserver limits
+  their ninja builds).
+
+  The CMake configure step is skipped if a fingerprint of its inputs (the
+  configure command, including the options, generator and prefixes, the
+  compilers found on the PATH and the top-level `CMakeLists.txt` and
+  `CMakePresets.json`) matches the fingerprint stored (in
+  `build/.cfdoit-configure`) by the last successful configure. (Changes to
+  any other CMake files are picked up by ninja's own re-configure rule.)
+
+  The configure caching, and an (optional) compiler launcher, are configured
+  by the `cmake` table of the `build` configuration (or the package's own
+  `cmake` key):
+
+    - `cacheConfigure`: skip unchanged configure steps (default: true)
+    - `stagedInstall`: install into a staging prefix and then merge into
+      `$localDir` (default: true)
+    - `compilerLauncher`: a compiler launcher (such as `ccache` or `sccache`)
+      used as the `CMAKE_C_COMPILER_LAUNCHER` and `CMAKE_CXX_COMPILER_LAUNCHER`
+      so that all packages share the launcher's compilation cache
   """
+  cmakeConfig = {
+    'cacheConfigure'   : True,
+    'compilerLauncher' : None,
+    'stagedInstall'    : True
+  }
+  if 'GLOBAL' in Config.config :
+    if 'build' in Config.config['GLOBAL'] :
+      if 'cmake' in Config.config['GLOBAL']['build'] :
+        cmakeConfig.update(Config.config['GLOBAL']['build']['cmake'])
+  if 'cmake' in snipetDef and isinstance(snipetDef['cmake'], dict) :
+    for aKey in [ 'cacheConfigure', 'compilerLauncher', 'stagedInstall' ] :
+      if aKey in snipetDef['cmake'] : cmakeConfig[aKey] = snipetDef['cmake'][aKey]
+
   if 'dependencies' in snipetDef :
     deps = snipetDef['dependencies']
     if 'packages' in deps :
@@ -129,10 +319,46 @@ def cmakeCompile(snipetDef, theEnv, theTasks) :
       for anInclude in created['includes'] :
         targets.append(f"${{pkgIncludes}}/{anInclude}")
     snipetExtendList(snipetDef, 'targets', targets)
-  
+
+  cmakeStagedInstall = 'no'
+  if cmakeConfig['stagedInstall'] :
+    cmakeStagedInstall = 'yes'
+    snipetExtendList(snipetDef, 'targets', [
+      '${localDir}/share/cfdoit/manifests/${taskName}'
+    ])
+
   cmakeOptions = " "
   if 'cmake' in snipetDef :
     if 'options' in snipetDef['cmake'] :
       for anOption, aValue in snipetDef['cmake']['options'].items() :
         cmakeOptions += f' -D{anOption}={aValue}'
-  snipetDef['environment'].append({'cmakeOptions' : cmakeOptions})
\ No newline at end of file
+  if cmakeConfig['compilerLauncher'] :
+    aLauncher = cmakeConfig['compilerLauncher']
+    cmakeOptions += f' -DCMAKE_C_COMPILER_LAUNCHER={aLauncher}'
+    cmakeOptions += f' -DCMAKE_CXX_COMPILER_LAUNCHER={aLauncher}'
+  cmakeConfigure = " ".join([
+    'cmake $cmakeOptions ..',
+    '-D CMAKE_GENERATOR=Ninja',
+    '-D CMAKE_PREFIX_PATH=$installPrefix',
+    '-D CMAKE_INSTALL_PREFIX=$installPrefix'
+  ])
+  cmakeCacheConfigure = 'yes' if cmakeConfig['cacheConfigure'] else 'no'
+  snipetDef['environment'].append({'cmakeOptions'        : cmakeOptions})
+  snipetDef['environment'].append({'cmakeConfigure'      : cmakeConfigure})
+  snipetDef['environment'].append({'cmakeCacheConfigure' : cmakeCacheConfigure})
+  snipetDef['environment'].append({'cmakeStagedInstall'  : cmakeStagedInstall})
+  snipetDef['environment'].append({
+    'manifestsDir' : '$installPrefix/share/cfdoit/manifests'
+  })
+
+gitCmakeCompileDef = copy.deepcopy(TaskSnipets.theSnipets['linux']['cmakeCompile'])
+del gitCmakeCompileDef['snipetFunc']
+gitCmakeCompileDef['snipetDeps'] = [ 'gitFetch' ]
+
+@TaskSnipets.addSnipet('linux', 'gitCmakeCompile', gitCmakeCompileDef)
+def gitCmakeCompile(snipetDef, theEnv, theTasks) :
+  """
+  Perform a "standard" CMake compile and install (see `cmakeCompile`) of the
+  sources fetched from a git mirror (see `gitFetch`).
+  """
+  cmakeCompile(snipetDef, theEnv, theTasks)
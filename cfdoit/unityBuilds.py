@@ -0,0 +1,213 @@
+"""
+Plan "unity" (amalgamated) builds for `gppInstallCommand` projects.
+
+A `gppInstallCommand` project opts into a unity build by adding a `unity` key
+to its description:
+
+    projects:
+      jsonEchoKernel:
+        taskSnipet: gppInstallCommand
+        unity:
+          groups: 2          # the number of amalgamation translation units
+          exclude:           # (optional) unity-incompatible source roots
+            - jeClass
+        dependencies:
+          cObj:
+            - jeMain.o
+            - jeClass.o
+
+Every `gppCompile` project whose object file is listed in the `cObj`
+dependencies (and which is neither excluded, nor marked `unityIncompatible`)
+is replaced by one of `groups` generated `gppUnityCompile` projects. The
+sources are ordered by a (stable) hash of their names and cut into `groups`
+contiguous groups, balanced by their historical compile times (if every
+source has been compiled before) or otherwise by their source sizes. So a
+source only moves to another group (forcing both groups to be recompiled)
+when it lies on a group boundary. The resulting unity objects replace the
+original objects in the `cObj` list. (A member's `gppCompile` project is
+only removed if no other project's `cObj` list still needs its object.)
+
+Sources whose `environment` differs from the majority of the sources are
+always compiled on their own.
+"""
+
+import copy
+import math
+import os
+import yaml
+import zlib
+
+from cfdoit.config import Config
+from cfdoit.taskHistory import TaskHistory
+
+def getBaseBuildDir() :
+  """
+  Return the (base) build directory (see the `buildBase` snipet).
+  """
+  buildDir = 'build'
+  if 'GLOBAL' in Config.config :
+    if 'build' in Config.config['GLOBAL'] :
+      if 'buildDir' in Config.config['GLOBAL']['build'] :
+        buildDir = Config.config['GLOBAL']['build']['buildDir']
+  return buildDir
+
+def sourceWeights(aPlatform, someSrcNames) :
+  """
+  Return a dict of the relative compile "weights" of the sources listed in
+  `someSrcNames`.
+
+  Historical compile durations are used if they are known for ALL of the
+  sources, otherwise the sizes of the source files are used.
+  """
+  weights = {}
+  for aSrcName in someSrcNames :
+    aDuration = TaskHistory.expectedDuration(f"compile-{aSrcName}.{aPlatform}")
+    if aDuration is None :
+      weights = {}
+      break
+    weights[aSrcName] = aDuration
+  if weights : return weights
+
+  srcDir = os.path.join(getBaseBuildDir(), 'src')
+  for aSrcName in someSrcNames :
+    try :
+      weights[aSrcName] = os.path.getsize(os.path.join(srcDir, aSrcName))
+    except OSError :
+      weights[aSrcName] = 1
+  return weights
+
+def roundedWeight(aWeight) :
+  """
+  Round a (positive) weight to the nearest power of two, so that small
+  fluctuations in the compile times do not move sources between groups.
+  """
+  if aWeight <= 0 : return 1
+  return 2.0 ** round(math.log2(aWeight))
+
+def partitionGroups(someWeights, numGroups) :
+  """
+  Partition the keys of the `someWeights` dict into `numGroups` groups of
+  (roughly) equal total weight.
+
+  The keys are ordered by a (stable) hash of their names and this ordering is
+  cut into `numGroups` contiguous runs. So a key only moves to another group
+  when it lies on the boundary between two groups, and adding (or removing) a
+  key only moves the keys next to it.
+
+  Returns a list of `numGroups` (possibly empty) lists of keys.
+  """
+  keys = sorted(
+    someWeights,
+    key=lambda aKey : (zlib.crc32(aKey.encode('utf-8')), aKey)
+  )
+  weights = {}
+  for aKey in keys : weights[aKey] = roundedWeight(someWeights[aKey])
+  totalWeight = sum(weights.values())
+
+  groups     = [ [] for aGroup in range(numGroups) ]
+  cumulative = 0.0
+  for aKey in keys :
+    # (each key joins the group which holds the middle of its weight)
+    groupNum = int((cumulative + weights[aKey]/2) * numGroups / totalWeight)
+    groups[min(groupNum, numGroups-1)].append(aKey)
+    cumulative += weights[aKey]
+  return [ sorted(aGroup) for aGroup in groups ]
+
+def mergeUnityDependencies(someMemberDefs) :
+  """
+  Merge the (compile) dependencies of all of the members of a unity group.
+  """
+  mergedDeps = {}
+  for aMemberDef in someMemberDefs :
+    if 'dependencies' not in aMemberDef : continue
+    for aKey, someValues in aMemberDef['dependencies'].items() :
+      if not isinstance(someValues, list) : continue
+      if aKey not in mergedDeps : mergedDeps[aKey] = []
+      for aValue in someValues :
+        if aValue not in mergedDeps[aKey] : mergedDeps[aKey].append(aValue)
+  return mergedDeps
+
+def planUnityBuild(aPlatform, aProjName, aProjDef, projects) :
+  """
+  Replace the unity-compatible `gppCompile` members of the `aProjName`
+  project by generated `gppUnityCompile` projects (in the `projects` dict).
+  """
+  unityDef = aProjDef['unity']
+  if not isinstance(unityDef, dict) : unityDef = {}
+  numGroups = int(unityDef.get('groups', 1))
+  excluded  = unityDef.get('exclude', [])
+
+  if 'dependencies' not in aProjDef : return
+  deps = aProjDef['dependencies']
+  if 'cObj' not in deps : return
+
+  # find the gppCompile projects which create each of the objects
+  objToSrc = {}
+  for aSrcName, aSrcDef in projects.items() :
+    if aSrcDef.get('taskSnipet', None) != 'gppCompile' : continue
+    objToSrc[os.path.splitext(aSrcName)[0]+'.o'] = aSrcName
+
+  # collect the unity compatible members (by environment)
+  members = {}
+  for anObj in deps['cObj'] :
+    if anObj not in objToSrc : continue
+    aSrcName = objToSrc[anObj]
+    aSrcDef  = projects[aSrcName]
+    if aSrcName in excluded or aSrcDef.get('unityIncompatible', False) :
+      continue
+    envKey = yaml.dump(aSrcDef.get('environment', {}), sort_keys=True)
+    if envKey not in members : members[envKey] = []
+    members[envKey].append(aSrcName)
+  if not members : return
+  members = max(members.values(), key=len)
+  if len(members) < 2 :
+    print(f"Not enough unity compatible sources for {aProjName}")
+    return
+
+  weights = sourceWeights(aPlatform, members)
+  groups  = partitionGroups(weights, max(1, numGroups))
+
+  unityObjs = []
+  for groupNum, someSrcNames in enumerate(groups) :
+    if not someSrcNames : continue
+    memberDefs = [ projects[aSrcName] for aSrcName in someSrcNames ]
+    unityName  = f"{aProjName}-unity-{groupNum}"
+    unityDef   = {
+      'taskSnipet'   : 'gppUnityCompile',
+      'unitySources' : someSrcNames,
+      'dependencies' : mergeUnityDependencies(memberDefs)
+    }
+    if 'environment' in memberDefs[0] :
+      unityDef['environment'] = copy.deepcopy(memberDefs[0]['environment'])
+    projects[unityName] = unityDef
+    unityObjs.append(unityName+'.o')
+    print(f"Unity build {unityName}: {', '.join(someSrcNames)}")
+
+  # (objects which other projects still link keep their gppCompile project)
+  otherObjs = set()
+  for anOtherName, anOtherDef in projects.items() :
+    if anOtherName == aProjName or not isinstance(anOtherDef, dict) : continue
+    someDeps = anOtherDef.get('dependencies', {})
+    if isinstance(someDeps, dict) : otherObjs.update(someDeps.get('cObj', []))
+
+  unityMembers = {}
+  for aSrcName in members :
+    anObj = os.path.splitext(aSrcName)[0]+'.o'
+    unityMembers[anObj] = True
+    if anObj not in otherObjs : del projects[aSrcName]
+
+  newObjs = [ anObj for anObj in deps['cObj'] if anObj not in unityMembers ]
+  deps['cObj'] = unityObjs + newObjs
+
+def planUnityBuilds(aPlatform, someProjects) :
+  """
+  Return a (deep) copy of the `someProjects` descriptions in which the members
+  of each unity build have been replaced by `gppUnityCompile` projects.
+  """
+  projects = copy.deepcopy(someProjects)
+  for aProjName in list(projects.keys()) :
+    if aProjName not in projects : continue
+    aProjDef = projects[aProjName]
+    if not isinstance(aProjDef, dict) or 'unity' not in aProjDef : continue
+    planUnityBuild(aPlatform, aProjName, aProjDef, projects)
+  return projects
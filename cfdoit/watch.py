@@ -0,0 +1,327 @@
+"""
+The `cfdoit watch` command: an incremental (inotify driven) rebuild loop.
+
+    cfdoit watch [doit run options] [--] [TASK ...]
+
+The watcher keeps the generated tasks (and the daemon's other warm state, see
+`cfdoit.daemon`) in memory, together with a reverse-dependency index of the
+tasks (see `cfdoit.depIndex`). It watches (using Linux's inotify) every
+source file which is a `file_dep` of a task, as well as the configuration and
+task description files.
+
+Whenever files change, a burst of events is debounced, and then only the
+tasks (transitively) affected by the changed files are rerun (restricted to
+the dependencies of the requested TASKs, if any). If a description changes,
+only the root tasks whose descriptions changed are regenerated.
+
+On systems without inotify the files are polled instead.
+
+The watcher is configured by the `watch` configuration table:
+
+- `debounce`: seconds without any further events before rebuilding (default:
+  0.2)
+- `pollInterval`: the seconds between polls when polling (default: 1.0)
+- `usePolling`: always poll, even if inotify is available (default: false)
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from doit.cmd_run import Run
+from doit.cmdparse import CmdOption, CmdParseError
+
+from cfdoit.config import Config
+from cfdoit.daemon import CfdoitDaemon
+from cfdoit.depIndex import DependencyIndex, normalizePath
+from cfdoit.taskGenerator import invalidateRootTasksFor
+from cfdoit.cli import globalConfigPath, localConfigPath
+
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_CLOEXEC     = 0o2000000
+
+watchMask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+  IN_CREATE | IN_DELETE
+
+def watchConfig() :
+  if 'GLOBAL' not in Config.config : return {}
+  return Config.config['GLOBAL'].get('watch', {})
+
+class InotifyWatcher :
+  """
+  Watch directories for changes using (Linux) inotify.
+  """
+
+  def __init__(self) :
+    libcName  = ctypes.util.find_library('c')
+    self.libc = ctypes.CDLL(libcName, use_errno=True)
+    self.fd   = self.libc.inotify_init1(IN_CLOEXEC)
+    if self.fd < 0 :
+      raise OSError(ctypes.get_errno(), "Could not initialize inotify")
+    self.dirs = {}  # watch descriptor -> directory
+
+  def watchFiles(self, somePaths) :
+    """
+    Watch the (parent directories of the) files in `somePaths`.
+    """
+    watchedDirs = set(self.dirs.values())
+    for aPath in somePaths :
+      aDir = os.path.dirname(aPath) or '.'
+      if aDir in watchedDirs or not os.path.isdir(aDir) : continue
+      aWd = self.libc.inotify_add_watch(self.fd, aDir.encode(), watchMask)
+      if aWd < 0 :
+        print(f"Could not watch {aDir}")
+        continue
+      self.dirs[aWd] = aDir
+      watchedDirs.add(aDir)
+
+  def readChanges(self, aTimeout) :
+    """
+    Return the set of paths changed within `aTimeout` seconds (or None if the
+    timeout expired without any changes).
+    """
+    readable, writable, errored = select.select([ self.fd ], [], [], aTimeout)
+    if not readable : return None
+    changed = set()
+    buffer  = os.read(self.fd, 65536)
+    offset  = 0
+    while offset + 16 <= len(buffer) :
+      aWd, aMask, aCookie, aLength = struct.unpack_from('iIII', buffer, offset)
+      aName  = buffer[offset+16:offset+16+aLength].rstrip(b'\0').decode(errors='replace')
+      offset = offset + 16 + aLength
+      if aWd in self.dirs and aName :
+        changed.add(normalizePath(os.path.join(self.dirs[aWd], aName)))
+    return changed
+
+class PollingWatcher :
+  """
+  Watch files for changes by polling their sizes and modification times.
+  """
+
+  def __init__(self) :
+    self.files        = {}
+    self.pollInterval = float(watchConfig().get('pollInterval', 1.0))
+
+  def fileStamp(self, aPath) :
+    try :
+      aStat = os.stat(aPath)
+      return (aStat.st_size, aStat.st_mtime_ns)
+    except OSError :
+      return None
+
+  def watchFiles(self, somePaths) :
+    for aPath in somePaths :
+      if aPath not in self.files : self.files[aPath] = self.fileStamp(aPath)
+
+  def readChanges(self, aTimeout) :
+    time.sleep(min(aTimeout, self.pollInterval))
+    changed = set()
+    for aPath, aStamp in self.files.items() :
+      newStamp = self.fileStamp(aPath)
+      if newStamp != aStamp :
+        self.files[aPath] = newStamp
+        changed.add(aPath)
+    if not changed : return None
+    return changed
+
+def newWatcher() :
+  """
+  Return an inotify watcher (or a polling watcher if inotify is unavailable).
+  """
+  if not watchConfig().get('usePolling', False) :
+    try :
+      return InotifyWatcher()
+    except Exception as err :
+      print(f"Could not use inotify ({repr(err)}), polling instead")
+  return PollingWatcher()
+
+def descriptionFiles() :
+  """
+  Return the list of the configuration and task description files.
+  """
+  descFiles = [ normalizePath(globalConfigPath()), normalizePath(localConfigPath()) ]
+  for aPath in CfdoitDaemon.descriptionPaths() :
+    if os.path.isdir(aPath) :
+      for aDir, someSubDirs, someFiles in os.walk(aPath) :
+        for aFile in someFiles :
+          if aFile.endswith('.yaml') :
+            descFiles.append(normalizePath(os.path.join(aDir, aFile)))
+    else :
+      descFiles.append(normalizePath(aPath))
+  return descFiles
+
+def splitRunArgs(someArgs) :
+  """
+  Split the `cfdoit watch` arguments into the (raw) `doit run` options (using
+  `doit run`'s own option table, so that an option's value, for example the
+  `4` of `-n 4`, stays with its option) and the requested task names (all of
+  the arguments after a `--` are task names).
+  """
+  shortOptions = {}
+  longOptions  = {}
+  for anOption in Run.base_options + Run.cmd_options :
+    anOption = CmdOption(anOption)
+    takesValue = anOption.type is not bool
+    if anOption.short : shortOptions['-' + anOption.short] = takesValue
+    if anOption.long  : longOptions['--' + anOption.long]  = takesValue
+    if anOption.inverse : longOptions['--' + anOption.inverse] = False
+
+  runOptions = []
+  taskNames  = []
+  someArgs   = list(someArgs)
+  while someArgs :
+    anArg = someArgs.pop(0)
+    if anArg == '--' :
+      taskNames.extend(someArgs)
+      break
+    if not anArg.startswith('-') :
+      taskNames.append(anArg)
+      continue
+    runOptions.append(anArg)
+    if anArg.startswith('--') :
+      aName = anArg.split('=', 1)[0]
+      if aName not in longOptions :
+        raise CmdParseError(f"cfdoit watch: unknown doit run option {aName}")
+      needsValue = longOptions[aName] and '=' not in anArg
+    else :
+      # (short options may be bundled, as in `-as` or `-an4`)
+      needsValue = False
+      for anIndex in range(1, len(anArg)) :
+        aName = '-' + anArg[anIndex]
+        if aName not in shortOptions :
+          raise CmdParseError(f"cfdoit watch: unknown doit run option {aName}")
+        if shortOptions[aName] :
+          needsValue = anIndex == len(anArg) - 1
+          break
+    if needsValue :
+      if not someArgs :
+        raise CmdParseError(f"cfdoit watch: the doit run option {anArg} requires a value")
+      runOptions.append(someArgs.pop(0))
+  return runOptions, taskNames
+
+class Watcher :
+  """
+  The incremental rebuild loop.
+  """
+
+  def __init__(self, someArgs) :
+    self.runOptions, self.requested = splitRunArgs(someArgs)
+    self.index      = None
+    self.descFiles  = set()
+    # (the configuration is loaded by the first refresh)
+    CfdoitDaemon.refresh()
+    self.watcher    = newWatcher()
+    self.debounce   = float(watchConfig().get('debounce', 0.2))
+
+  def refresh(self) :
+    """
+    (Re)generate any out of date tasks, (re)index them and watch their files.
+    """
+    CfdoitDaemon.refresh()
+    self.index     = DependencyIndex(CfdoitDaemon.tasks)
+    self.descFiles = set(descriptionFiles())
+    self.watcher.watchFiles(self.index.watchedFiles())
+    self.watcher.watchFiles(sorted(self.descFiles))
+
+  def relevantChanges(self, somePaths) :
+    """
+    Return the changed paths which are either sources or descriptions.
+    """
+    return set(
+      aPath for aPath in somePaths
+      if aPath in self.descFiles or (
+        aPath in self.index.fileTasks and aPath not in self.index.targetTasks
+      )
+    )
+
+  def waitForChanges(self) :
+    """
+    Wait for (and then debounce) a burst of relevant changes.
+    """
+    changed = set()
+    while not changed :
+      someChanges = self.watcher.readChanges(3600)
+      if someChanges : changed = self.relevantChanges(someChanges)
+    while True :
+      someChanges = self.watcher.readChanges(self.debounce)
+      if someChanges is None : break
+      changed.update(self.relevantChanges(someChanges))
+    return changed
+
+  def drainChanges(self) :
+    """
+    Discard the changes made by our own build (keeping any source changes made
+    while the build was running).
+    """
+    changed = set()
+    while True :
+      someChanges = self.watcher.readChanges(0.05)
+      if someChanges is None : break
+      changed.update(self.relevantChanges(someChanges))
+    return changed
+
+  def tasksToRun(self, changedPaths) :
+    """
+    Return the (topologically ordered) affected tasks which should be run.
+    """
+    affected = self.index.affectedBy(changedPaths)
+    if self.requested :
+      wanted   = self.index.dependenciesOf(self.requested)
+      affected = [ aTaskName for aTaskName in affected if aTaskName in wanted ]
+    # group tasks would (re)check ALL of their grouped tasks
+    return [
+      aTaskName for aTaskName in affected
+      if aTaskName not in self.index.groupTasks
+    ]
+
+  def run(self) :
+    """
+    Build (once) and then rebuild whenever the sources change.
+    """
+    self.refresh()
+    CfdoitDaemon.runDoit([ 'run' ] + self.runOptions + self.requested, sys.stdout)
+    pending = self.drainChanges()
+    print(f"Watching {len(self.index.watchedFiles())} source files (Ctrl-C to stop)")
+    while True :
+      changed = pending or self.waitForChanges()
+      pending = set()
+      print(f"Changed: {', '.join(sorted(changed))}")
+
+      # regenerate the tasks of any changed descriptions (and of any sources
+      # which might change the generated tasks)
+      invalidateRootTasksFor(changed)
+      CfdoitDaemon.tasks = None
+      self.refresh()
+
+      toRun = self.tasksToRun(changed)
+      if toRun :
+        print(f"Rebuilding: {' '.join(toRun)}")
+        CfdoitDaemon.runDoit([ 'run' ] + self.runOptions + toRun, sys.stdout)
+      else :
+        print("Nothing to rebuild")
+      pending = self.drainChanges()
+
+def watchCommand(someArgs) :
+  """
+  Run the `cfdoit watch` command, returning its returncode.
+  """
+  CfdoitDaemon.startedAt = time.time()
+  try :
+    splitRunArgs(someArgs)
+  except CmdParseError as err :
+    print(str(err))
+    return 1
+  try :
+    Watcher(someArgs).run()
+  except KeyboardInterrupt :
+    print("\nStopped watching")
+  return 0
@@ -2,18 +2,31 @@
 import os
 import platform
 import pprint
+import queue
 import tempfile
+import threading
+import time
+import uuid
 import yaml
 
 from doit.action     import BaseAction, CmdAction
 #from doit.cmd_base   import DoitCmdBase
 from doit.cmd_info   import opt_hide_status, Info
-from doit.exceptions import InvalidCommand
+from doit.exceptions import InvalidCommand, TaskFailed
 
 from cfdoit.config import Config
+from cfdoit.batching import BatchCoalescer
+from cfdoit.circuitBreaker import CircuitBreaker
+from cfdoit.inFlight import InFlight
+from cfdoit.jobServer import JobServer
+from cfdoit.localFarm import LocalFarm
+from cfdoit.scratch import Scratch
+from cfdoit.staging import Staging
+from cfdoit.taskHistory import TaskHistory
 from cfdoit.computeFarmTools import (
   tcpTMConnection, tcpTMSentRequest, tcpTMGetResult,
-  tcpTMCollectResults, tcpTMCloseConnection, compileActionScript
+  tcpTMCollectTaskResult, tcpTMCollectBatchResults,
+  tcpTMCloseConnection, compileActionScript
 )
 
 # copied from pydoit/cmd_info:Info._execute
@@ -107,6 +120,28 @@ class WorkerTask(BaseAction) :
   availableWorkers   = {}
   baseDirectory      = os.path.abspath(os.getcwd())
 
+  # The (process wide) coalescer of batchable remote task requests, together
+  # with the running estimate of the per-task duration for each batch key.
+  remoteBatcher  = None
+  batcherLock    = threading.Lock()
+  batchDurations = {}
+
+  # The (process wide) budget of individual re-sends of the tasks missing
+  # from incomplete batch replies (see `takeBatchRetry`).
+  batchRetries = 1.0
+
+  # The (process wide) circuit breaker guarding the taskManager connections.
+  tmBreaker   = None
+  breakerLock = threading.Lock()
+
+  # The environment variables which (normally) differ between otherwise
+  # identical tasks, and so are not part of a task's "environment profile".
+  perTaskEnvKeys = [ 'taskName', 'doitTaskName', 'in', 'out', 'srcBaseName' ]
+
+  # The environment variables which identify a task's root task (see
+  # `affinityHints`), and so are always kept in a task's (minimal) environment.
+  identityEnvKeys = [ 'taskName', 'platform', 'repoPath', 'repoVersion' ]
+
   def __init__(self, actionsDict) :
     """
     Initialize the WorkerTasks class.
@@ -135,6 +170,11 @@ class WorkerTask(BaseAction) :
     self.estimatedLoad = 0.5
     if 'estimatedLoad' in actionsDict :
       self.estimatedLoad = actionsDict['estimatedLoad']
+    self.jobServerLoad = None
+    if 'jobServerLoad' in actionsDict :
+      self.jobServerLoad = actionsDict['jobServerLoad']
+    self.batchable = False
+    if 'batchable' in actionsDict : self.batchable = actionsDict['batchable']
     self.values  = {}
     self.out     = None
     self.err     = None
@@ -143,12 +183,14 @@ class WorkerTask(BaseAction) :
   def __str__(self) :
     selfStrs = yaml.dump({
       'actions'       : self.actions,
-      'environment'   : self.env,
+      'environment'   : dict(self.env),
       'tools'         : self.tools,
       'workers'       : self.workers,
       'aliases'       : self.aliases,
       'platform'      : self.requiredPlatform,
       'estimatedLoad' : self.estimatedLoad,
+      'jobServerLoad' : self.jobServerLoad,
+      'batchable'     : self.batchable,
       'baseDir'       : self.baseDir
     }).split('\n')
     selfStr = "\n   ".join(selfStrs)
@@ -161,14 +203,18 @@ class WorkerTask(BaseAction) :
     Connect to the taskManager and (re)request the currently registered types of
     workers.
     """
+    tmConfig = Config.config.get('GLOBAL', {}).get('taskManager', {})
     queryRequest = {
-      'progName' : "",
-      'host'     : "127.0.0.1",
-      'port'     : 8888,
-      'type'     : "workerQuery",
-      'taskName' : "workerQuery",
-      'taskType' : "workerQuery",
-      'verbose'  : False
+      'progName'       : "",
+      'host'           : tmConfig.get('host', "127.0.0.1"),
+      'port'           : tmConfig.get('port', 8888),
+      'type'           : "workerQuery",
+      'taskName'       : "workerQuery",
+      'taskType'       : "workerQuery",
+      'connectTimeOut' : tmConfig.get('connectTimeOut', None),
+      'sendTimeOut'    : tmConfig.get('sendTimeOut', None),
+      'readTimeOut'    : tmConfig.get('queryTimeOut', None),
+      'verbose'        : False
     }
 
     thisPlatform = platform.system().lower()+'-'+platform.machine().lower()
@@ -176,8 +222,16 @@ class WorkerTask(BaseAction) :
       'any'        : True, 
       thisPlatform : True
     }
+    LocalFarm.pools = None
 
     tmSocket = tcpTMConnection(queryRequest)
+    if not tmSocket :
+      # without a taskManager, use the local pools described by `workers`
+      localInventory = LocalFarm.install()
+      if localInventory :
+        WorkerTask.availableTools   = localInventory['tools']
+        WorkerTask.availableWorkers = localInventory['workers']
+        WorkerTask.availablePlatforms.update(localInventory['hostTypes'])
     if tmSocket :
       if tcpTMSentRequest(queryRequest, tmSocket) :
         result = tcpTMGetResult(tmSocket)
@@ -210,6 +264,9 @@ class WorkerTask(BaseAction) :
     # start by trying to access the taskManager
     if WorkerTask.availablePlatforms is None : WorkerTask.getWorkerTypes()
 
+    # staged tasks run in the root of (a copy of) this tree, see `Staging`
+    if Staging.isEnabled() : return '.'
+
     if aDir.startswith(WorkerTask.baseDirectory) : 
       return aDir.replace(WorkerTask.baseDirectory, '.')
     return None
@@ -227,6 +284,9 @@ class WorkerTask(BaseAction) :
     # start by trying to access the taskManager
     if WorkerTask.availablePlatforms is None : WorkerTask.getWorkerTypes()
 
+    # the local pools (if any) are matched in the same way, see `LocalFarm`
+    if LocalFarm.isActive() : return LocalFarm.workersFor(aPlatform, requiredTools)
+
     # first check if the platform is known to the taskManager
     if aPlatform not in WorkerTask.availablePlatforms : return []
 
@@ -256,6 +316,416 @@ class WorkerTask(BaseAction) :
 
     return list(workersFound)
 
+  def getRemoteBatcher() :
+    """
+    Return the (process wide) coalescer of batchable remote task requests.
+    """
+    with WorkerTask.batcherLock :
+      if WorkerTask.remoteBatcher is None :
+        tmConfig = Config.config['GLOBAL']['taskManager']
+        WorkerTask.remoteBatcher = BatchCoalescer(
+          WorkerTask.runRemoteBatch,
+          window=tmConfig['batchWindow'],
+          batchSizeFor=WorkerTask.remoteBatchSizeFor
+        )
+      return WorkerTask.remoteBatcher
+
+  def doitDefaults(cfdoitConfig) :
+    """
+    Return the `doit` (DOIT_CONFIG) defaults required to coalesce batchable
+    remote tasks (unless `par_type` has been configured in `cfdoitConfig`).
+
+    Batches are only coalesced from `doit`'s task threads, so when batching
+    has been enabled `doit` runs tasks in threads (`-P thread`).
+    """
+    gConfig = cfdoitConfig.get('GLOBAL', {})
+    if not gConfig.get('taskManager', {}).get('batch', False) : return {}
+    if 'par_type' in gConfig : return {}
+    return { 'par_type' : 'thread' }
+
+  def checkBatching(someArgs, doitConfig, someDefaults) :
+    """
+    Warn if batching has been enabled but `doit` has been asked (on the
+    command line `someArgs`, in the `doitConfig` or the DOIT_CONFIG
+    `someDefaults`) to run tasks in several processes, where every batch would
+    contain exactly one task.
+    """
+    gConfig = dict(someDefaults)
+    gConfig.update(doitConfig.get('GLOBAL', {}))
+    if not gConfig.get('taskManager', {}).get('batch', False) : return
+    if InFlight.runsInProcesses(someArgs, { 'GLOBAL' : gConfig }) :
+      print("Warning: remote tasks are only batched when doit runs tasks in threads (use -P thread)")
+
+  def takeBatchRetry() :
+    """
+    Take one (individual) re-send of a task missing from an incomplete batch
+    reply from the retry budget, returning False if the budget is exhausted
+    (in which case the task should be run locally).
+
+    Each batch which is sent adds `batchRetryRatio` re-sends (per task) to
+    the budget, so that a flaky taskManager can never (nearly) double the
+    number of requests sent to it.
+    """
+    with WorkerTask.batcherLock :
+      if WorkerTask.batchRetries < 1.0 : return False
+      WorkerTask.batchRetries -= 1.0
+      return True
+
+  def addBatchRetries(numTasks) :
+    tmConfig = Config.config['GLOBAL']['taskManager']
+    with WorkerTask.batcherLock :
+      WorkerTask.batchRetries = min(
+        float(tmConfig['maxBatchSize']),
+        WorkerTask.batchRetries + tmConfig['batchRetryRatio'] * numTasks
+      )
+
+  def getCircuitBreaker() :
+    """
+    Return the (process wide) circuit breaker guarding the taskManager
+    connections.
+    """
+    with WorkerTask.breakerLock :
+      if WorkerTask.tmBreaker is None :
+        tmConfig = Config.config['GLOBAL']['taskManager']
+        WorkerTask.tmBreaker = CircuitBreaker(
+          maxFailures=tmConfig['breakerFailures'],
+          coolDown=tmConfig['breakerCoolDown']
+        )
+      return WorkerTask.tmBreaker
+
+  def recordOutcome(returnCode, cancelled=False) :
+    """
+    Record the outcome of a remote request (with the `returnCode`) in the
+    circuit breaker. Requests which were cancelled (or lost because the build
+    was aborted, or abandoned because a live connection went idle) say
+    nothing about the taskManager's health.
+    """
+    if returnCode is not None :
+      WorkerTask.getCircuitBreaker().recordSuccess()
+    elif not cancelled and not InFlight.isAborted() :
+      WorkerTask.getCircuitBreaker().recordFailure()
+
+  def idleTimeOut() :
+    """
+    Return the deadline (in seconds) for each read of a remote request's
+    results (None if the taskManager may stay silent for as long as the task
+    runs).
+    """
+    idleTimeOut = Config.config['GLOBAL']['taskManager'].get('idleTimeOut', 0)
+    if not idleTimeOut : return None
+    return idleTimeOut
+
+  def stopAbandoned(requestId, someResults) :
+    """
+    Cancel the (abandoned) remote request `requestId` whose connection was
+    lost (or went idle) before all of its `someResults` were complete, so
+    that the remote copies of its tasks can not race a local (or repeated)
+    run of the same tasks.
+
+    Each incomplete result is marked as `stopped` if the taskManager
+    acknowledged the cancellation.
+    """
+    incomplete = [ aResult for aResult in someResults if aResult['returncode'] is None ]
+    if not incomplete or InFlight.isAborted() : return
+    stopped = InFlight.sendCancel(requestId)
+    if not stopped :
+      print(f"Could not confirm that the abandoned remote request {requestId} was cancelled")
+    for aResult in incomplete : aResult['stopped'] = stopped
+
+  def mayStillRun(aResult) :
+    """
+    Return True if the (incomplete) remote request of `aResult` might still
+    be running (its cancellation was not acknowledged).
+    """
+    if not isinstance(aResult, dict) or aResult['returncode'] is not None :
+      return False
+    return not aResult.get('stopped', True)
+
+  def remoteBatchSizeFor(aBatchKey) :
+    """
+    Adapt the size of a batch so that each batch takes (roughly) the configured
+    `batchTargetSeconds` given the measured per-task durations of previous
+    batches with the same batch key.
+    """
+    tmConfig     = Config.config['GLOBAL']['taskManager']
+    maxBatchSize = tmConfig['maxBatchSize']
+    perTask      = WorkerTask.batchDurations.get(aBatchKey, None)
+    if not perTask : return maxBatchSize
+    batchSize = int(tmConfig['batchTargetSeconds'] / perTask)
+    return max(1, min(maxBatchSize, batchSize))
+
+  def runRemoteBatch(aBatchKey, someTaskRequests) :
+    """
+    Send a batch of task requests (which share a platform, tools and
+    environment profile) to the taskManager as one `batchRequest`.
+
+    Returns a list of per-task results (see `tcpTMCollectBatchResults`), or
+    Nones if the batch could not be sent.
+    """
+    tmConfig = Config.config['GLOBAL']['taskManager']
+    firstRequest = someTaskRequests[0]
+    batchRequest = {
+      'host'             : tmConfig['host'],
+      'port'             : tmConfig['port'],
+      'type'             : "batchRequest",
+      'taskName'         : f"batch-{firstRequest['taskName']}-{len(someTaskRequests)}",
+      'requestId'        : uuid.uuid4().hex,
+      'workers'          : firstRequest['workers'],
+      'requiredPlatform' : firstRequest['requiredPlatform'],
+      'estimatedLoad'    : firstRequest['estimatedLoad'],
+      'runConcurrently'  : True,
+      'tasks'            : [],
+      'timeOut'          : sum(aRequest['timeOut'] for aRequest in someTaskRequests),
+      'connectTimeOut'   : firstRequest['connectTimeOut'],
+      'sendTimeOut'      : firstRequest['sendTimeOut'],
+      'logPath'          : 'stdout',
+      'verbose'          : False
+    }
+    taskNames = []
+    for aTaskRequest in someTaskRequests :
+      taskNames.append(aTaskRequest['taskName'])
+      aBatchTask = {
+        'taskName' : aTaskRequest['taskName'],
+        'actions'  : aTaskRequest['actions'],
+        'env'      : aTaskRequest['env'],
+        'dir'      : aTaskRequest['dir']
+      }
+      if 'affinity' in aTaskRequest : aBatchTask['affinity'] = aTaskRequest['affinity']
+      if 'staging'  in aTaskRequest : aBatchTask['staging']  = aTaskRequest['staging']
+      batchRequest['tasks'].append(aBatchTask)
+
+    print(f"Sending a batch of {len(taskNames)} tasks to the taskManager")
+    startTime = time.time()
+    batchRequest['readTimeOut'] = WorkerTask.idleTimeOut()
+    tmSocket  = tcpTMConnection(batchRequest)
+    if not tmSocket :
+      WorkerTask.recordOutcome(None)
+      return [ None for aTaskName in taskNames ]
+    if not tcpTMSentRequest(batchRequest, tmSocket) or \
+       not InFlight.register(batchRequest['requestId'], tmSocket, taskNames) :
+      WorkerTask.recordOutcome(None)
+      tcpTMCloseConnection(tmSocket)
+      return [ None for aTaskName in taskNames ]
+    WorkerTask.addBatchRetries(len(taskNames))
+    status  = {}
+    results = tcpTMCollectBatchResults(tmSocket, taskNames, status)
+    WorkerTask.stopAbandoned(batchRequest['requestId'], results.values())
+    InFlight.unregister(batchRequest['requestId'])
+    returnCodes = [ aResult['returncode'] for aResult in results.values() ]
+    WorkerTask.recordOutcome(
+      0 if any(aCode is not None for aCode in returnCodes) else None,
+      status.get('timedOut', False)
+    )
+    elapsed = time.time() - startTime
+
+    # update the estimated per-task duration for this batch key
+    durations = []
+    for aResult in results.values() :
+      if aResult['returncode'] is None : continue
+      if 'duration' in aResult : durations.append(aResult['duration'])
+    if durations : perTask = sum(durations) / len(durations)
+    else         : perTask = elapsed / len(taskNames)
+    lastPerTask = WorkerTask.batchDurations.get(aBatchKey, None)
+    if lastPerTask : perTask = 0.7 * lastPerTask + 0.3 * perTask
+    WorkerTask.batchDurations[aBatchKey] = perTask
+
+    return [ results[aTaskName] for aTaskName in taskNames ]
+
+  def batchKey(self) :
+    """
+    Return the key used to coalesce this task with other batchable tasks
+    which share the same platform, tools, workers and environment profile.
+    """
+    envProfile = []
+    for aKey, aValue in sorted(self.env.items()) :
+      if aKey in WorkerTask.perTaskEnvKeys : continue
+      envProfile.append((aKey, str(aValue)))
+    return (
+      self.requiredPlatform,
+      tuple(sorted(self.tools)),
+      tuple(sorted(self.workers)),
+      hash(tuple(envProfile))
+    )
+
+  def affinityKey(self) :
+    """
+    Return the key (of this task's root task and platform) under which the
+    workers which ran this task are recorded (None if the root task is not
+    known).
+    """
+    if 'taskName' not in self.env : return None
+    aPlatform = self.env.get('platform', self.requiredPlatform)
+    return f"root:{aPlatform}:{self.env['taskName']}"
+
+  def affinityHints(self) :
+    """
+    Return the (soft) placement hints for this task: the workers which most
+    recently ran tasks of the same root task (and so have warm caches and
+    build directories), the keys of the cached content this task uses, and
+    how long the taskManager should wait for one of the preferred workers
+    (before using any other matching worker).
+
+    Returns None if the hints have been disabled (or the root task is not
+    known).
+    """
+    tmConfig = Config.config['GLOBAL']['taskManager']
+    anAffinityKey = self.affinityKey()
+    if not tmConfig['affinity'] or anAffinityKey is None : return None
+    cacheKeys = [ anAffinityKey ]
+    if 'repoPath' in self.env :
+      cacheKeys.append(f"repo:{self.env['repoPath']}@{self.env.get('repoVersion', '')}")
+    return {
+      'key'              : anAffinityKey,
+      'preferredWorkers' : TaskHistory.workersFor(anAffinityKey),
+      'cacheKeys'        : cacheKeys,
+      'preferredWait'    : tmConfig['affinityWaitSeconds']
+    }
+
+  def remoteResult(self, aResult, startTime, aStaging=None) :
+    """
+    Record the result (dict) of running this task on a remote worker
+    (together with the worker which ran it, if known), writing any staged
+    targets (see `Staging`).
+
+    Returns a `TaskFailed` if the remote task failed.
+    """
+    TaskHistory.recordDuration(self.task.name, time.time() - startTime)
+    anAffinityKey = self.affinityKey()
+    if aResult.get('worker', None) and anAffinityKey :
+      TaskHistory.recordWorker(anAffinityKey, aResult['worker'])
+    returnCode  = aResult['returncode']
+    self.out    = "\n".join(aResult['msgs'])
+    self.err    = ""
+    # like a CmdAction, the result is the task's output (so that `doit`'s
+    # `result_dep` can detect when a remote task's result has changed)
+    self.result = self.out
+    if returnCode != 0 :
+      return TaskFailed(
+        f"Remote task {self.task.name} failed: returned {returnCode}"
+      )
+    if aStaging :
+      anError = Staging.writeTargets(aStaging, aResult.get('targets', []))
+      if anError : return TaskFailed(f"Remote task {self.task.name} failed: {anError}")
+    return None
+
+  def timeOutFor(taskName) :
+    """
+    Return the time out (in seconds) of a remote request for the task
+    `taskName`, adapted from the longest recorded duration of the task (or
+    the configured `timeOut` if the task has never been run).
+    """
+    tmConfig = Config.config['GLOBAL']['taskManager']
+    longest  = TaskHistory.expectedDuration(taskName, 100)
+    if longest is None : return tmConfig['timeOut']
+    aTimeOut = longest * tmConfig['timeOutFactor']
+    return min(tmConfig['maxTimeOut'], max(tmConfig['minTimeOut'], aTimeOut))
+
+  def speculationDelay(taskName) :
+    """
+    Return how long (in seconds) to wait for a remote request for the task
+    `taskName` before (speculatively) sending a duplicate request, or None if
+    speculation is disabled (or the task has never been run).
+    """
+    tmConfig = Config.config['GLOBAL']['taskManager']
+    if not tmConfig['speculate'] : return None
+    expected = TaskHistory.expectedDuration(
+      taskName, tmConfig['speculatePercentile']
+    )
+    if expected is None : return None
+    return max(tmConfig['speculateMinSeconds'], expected * tmConfig['speculateFactor'])
+
+  def startRemoteRequest(taskRequest, finished) :
+    """
+    Send the `taskRequest` to the taskManager and collect its results (in a
+    background thread) into a result dict, which is put on the `finished`
+    queue once the request has completed.
+
+    Returns the result dict (or None if the request could not be sent).
+    """
+    tmSocket = tcpTMConnection(taskRequest)
+    if not tmSocket :
+      WorkerTask.recordOutcome(None)
+      return None
+    if not tcpTMSentRequest(taskRequest, tmSocket) or not InFlight.register(
+      taskRequest['requestId'], tmSocket, [ taskRequest['taskName'] ]
+    ) :
+      WorkerTask.recordOutcome(None)
+      tcpTMCloseConnection(tmSocket)
+      return None
+    aResult = {
+      'requestId'  : taskRequest['requestId'],
+      'socket'     : tmSocket,
+      'msgs'       : [],
+      'returncode' : None,
+      'done'       : False,
+      'cancelled'  : False
+    }
+    def collectResults() :
+      tcpTMCollectTaskResult(tmSocket, aResult)
+      if not aResult['cancelled'] :
+        WorkerTask.stopAbandoned(aResult['requestId'], [ aResult ])
+      InFlight.unregister(aResult['requestId'])
+      WorkerTask.recordOutcome(
+        aResult['returncode'],
+        aResult['cancelled'] or aResult.get('timedOut', False)
+      )
+      aResult['done'] = True
+      finished.put(aResult)
+    threading.Thread(target=collectResults, daemon=True).start()
+    return aResult
+
+  def runRemoteRequest(self, taskRequest) :
+    """
+    Run the `taskRequest` on a remote worker, returning its result dict (or
+    None if the request could not be sent).
+
+    If speculation is enabled and the request takes longer than expected
+    (see `speculationDelay`), a duplicate request (excluding the worker
+    running the original request, if known) is sent, the first successful
+    result is used, and the other request is cancelled.
+    """
+    finished = queue.Queue()
+    primary  = WorkerTask.startRemoteRequest(taskRequest, finished)
+    if primary is None : return None
+
+    delay = WorkerTask.speculationDelay(self.task.name)
+    if delay is None : return finished.get()
+    try :
+      return finished.get(timeout=delay)
+    except queue.Empty :
+      pass
+
+    duplicateRequest = dict(taskRequest)
+    duplicateRequest['requestId']   = uuid.uuid4().hex
+    duplicateRequest['speculative'] = True
+    # (the preferred workers are most likely running the original request)
+    duplicateRequest.pop('affinity', None)
+    if 'worker' in primary :
+      duplicateRequest['excludeWorkers'] = [ primary['worker'] ]
+    print(f"{self.task.name} is straggling (> {delay:.1f}s), speculatively re-running it")
+    duplicate = WorkerTask.startRemoteRequest(duplicateRequest, finished)
+    if duplicate is None : return finished.get()
+
+    racing  = [ primary, duplicate ]
+    results = []
+    while len(results) < len(racing) :
+      aResult = finished.get()
+      results.append(aResult)
+      if aResult['returncode'] == 0 : break
+
+    for aResult in racing :
+      if not aResult['done'] :
+        aResult['cancelled'] = True
+        InFlight.cancel(aResult['requestId'])
+
+    # the first successful result (or the first result which completed)
+    theResult = results[-1]
+    if theResult['returncode'] != 0 :
+      completed = [ aResult for aResult in results if aResult['returncode'] is not None ]
+      if completed : theResult = completed[0]
+    if theResult is duplicate : print(f"The speculative {self.task.name} won")
+    return theResult
+
   def execute(self, out=None, err=None) :
     """
     Execute the WorkerTask by forwarding this task description to the
@@ -263,18 +733,74 @@ class WorkerTask(BaseAction) :
 
     The ComputeFarm task manager is specified in the `cfdoit` configuration.
 
+    If the task is `batchable` and batching has been enabled (the `batch` key
+    of the `taskManager` configuration), then this task is sent to the task
+    manager in a batch together with any other batchable tasks which are ready
+    to run at the same time. A task missing from an (incomplete) batch reply is
+    re-sent on its own only while the retry budget (see `takeBatchRetry`)
+    allows, otherwise it is run locally.
+
+    If staging has been enabled (the `staging` key of the `taskManager`
+    configuration, see `Staging`), the task's inputs are sent to (and its
+    targets pulled back from) the worker, which need not share this tree.
+
     If no ComputeFarm task manager can be contacted, then this task will
-    fallback to simply using the resources of the local computer.
+    fallback to simply using the resources of the local computer (sharing the
+    local jobserver, if it has been enabled), running in one of the local
+    worker pools (if any, see `LocalFarm`).
+
+    Once the build has been aborted (see `InFlight`) no further tasks are
+    run, and (unless `doit` is continuing after failures) the first failure
+    aborts the build.
     """
  
     print(f"Running WorkerTask execute for {self.task}")
 
-    if 0 < len(self.workers) and 'localWorker' not in self.workers :
+    if InFlight.isAborted() :
+      return TaskFailed(
+        f"{self.task.name} was not run: the build was aborted ({InFlight.aborted})"
+      )
+    failure = self.dispatch(out, err)
+    if failure is not None : InFlight.taskFailed(self.task.name)
+    return failure
+
+  def localLoad(self) :
+    """
+    Return the load this task places on this host when it is run locally.
+
+    While this command's jobserver is running, a task's (make/ninja) builds
+    share the jobserver's job slots, so the task's `jobServerLoad` (if any)
+    is used instead of its `estimatedLoad`. (Remote workers can not see this
+    command's jobserver, so remote requests always use the `estimatedLoad`.)
+    """
+    if JobServer.fifoPath and self.jobServerLoad is not None :
+      return self.jobServerLoad
+    return self.estimatedLoad
+
+  def dispatch(self, out, err) :
+    """
+    Run this task (remotely, in a local pool, or locally).
+    """
+
+    startTime = time.time()
+    if LocalFarm.hasPools(self.workers) :
+      # run this task in one of the (matching) local pools
+      aLoad = self.localLoad()
+      aPool = LocalFarm.admit(self.workers, aLoad)
+      print(f"Running {self.task} in the local {aPool.name} pool")
+      try :
+        return self.runLocally(out, err, startTime)
+      finally :
+        LocalFarm.release(aPool, aLoad)
+
+    if 0 < len(self.workers) and 'localWorker' not in self.workers and \
+       WorkerTask.getCircuitBreaker().allowRequest() :
       # Try to send this task to a computeFarm taskManager....
       #Config.printConfig()
+      tmConfig = Config.config['GLOBAL']['taskManager']
       taskRequest = {
-        'host'             : Config.config['GLOBAL']['taskManager']['host'],
-        'port'             : Config.config['GLOBAL']['taskManager']['port'],
+        'host'             : tmConfig['host'],
+        'port'             : tmConfig['port'],
         'type'             : "taskRequest",
         'taskName'         : self.task.name,
         'workers'          : self.workers,
@@ -283,25 +809,93 @@ class WorkerTask(BaseAction) :
         'requiredPlatform' : self.requiredPlatform,
         'estimatedLoad'    : self.estimatedLoad,
         'dir'              : self.baseDir,
-        'timeOut'          : 100,
+        'requestId'        : uuid.uuid4().hex,
+        'timeOut'          : WorkerTask.timeOutFor(self.task.name),
+        'connectTimeOut'   : tmConfig['connectTimeOut'],
+        'sendTimeOut'      : tmConfig['sendTimeOut'],
+        'useJobServer'     : JobServer.isEnabled(),
         'logPath'          : 'stdout',
         'verbose'          : False
       }
+      # (the taskManager may stay silent while the task runs, so the
+      # whole-task `timeOut` is enforced by the taskManager, not by our reads)
+      taskRequest['readTimeOut'] = WorkerTask.idleTimeOut()
+      affinity = self.affinityHints()
+      if affinity : taskRequest['affinity'] = affinity
+      if Staging.isEnabled() :
+        taskRequest['staging'] = Staging.stageTask(self.task)
+        if taskRequest['staging'] is None :
+          # the inputs could not be staged... so run this task locally
+          WorkerTask.recordOutcome(None)
+          return self.runLocally(out, err, startTime)
+      aStaging = taskRequest.get('staging', None)
       #print("==============")
       #print(yaml.dump(taskRequest))
       #print("==============")
-      tmSocket = tcpTMConnection(taskRequest)
-      if tmSocket and tcpTMSentRequest(taskRequest, tmSocket) :
-        resultsArray = []
-        self.result = tcpTMCollectResults(tmSocket, resultsArray)
-        self.out    = "\n".join(resultsArray)
-        self.err    = ""
-        # self.values = ???
-        return 
+      InFlight.addTask(self.task.name, self.task.targets)
+      try :
+        if self.batchable and tmConfig['batch'] :
+          result = WorkerTask.getRemoteBatcher().submit(
+            self.batchKey(), taskRequest
+          )
+          if isinstance(result, dict) and result['returncode'] is not None :
+            return self.remoteResult(result, startTime, aStaging)
+          if WorkerTask.mayStillRun(result) : return self.abandonedFailure()
+          # the batch failed to run this task... so try it on its own (if the
+          # retry budget, and the circuit breaker, allow), otherwise locally
+          retryRemotely = WorkerTask.takeBatchRetry() and \
+            WorkerTask.getCircuitBreaker().allowRequest()
+        else :
+          retryRemotely = True
+        if retryRemotely and not InFlight.isAborted() :
+          result = self.runRemoteRequest(taskRequest)
+          if result and result['returncode'] is not None :
+            # self.values = ???
+            return self.remoteResult(result, startTime, aStaging)
+          if WorkerTask.mayStillRun(result) : return self.abandonedFailure()
+      finally :
+        InFlight.removeTask(self.task.name)
+      if InFlight.isAborted() :
+        # (do NOT fall back to running a cancelled task locally)
+        return TaskFailed(
+          f"Remote task {self.task.name} was cancelled: the build was aborted ({InFlight.aborted})"
+        )
 
     # that did not work or we only have the localWorker....
     # ... so lob it over the fence and hope it works!
     #print(f"WARNING: no valid workers could be found for {self.task}")
+    return self.runLocally(out, err, startTime)
+
+  def abandonedFailure(self) :
+    # (running this task locally could race the remote copy for its targets)
+    return TaskFailed(
+      f"Remote task {self.task.name} was abandoned, but its cancellation was not acknowledged: NOT re-running it locally"
+    )
+
+  def runScript(self, scriptPath, out, err, aDir=None) :
+    """
+    Run the (local) action script `scriptPath` (in the directory `aDir`, if
+    given) as a `CmdAction`.
+    """
+    # share this host's jobserver (if any) with the task's (make/ninja)
+    # builds, holding a token for the task's own (implicit) job slot
+    myAction = CmdAction(scriptPath, self.task, env=JobServer.environment(), cwd=aDir)
+    aToken = JobServer.acquire()
+    try :
+      failure = myAction.execute(out, err)
+    finally :
+      JobServer.release(aToken)
+    self.result = myAction.result
+    self.out    = myAction.out
+    self.err    = myAction.err
+    self.values = myAction.values
+    return failure
+
+  def runLocally(self, out, err, startTime) :
+    """
+    Run this task's actions (as a shell script) on this host (in a tmpfs
+    scratch directory, if the scratch mode has been enabled, see `Scratch`).
+    """
     actionScript = compileActionScript(self.aliases, self.env, self.actions)
     #print("---------------------------------------")
     #print(actionScript)
@@ -311,10 +905,23 @@ class WorkerTask(BaseAction) :
     tmpFile.close()
     os.chmod(tmpFile.name, 0o755)
     print(f"Running local workerTask {tmpFile.name} as CmdAction for {self.task}")
-    myAction = CmdAction(tmpFile.name, self.task)
-    myAction.execute(out, err)
-    self.result = myAction.result
-    self.out    = myAction.out
-    self.err    = myAction.err
-    self.values = myAction.values
-    os.unlink(tmpFile.name)
+    aScratch = Scratch.begin(self.task)
+    try :
+      if aScratch is None :
+        failure = self.runScript(tmpFile.name, out, err)
+      else :
+        failure = self.runScript(tmpFile.name, out, err, aScratch['dir'])
+        if failure is None :
+          anError = Scratch.moveTargets(aScratch)
+          if anError : failure = TaskFailed(f"Local task {self.task.name} failed: {anError}")
+        elif Scratch.exhausted(aScratch) :
+          print(f"The scratch space filled up... re-running {self.task.name} on disk")
+          Scratch.end(aScratch)
+          aScratch = None
+          failure = self.runScript(tmpFile.name, out, err)
+    finally :
+      if aScratch is not None : Scratch.end(aScratch)
+      os.unlink(tmpFile.name)
+    if failure is None :
+      TaskHistory.recordDuration(self.task.name, time.time() - startTime)
+    return failure
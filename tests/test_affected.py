@@ -0,0 +1,46 @@
+"""
+Check the configuration and description files which the dependency index of
+`cfdoit affected` depends upon (see `cfdoit.affected.configuredPaths`).
+"""
+
+import os
+
+from cfdoit.affected import configuredPaths, indexIsStale
+
+def writeFile(aPath, someText='') :
+  os.makedirs(os.path.dirname(aPath) or '.', exist_ok=True)
+  with open(aPath, 'w') as aFile : aFile.write(someText)
+
+def test_descriptionPathsAreResolvedLikeConfig(tmp_path, monkeypatch) :
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+  writeFile('cfdoit.toml')
+  writeFile('project.yaml')
+  writeFile(os.path.join('out', 'descs', 'generated.yaml'))
+  writeFile(os.path.join('out', 'descs', 'notes.txt'))
+  writeFile(os.path.join('descs', 'shared.yaml'))
+
+  somePaths = configuredPaths({
+    'buildDir'     : 'out',
+    'projDescPath' : 'project.yaml',
+    'descPaths'    : [ '$buildDir/descs', 'descs/shared.yaml', 'missing.yaml' ]
+  })
+  assert somePaths == [
+    'cfdoit.toml',
+    'project.yaml',
+    os.path.join('out', 'descs', 'generated.yaml'),
+    os.path.join('descs', 'shared.yaml')
+  ]
+
+def test_indexIsStaleWhenTheProjectDescriptionChanges(tmp_path, monkeypatch) :
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+  writeFile('project.yaml')
+  writeFile('index.json')
+  buildConfig = { 'projDescPath' : 'project.yaml' }
+  os.utime('project.yaml', (1000, 1000))
+  assert not indexIsStale('index.json', buildConfig)
+  os.utime('project.yaml', None)
+  os.utime('index.json', (1000, 1000))
+  assert indexIsStale('index.json', buildConfig)
+  assert indexIsStale('missing.json', buildConfig)
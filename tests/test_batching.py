@@ -0,0 +1,97 @@
+"""
+Check the coalescing of concurrently submitted items into batches (see
+`cfdoit.batching`), and the retry budget of incomplete remote batches.
+"""
+
+import threading
+import time
+
+from cfdoit.batching import BatchCoalescer
+from cfdoit.config import Config
+from cfdoit.workerTasks import WorkerTask
+
+def newCoalescer(window=5.0, batchSize=32) :
+  batches = []
+  def runBatch(aKey, someItems) :
+    batches.append((aKey, list(someItems)))
+    return [ (aKey, anItem) for anItem in someItems ]
+  aCoalescer = BatchCoalescer(
+    runBatch, window=window, batchSizeFor=lambda aKey : batchSize
+  )
+  return aCoalescer, batches
+
+def submitFromThreads(aCoalescer, someItems, aKey='k') :
+  results = {}
+  started = threading.Barrier(len(someItems))
+  def submit(anItem) :
+    started.wait()
+    results[anItem] = aCoalescer.submit(aKey, anItem)
+  threads = [ threading.Thread(target=submit, args=(anItem,)) for anItem in someItems ]
+  for aThread in threads : aThread.start()
+  for aThread in threads : aThread.join()
+  return results
+
+def test_singleSubmitterDoesNotWaitForTheWindow() :
+  aCoalescer, batches = newCoalescer(window=5.0)
+  startTime = time.time()
+  assert aCoalescer.submit('k', 1) == ('k', 1)
+  assert aCoalescer.submit('k', 2) == ('k', 2)
+  assert time.time() - startTime < 1.0
+  assert batches == [ ('k', [ 1 ]), ('k', [ 2 ]) ]
+
+def test_concurrentSubmittersShareOneBatch() :
+  aCoalescer, batches = newCoalescer(window=0.05)
+  firstRoundDone    = threading.Barrier(9)
+  secondRoundStarts = threading.Barrier(9)
+  results = {}
+  def submit(anItem) :
+    # (a first round makes all of the threads known submitters)
+    aCoalescer.submit('k', anItem)
+    firstRoundDone.wait()
+    secondRoundStarts.wait()
+    results[anItem+8] = aCoalescer.submit('k', anItem+8)
+  threads = [ threading.Thread(target=submit, args=(anItem,)) for anItem in range(8) ]
+  for aThread in threads : aThread.start()
+  firstRoundDone.wait()
+  batches.clear()
+  aCoalescer.window = 5.0
+  startTime = time.time()
+  secondRoundStarts.wait()
+  for aThread in threads : aThread.join()
+  for anItem, aResult in results.items() : assert aResult == ('k', anItem)
+  assert len(batches) == 1
+  assert sorted(batches[0][1]) == list(range(8, 16))
+  # (the batch closes as soon as every known submitter is waiting)
+  assert time.time() - startTime < 5.0
+
+def test_batchesAreLimitedInSize() :
+  aCoalescer, batches = newCoalescer(window=0.2, batchSize=3)
+  results = submitFromThreads(aCoalescer, list(range(10)))
+  assert len(results) == 10
+  assert max(len(someItems) for aKey, someItems in batches) <= 3
+
+def test_differentKeysAreNotMixed() :
+  aCoalescer, batches = newCoalescer(window=0.2)
+  submitFromThreads(aCoalescer, [ 1, 2, 3 ], 'a')
+  submitFromThreads(aCoalescer, [ 4, 5 ], 'b')
+  for aKey, someItems in batches :
+    if aKey == 'a' : assert set(someItems) <= { 1, 2, 3 }
+    else           : assert set(someItems) <= { 4, 5 }
+
+def test_batchExceptionIsEveryItemsResult() :
+  def runBatch(aKey, someItems) : raise ValueError("broken")
+  aCoalescer = BatchCoalescer(runBatch)
+  aResult = aCoalescer.submit('k', 1)
+  assert isinstance(aResult, ValueError)
+
+def test_batchRetryBudget() :
+  Config.config = {}
+  Config.updateConfig({ 'GLOBAL' : {} })
+  WorkerTask.batchRetries = 1.0
+  assert WorkerTask.takeBatchRetry()
+  assert not WorkerTask.takeBatchRetry()
+  # (a batch of 20 tasks adds 20 * batchRetryRatio (0.1) re-sends)
+  WorkerTask.addBatchRetries(20)
+  assert WorkerTask.takeBatchRetry()
+  assert WorkerTask.takeBatchRetry()
+  assert not WorkerTask.takeBatchRetry()
@@ -0,0 +1,71 @@
+"""
+Check the state transitions of the TaskManager's `CircuitBreaker`.
+"""
+
+from cfdoit import circuitBreaker
+from cfdoit.circuitBreaker import CircuitBreaker
+
+class FakeClock :
+  def __init__(self) :
+    self.now = 1000.0
+
+  def time(self) :
+    return self.now
+
+def newBreaker(monkeypatch) :
+  aClock = FakeClock()
+  monkeypatch.setattr(circuitBreaker.time, 'time', aClock.time)
+  return CircuitBreaker(maxFailures=2, coolDown=10.0), aClock
+
+def test_opensAfterMaxFailures(monkeypatch) :
+  aBreaker, aClock = newBreaker(monkeypatch)
+  assert aBreaker.allowRequest()
+  aBreaker.recordFailure()
+  assert aBreaker.state == 'closed'
+  aBreaker.recordFailure()
+  assert aBreaker.state == 'open'
+  assert not aBreaker.allowRequest()
+
+def test_successResetsTheFailureCount(monkeypatch) :
+  aBreaker, aClock = newBreaker(monkeypatch)
+  aBreaker.recordFailure()
+  aBreaker.recordSuccess()
+  aBreaker.recordFailure()
+  assert aBreaker.state == 'closed'
+
+def test_halfOpenProbeSuccessCloses(monkeypatch) :
+  aBreaker, aClock = newBreaker(monkeypatch)
+  aBreaker.recordFailure()
+  aBreaker.recordFailure()
+  aClock.now += 10.0
+  assert aBreaker.allowRequest()
+  assert aBreaker.state == 'half-open'
+  # (only one probe is allowed while it is running)
+  assert not aBreaker.allowRequest()
+  aBreaker.recordSuccess()
+  assert aBreaker.state == 'closed'
+  assert aBreaker.allowRequest()
+
+def test_halfOpenProbeFailureReopens(monkeypatch) :
+  aBreaker, aClock = newBreaker(monkeypatch)
+  aBreaker.recordFailure()
+  aBreaker.recordFailure()
+  aClock.now += 10.0
+  assert aBreaker.allowRequest()
+  aBreaker.recordFailure()
+  assert aBreaker.state == 'open'
+  assert not aBreaker.allowRequest()
+  aClock.now += 10.0
+  assert aBreaker.allowRequest()
+  assert aBreaker.state == 'half-open'
+
+def test_lostProbeIsRetriedAfterCoolDown(monkeypatch) :
+  aBreaker, aClock = newBreaker(monkeypatch)
+  aBreaker.recordFailure()
+  aBreaker.recordFailure()
+  aClock.now += 10.0
+  assert aBreaker.allowRequest()
+  aClock.now += 5.0
+  assert not aBreaker.allowRequest()
+  aClock.now += 5.0
+  assert aBreaker.allowRequest()
@@ -0,0 +1,23 @@
+"""
+Check the shell scripts compiled from a task's actions (see
+`cfdoit.computeFarmTools.compileActionScript`).
+"""
+
+from cfdoit.computeFarmTools import compileActionScript
+
+def test_dictEnvironmentsAreExportedInOrder() :
+  aScript = compileActionScript(
+    {}, { 'srcDir' : 'src', 'CFLAGS' : '-O2 -g' }, [ 'cmake ..' ]
+  ).split("\n\n")
+  assert aScript.index('export srcDir="src"') < aScript.index('export CFLAGS="-O2 -g"')
+  assert aScript.index('export CFLAGS="-O2 -g"') < aScript.index('cmake ..')
+
+def test_listsOfEnvironmentsAndActionLines() :
+  aScript = compileActionScript(
+    { 'll' : 'ls -l' },
+    [ { 'A' : '1' }, { 'B' : '$A/2' } ],
+    [ 'cd build', [ 'ninja', '-j', '4' ] ]
+  ).split("\n\n")
+  assert 'alias ll="ls -l"' in aScript
+  assert 'export A="1"' in aScript and 'export B="$A/2"' in aScript
+  assert aScript[-2:] == [ 'cd build', 'ninja -j 4' ]
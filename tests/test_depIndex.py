@@ -0,0 +1,61 @@
+"""
+Check the tasks which the `DependencyIndex` finds are affected by changes.
+"""
+
+from cfdoit.depIndex import DependencyIndex
+
+def someTasks() :
+  # a.c -> compile-a -> a.o -\
+  #                           link -> app -> install
+  # b.c -> compile-b -> b.o -/
+  # doc.tex -> typeset (unrelated)
+  action = [ 'true' ]
+  return [
+    { 'basename' : 'compile-a', 'actions' : action,
+      'file_dep' : [ 'src/a.c', 'src/common.h' ], 'targets' : [ 'build/a.o' ] },
+    { 'basename' : 'compile-b', 'actions' : action,
+      'file_dep' : [ 'src/b.c', 'src/common.h' ], 'targets' : [ 'build/b.o' ] },
+    { 'basename' : 'link', 'actions' : action,
+      'file_dep' : [ 'build/a.o', 'build/b.o' ], 'targets' : [ 'build/app' ] },
+    { 'basename' : 'install', 'actions' : action,
+      'task_dep' : [ 'link' ], 'targets' : [ 'install/app' ] },
+    { 'basename' : 'typeset', 'actions' : action,
+      'file_dep' : [ 'doc.tex' ], 'targets' : [ 'doc.pdf' ] },
+    { 'basename' : 'all', 'actions' : None,
+      'task_dep' : [ 'install', 'typeset' ] }
+  ]
+
+def test_affectedByOneSource() :
+  anIndex = DependencyIndex(someTasks())
+  assert anIndex.affectedBy([ 'src/a.c' ]) == [
+    'compile-a', 'link', 'install', 'all'
+  ]
+
+def test_affectedBySharedHeader() :
+  anIndex = DependencyIndex(someTasks())
+  affected = anIndex.affectedBy([ './src/common.h' ])
+  assert set(affected) == {
+    'compile-a', 'compile-b', 'link', 'install', 'all'
+  }
+  for aTask, aDep in [
+    ('link', 'compile-a'), ('link', 'compile-b'),
+    ('install', 'link'), ('all', 'install')
+  ] :
+    assert affected.index(aDep) < affected.index(aTask)
+
+def test_affectedByRemovedTarget() :
+  anIndex = DependencyIndex(someTasks())
+  assert anIndex.affectedBy([ 'build/b.o' ]) == [
+    'compile-b', 'link', 'install', 'all'
+  ]
+
+def test_unknownFileAffectsNothing() :
+  anIndex = DependencyIndex(someTasks())
+  assert anIndex.affectedBy([ 'README' ]) == []
+
+def test_indexRoundTripsThroughItsDict() :
+  anIndex = DependencyIndex.fromDict(DependencyIndex(someTasks()).toDict())
+  assert anIndex.affectedBy([ 'doc.tex' ]) == [ 'typeset', 'all' ]
+  assert anIndex.watchedFiles() == [
+    'doc.tex', 'src/a.c', 'src/b.c', 'src/common.h'
+  ]
@@ -0,0 +1,62 @@
+"""
+Check the minimal (frozen, shared) environments of WorkerTasks (see
+`cfdoit.envHelpers.minimalEnvironment`).
+"""
+
+import pytest
+
+from cfdoit.envHelpers import (
+  FrozenEnvironment, expandEnvInActions, minimalEnvironment
+)
+
+identityKeys = [ 'taskName', 'platform', 'repoPath', 'repoVersion' ]
+
+def someEnv() :
+  return {
+    'taskName'    : 'hello.cpp',
+    'platform'    : 'linux-x86_64',
+    'buildDir'    : 'build/linux-x86_64',
+    'srcDir'      : 'src',
+    'in'          : '$srcDir/hello.cpp',
+    'gpp'         : 'g++',
+    'CFLAGS'      : '-O2',
+    'CC'          : 'gcc',
+    'LDFLAGS'     : '-lm',
+    'unused'      : 'never referenced'
+  }
+
+def someActions() :
+  return [
+    'mkdir -p $buildDir',
+    [ '$gpp $CFLAGS', '-c -o $buildDir/hello.o $in' ],
+    'echo "compiled with $$CC"'
+  ]
+
+def test_keysComeFromTheUnexpandedActions() :
+  anEnv = minimalEnvironment(someActions(), someEnv(), identityKeys)
+  assert set(anEnv) == {
+    'taskName', 'platform', 'buildDir', 'gpp', 'CFLAGS', 'in', 'srcDir', 'CC'
+  }
+
+def test_expandedActionsLoseTheirReferences() :
+  # (this is why the unexpanded actions MUST be used)
+  expandedActions = expandEnvInActions('test', someActions(), someEnv())
+  anEnv = minimalEnvironment(expandedActions, someEnv(), identityKeys)
+  assert 'CC' in anEnv
+  for aKey in [ 'buildDir', 'gpp', 'CFLAGS' ] : assert aKey not in anEnv
+
+def test_referencedVariablesAreExportedFirst() :
+  anEnv = minimalEnvironment([ 'cat $in' ], someEnv())
+  assert list(anEnv) == [ 'srcDir', 'in' ]
+
+def test_exportKeys() :
+  assert set(minimalEnvironment([ 'true' ], someEnv(), [ 'LDFLAGS' ])) == { 'LDFLAGS' }
+  assert set(minimalEnvironment([ 'true' ], someEnv(), True)) == set(someEnv())
+
+def test_identicalEnvironmentsAreShared() :
+  anEnv    = minimalEnvironment(someActions(), someEnv(), identityKeys)
+  otherEnv = minimalEnvironment(list(reversed(someActions())), someEnv(), identityKeys)
+  assert anEnv is otherEnv
+  assert isinstance(anEnv, FrozenEnvironment)
+  with pytest.raises(TypeError) :
+    anEnv['CFLAGS'] = '-O0'
@@ -0,0 +1,71 @@
+"""
+Check the token accounting of the jobserver (see `cfdoit.jobServer`), and the
+load of the tasks which run while it is running.
+"""
+
+import os
+import threading
+
+import pytest
+
+from cfdoit.config import Config
+from cfdoit.jobServer import JobServer
+from cfdoit.workerTasks import WorkerTask
+
+@pytest.fixture
+def jobServer(monkeypatch) :
+  monkeypatch.setattr(Config, 'config', {
+    'GLOBAL' : { 'build' : { 'jobServer' : True, 'jobServerSlots' : 2 } }
+  })
+  JobServer.start()
+  assert JobServer.fifoPath is not None
+  yield JobServer
+  JobServer.stop()
+
+def test_disabledJobServerIsNotStarted(monkeypatch) :
+  monkeypatch.setattr(Config, 'config', {})
+  JobServer.start()
+  assert JobServer.fifoPath is None
+  assert JobServer.acquire() is None
+  assert JobServer.environment() is None
+
+def test_tokensAreLimitedToTheSlots(jobServer) :
+  firstToken  = jobServer.acquire()
+  secondToken = jobServer.acquire()
+  assert firstToken and secondToken
+
+  acquired = threading.Event()
+  tokens   = []
+  def takeToken() :
+    tokens.append(jobServer.acquire())
+    acquired.set()
+  aThread = threading.Thread(target=takeToken, daemon=True)
+  aThread.start()
+  assert not acquired.wait(0.2)
+
+  jobServer.release(firstToken)
+  assert acquired.wait(5.0)
+  assert tokens == [ firstToken ]
+
+  jobServer.release(secondToken)
+  jobServer.release(tokens[0])
+
+def test_environmentAdvertisesTheJobServer(jobServer) :
+  anEnv = jobServer.environment()
+  assert anEnv['CFDOIT_JOBSERVER'] == jobServer.fifoPath
+  assert f"--jobserver-auth=fifo:{jobServer.fifoPath}" in anEnv['MAKEFLAGS']
+  assert ' -j2 ' in anEnv['MAKEFLAGS']
+
+def test_stopRemovesTheFifo(jobServer) :
+  fifoPath = jobServer.fifoPath
+  jobServer.stop()
+  assert not os.path.exists(fifoPath)
+  assert jobServer.acquire() is None
+
+def test_jobServerLoadIsOnlyUsedWhileTheJobServerRuns(monkeypatch) :
+  aTask = WorkerTask({ 'estimatedLoad' : 10.0, 'jobServerLoad' : 1.0 })
+  monkeypatch.setattr(Config, 'config', {})
+  assert aTask.localLoad() == 10.0
+  monkeypatch.setattr(JobServer, 'fifoPath', '/tmp/fifo')
+  assert aTask.localLoad() == 1.0
+  assert WorkerTask({ 'estimatedLoad' : 10.0 }).localLoad() == 10.0
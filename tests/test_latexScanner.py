@@ -0,0 +1,68 @@
+"""
+Check the discovery of the dependencies of LaTeX documents, and the cache of
+the references found in each source (see `cfdoit.latexScanner`).
+"""
+
+import os
+
+import pytest
+
+import cfdoit.latexScanner
+from cfdoit.config import Config
+from cfdoit.latexScanner import LatexScanner
+
+@pytest.fixture
+def latexDir(tmp_path, monkeypatch) :
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(Config, 'config', {
+    'GLOBAL' : { 'build' : { 'stateDir' : 'state' } }
+  })
+  monkeypatch.setattr(LatexScanner, 'cache', None)
+  monkeypatch.setattr(LatexScanner, 'changed', False)
+  (tmp_path / 'doc.tex').write_text("\n".join([
+    "\\input{chapter}",
+    "\\includegraphics[width=5cm]{arch_v1_5}",
+    "\\input{code.pygmented}",
+    "% \\includegraphics{commented_v1_5}",
+    ""
+  ]))
+  (tmp_path / 'chapter.tex').write_text("\\includegraphics{flow_v1_5.pdf}\n")
+  return tmp_path
+
+def forbidScanning(monkeypatch) :
+  def scanSource(someText, somePatterns) :
+    raise AssertionError("the source was rescanned")
+  monkeypatch.setattr(cfdoit.latexScanner, 'scanSource', scanSource)
+
+def test_scanFollowsInputs(latexDir) :
+  dependencies = LatexScanner.scan('doc.tex')
+  assert dependencies['sources']  == [ 'doc.tex', 'chapter.tex' ]
+  assert dependencies['diagrams'] == [ 'arch', 'flow' ]
+  assert dependencies['pygments'] == [ 'code.chunk' ]
+  assert os.path.exists(os.path.join('state', 'latexScan.json'))
+
+def test_unchangedSourcesAreNotRescanned(latexDir, monkeypatch) :
+  firstScan = LatexScanner.scan('doc.tex')
+  # (the cache is also reloaded from the cache file)
+  LatexScanner.cache = None
+  forbidScanning(monkeypatch)
+  assert LatexScanner.scan('doc.tex') == firstScan
+
+def test_touchedSourcesAreNotRescanned(latexDir, monkeypatch) :
+  firstScan = LatexScanner.scan('doc.tex')
+  aStat = os.stat('chapter.tex')
+  os.utime('chapter.tex', (aStat.st_atime, aStat.st_mtime + 10))
+  forbidScanning(monkeypatch)
+  assert LatexScanner.scan('doc.tex') == firstScan
+
+def test_changedSourcesAreRescanned(latexDir) :
+  LatexScanner.scan('doc.tex')
+  (latexDir / 'chapter.tex').write_text("\\includegraphics{other_v1_5}\n")
+  assert LatexScanner.scan('doc.tex')['diagrams'] == [ 'arch', 'other' ]
+
+def test_changedPatternsRescanTheSources(latexDir) :
+  LatexScanner.scan('doc.tex')
+  Config.config['GLOBAL']['latex'] = {
+    'scanPatterns' : { 'diagrams' : [ r'\\includegraphics\{([^}]*?)\.pdf\}' ] }
+  }
+  assert LatexScanner.scan('doc.tex')['diagrams'] == [ 'flow_v1_5' ]
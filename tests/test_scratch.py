@@ -0,0 +1,83 @@
+"""
+Check the mirroring of the project's tree into a scratch directory, and the
+moving of the targets back out of it (see `cfdoit.scratch.Scratch`).
+"""
+
+import os
+
+import pytest
+
+from cfdoit.scratch import Scratch
+
+def writeFile(aPath, someText='') :
+  os.makedirs(os.path.dirname(aPath) or '.', exist_ok=True)
+  with open(aPath, 'w') as aFile : aFile.write(someText)
+
+def readFile(aPath) :
+  with open(aPath) as aFile : return aFile.read()
+
+@pytest.fixture
+def projectDir(tmp_path, monkeypatch) :
+  projectDir = tmp_path / 'project'
+  projectDir.mkdir()
+  monkeypatch.chdir(projectDir)
+  writeFile(os.path.join('src', 'hello.cpp'), 'int main() {}\n')
+  writeFile(os.path.join('build', 'obj', 'old.o'), 'old object')
+  writeFile(os.path.join('build', 'obj', 'dep.o'), 'dependency')
+  writeFile(os.path.join('build', 'other', 'lib.a'), 'library')
+  writeFile('README', 'readme')
+  return projectDir
+
+@pytest.fixture
+def scratchDir(tmp_path) :
+  scratchDir = tmp_path / 'scratch'
+  scratchDir.mkdir()
+  return str(scratchDir)
+
+def test_mirrorLinksEverythingOutsideTheOutputDirs(projectDir, scratchDir) :
+  Scratch.mirrorTree(scratchDir, [ os.path.join('build', 'obj', 'hello.o') ])
+  for relPath in [ 'README', 'src', os.path.join('build', 'other') ] :
+    assert os.path.islink(os.path.join(scratchDir, relPath))
+  assert readFile(os.path.join(scratchDir, 'src', 'hello.cpp')) == 'int main() {}\n'
+  # (the directories along the path to the targets are real directories)
+  for relPath in [ 'build', os.path.join('build', 'obj') ] :
+    aPath = os.path.join(scratchDir, relPath)
+    assert os.path.isdir(aPath) and not os.path.islink(aPath)
+
+def test_mirrorOnlyLinksDeclaredInputsInOutputDirs(projectDir, scratchDir) :
+  Scratch.mirrorTree(
+    scratchDir,
+    [ os.path.join('build', 'obj', 'hello.o') ],
+    [ os.path.join('build', 'obj', 'dep.o'), os.path.join('src', 'hello.cpp') ]
+  )
+  objDir = os.path.join(scratchDir, 'build', 'obj')
+  assert os.listdir(objDir) == [ 'dep.o' ]
+  assert os.path.islink(os.path.join(objDir, 'dep.o'))
+
+def test_mirrorCreatesMissingOutputDirs(projectDir, scratchDir) :
+  Scratch.mirrorTree(scratchDir, [ os.path.join('out', 'new', 'a.pdf') ])
+  assert os.path.isdir(os.path.join(scratchDir, 'out', 'new'))
+  assert not os.path.exists(os.path.join(projectDir, 'out'))
+
+def test_targetsWrittenInScratchDoNotReachTheTree(projectDir, scratchDir) :
+  target = os.path.join('build', 'obj', 'old.o')
+  Scratch.mirrorTree(scratchDir, [ target ])
+  assert not os.path.exists(os.path.join(scratchDir, target))
+  writeFile(os.path.join(scratchDir, target), 'new object')
+  assert readFile(target) == 'old object'
+
+def test_moveTargetsReplacesTheTargets(projectDir, scratchDir) :
+  targets = [
+    os.path.join('build', 'obj', 'old.o'),
+    os.path.join('out', 'new', 'a.pdf'),
+    os.path.join('build', 'obj', 'notCreated.o')
+  ]
+  Scratch.mirrorTree(scratchDir, targets)
+  writeFile(os.path.join(scratchDir, targets[0]), 'new object')
+  writeFile(os.path.join(scratchDir, targets[1]), 'pdf')
+  aScratch = { 'dir' : scratchDir, 'targets' : targets }
+  assert Scratch.moveTargets(aScratch) is None
+  assert readFile(targets[0]) == 'new object'
+  assert readFile(targets[1]) == 'pdf'
+  assert not os.path.exists(targets[2])
+  assert aScratch['usedBytes'] == len('new object') + len('pdf')
@@ -0,0 +1,42 @@
+"""
+Check the block delta used to upload staged inputs (see `cfdoit.staging`).
+"""
+
+import os
+
+from cfdoit.staging import blockDelta, applyDelta
+
+blockSize = 16
+
+def roundTrip(baseBytes, newBytes) :
+  delta = blockDelta(baseBytes, newBytes, blockSize)
+  assert applyDelta(baseBytes, delta, blockSize) == newBytes
+  return delta
+
+def test_unchangedFileIsAllReferences() :
+  someBytes = os.urandom(10 * blockSize)
+  delta = roundTrip(someBytes, someBytes)
+  assert delta == list(range(10))
+
+def test_changedBlockIsSentLiterally() :
+  baseBytes = os.urandom(8 * blockSize)
+  newBytes  = baseBytes[:3*blockSize] + b'x'*blockSize + baseBytes[4*blockSize:]
+  delta = roundTrip(baseBytes, newBytes)
+  assert [ isinstance(anItem, int) for anItem in delta ] == \
+    [ True, True, True, False, True, True, True, True ]
+
+def test_baseLongerThanNewFile() :
+  baseBytes = os.urandom(12 * blockSize + 5)
+  newBytes  = baseBytes[:4*blockSize] + b'tail'
+  delta = roundTrip(baseBytes, newBytes)
+  assert delta[:4] == [ 0, 1, 2, 3 ]
+
+def test_baseShorterThanNewFile() :
+  baseBytes = os.urandom(3 * blockSize + 7)
+  newBytes  = baseBytes + os.urandom(9 * blockSize + 3)
+  delta = roundTrip(baseBytes, newBytes)
+  assert delta[:3] == [ 0, 1, 2 ]
+
+def test_emptyBaseAndEmptyNewFile() :
+  roundTrip(b'', os.urandom(2 * blockSize + 1))
+  assert roundTrip(os.urandom(blockSize), b'') == []
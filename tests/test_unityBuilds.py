@@ -0,0 +1,88 @@
+"""
+Check the partitioning of sources into unity groups, and the planning of
+unity builds (see `cfdoit.unityBuilds`).
+"""
+
+import os
+
+from cfdoit.config import Config
+from cfdoit.taskHistory import TaskHistory
+from cfdoit.unityBuilds import partitionGroups, planUnityBuilds
+
+def srcNames(numSrcs) :
+  return [ f"src{aNum:03d}.cpp" for aNum in range(numSrcs) ]
+
+def test_everySourceIsInExactlyOneGroup() :
+  weights = { aSrcName : 1 for aSrcName in srcNames(20) }
+  groups  = partitionGroups(weights, 3)
+  assert len(groups) == 3
+  assert sorted(sum(groups, [])) == sorted(weights)
+
+def test_equalWeightsGiveBalancedGroups() :
+  weights = { aSrcName : 100 for aSrcName in srcNames(30) }
+  groups  = partitionGroups(weights, 3)
+  assert [ len(aGroup) for aGroup in groups ] == [ 10, 10, 10 ]
+
+def test_partitionIgnoresTheOrderOfTheSources() :
+  weights = { aSrcName : 1 for aSrcName in srcNames(12) }
+  reversedWeights = dict(reversed(list(weights.items())))
+  assert partitionGroups(weights, 4) == partitionGroups(reversedWeights, 4)
+
+def test_smallWeightChangesDoNotMoveSources() :
+  weights = { aSrcName : 100 for aSrcName in srcNames(16) }
+  jitteredWeights = {
+    aSrcName : 100 + (aNum % 3) for aNum, aSrcName in enumerate(weights)
+  }
+  assert partitionGroups(weights, 4) == partitionGroups(jitteredWeights, 4)
+
+def test_addingASourceOnlyMovesItsNeighbours() :
+  weights = { aSrcName : 1 for aSrcName in srcNames(40) }
+  oldGroups = partitionGroups(weights, 4)
+  weights['added.cpp'] = 1
+  newGroups = partitionGroups(weights, 4)
+  oldGroupOf = {}
+  for groupNum, aGroup in enumerate(oldGroups) :
+    for aSrcName in aGroup : oldGroupOf[aSrcName] = groupNum
+  moved = 0
+  for groupNum, aGroup in enumerate(newGroups) :
+    for aSrcName in aGroup :
+      if aSrcName in oldGroupOf and oldGroupOf[aSrcName] != groupNum : moved += 1
+  assert moved <= 3
+
+def test_moreGroupsThanSources() :
+  groups = partitionGroups({ 'a.cpp' : 1, 'b.cpp' : 1 }, 4)
+  assert len(groups) == 4
+  assert sorted(sum(groups, [])) == [ 'a.cpp', 'b.cpp' ]
+
+def test_planKeepsMembersWhichOtherProjectsLink(tmp_path, monkeypatch) :
+  monkeypatch.setattr(TaskHistory, 'history', {})
+  monkeypatch.setattr(Config, 'config', {
+    'GLOBAL' : { 'build' : { 'buildDir' : str(tmp_path) } }
+  })
+  os.makedirs(tmp_path / 'src')
+  for aSrcName in [ 'a.cpp', 'b.cpp', 'c.cpp' ] :
+    (tmp_path / 'src' / aSrcName).write_text('int x;\n')
+
+  projects = {
+    'a.cpp' : { 'taskSnipet' : 'gppCompile' },
+    'b.cpp' : { 'taskSnipet' : 'gppCompile' },
+    'c.cpp' : { 'taskSnipet' : 'gppCompile' },
+    'tool'  : {
+      'taskSnipet'   : 'gppInstallCommand',
+      'unity'        : { 'groups' : 1 },
+      'dependencies' : { 'cObj' : [ 'a.o', 'b.o', 'c.o' ] }
+    },
+    'other' : {
+      'taskSnipet'   : 'gppInstallCommand',
+      'dependencies' : { 'cObj' : [ 'b.o' ] }
+    }
+  }
+  planned = planUnityBuilds('linux', projects)
+
+  assert planned['tool']['dependencies']['cObj'] == [ 'tool-unity-0.o' ]
+  assert planned['tool-unity-0']['taskSnipet'] == 'gppUnityCompile'
+  assert planned['tool-unity-0']['unitySources'] == [ 'a.cpp', 'b.cpp', 'c.cpp' ]
+  assert 'a.cpp' not in planned and 'c.cpp' not in planned
+  assert 'b.cpp' in planned
+  # (the original descriptions are not changed)
+  assert projects['tool']['dependencies']['cObj'] == [ 'a.o', 'b.o', 'c.o' ]
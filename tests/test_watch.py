@@ -0,0 +1,54 @@
+"""
+Check the splitting of the `cfdoit watch` arguments into `doit run` options
+and task names (see `cfdoit.watch.splitRunArgs`).
+"""
+
+import pytest
+
+from doit.cmdparse import CmdParseError
+
+from cfdoit.watch import splitRunArgs
+
+def test_taskNamesOnly() :
+  assert splitRunArgs([ 'compile', 'link' ]) == ([], [ 'compile', 'link' ])
+
+def test_optionValuesStayWithTheirOptions() :
+  runOptions, taskNames = splitRunArgs([ '-n', '4', 'link', '-P', 'thread' ])
+  assert runOptions == [ '-n', '4', '-P', 'thread' ]
+  assert taskNames  == [ 'link' ]
+
+def test_flagsDoNotTakeValues() :
+  runOptions, taskNames = splitRunArgs([ '-a', 'link', '--continue', 'compile' ])
+  assert runOptions == [ '-a', '--continue' ]
+  assert taskNames  == [ 'link', 'compile' ]
+
+def test_inverseOptionsDoNotTakeValues() :
+  assert splitRunArgs([ '--no-continue', 'link' ]) == ([ '--no-continue' ], [ 'link' ])
+
+def test_longOptionValues() :
+  runOptions, taskNames = splitRunArgs([
+    '--process=4', '--reporter', 'json', 'link'
+  ])
+  assert runOptions == [ '--process=4', '--reporter', 'json' ]
+  assert taskNames  == [ 'link' ]
+
+def test_bundledShortOptions() :
+  # (a value is only taken from the next argument by the last bundled option)
+  assert splitRunArgs([ '-an', '4', 'link' ]) == ([ '-an', '4' ], [ 'link' ])
+  assert splitRunArgs([ '-an4', 'link' ]) == ([ '-an4' ], [ 'link' ])
+  assert splitRunArgs([ '-as', 'link' ]) == ([ '-as' ], [ 'link' ])
+
+def test_argumentsAfterADoubleDashAreTaskNames() :
+  runOptions, taskNames = splitRunArgs([ '-n', '2', '--', '-odd-name', 'link' ])
+  assert runOptions == [ '-n', '2' ]
+  assert taskNames  == [ '-odd-name', 'link' ]
+
+def test_unknownOptionsAreRejected() :
+  with pytest.raises(CmdParseError) :
+    splitRunArgs([ '--no-such-option', 'link' ])
+  with pytest.raises(CmdParseError) :
+    splitRunArgs([ '-Z' ])
+
+def test_missingOptionValuesAreRejected() :
+  with pytest.raises(CmdParseError) :
+    splitRunArgs([ 'link', '-n' ])